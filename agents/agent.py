@@ -1,9 +1,12 @@
 import logging
+from agents.metrics import registry
 
 class Agent:
     """
     An abstract superclass for Agents
     Used to log messages in a way that can identify each Agent
+    Agents that price, scan or alert also offer async variants (aprice, ascan, aalert) for use on one event loop;
+    the sync methods remain for notebooks and scripts
     """
 
     # Foreground colors
@@ -27,7 +30,18 @@ class Agent:
     def log(self, message):
         """
         Log this as an info message, identifying the agent
+        The colour codes are only assembled when INFO logging is actually enabled
         """
+        if not logging.root.isEnabledFor(logging.INFO):
+            return
         color_code = self.BG_BLACK + self.color
         message = f"[{self.name}] {message}"
-        logging.info(color_code + message + self.RESET)
\ No newline at end of file
+        logging.info(color_code + message + self.RESET)
+
+    def span(self, stage: str, model: str = None):
+        """
+        Time a stage of this agent's work, recording duration, outcome, model and cache hits
+        Use as: with self.span("price", model=self.MODEL) as span: ...
+        Returns a shared no-op span when metrics are disabled
+        """
+        return registry.span(self.name, stage, model)
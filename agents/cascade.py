@@ -0,0 +1,54 @@
+import os
+import json
+import math
+from pydantic import BaseModel
+
+THRESHOLDS_FILENAME = "cascade_thresholds.json"
+
+# The tiers of the cascade, cheapest first, with a rough relative cost of reaching each one
+TIERS = ["local", "specialist", "frontier"]
+TIER_COST = {"local": 0.0, "specialist": 1.0, "frontier": 2.5}
+
+
+class CascadeThresholds(BaseModel):
+    """
+    When the cheap tiers of the ensemble cascade are trusted to answer on their own
+    Disagreements are measured as the absolute difference of log(1 + price)
+    """
+    local_disagreement: float = 0.3
+    local_distance: float = 0.9
+    specialist_disagreement: float = 0.3
+
+    @classmethod
+    def load(cls, filename: str = THRESHOLDS_FILENAME) -> "CascadeThresholds":
+        if os.path.exists(filename):
+            with open(filename, "r") as file:
+                return cls(**json.load(file))
+        return cls()
+
+    def save(self, filename: str = THRESHOLDS_FILENAME) -> None:
+        with open(filename, "w") as file:
+            json.dump(self.dict(), file, indent=2)
+
+
+def log_gap(a: float, b: float) -> float:
+    return abs(math.log1p(max(a, 0)) - math.log1p(max(b, 0)))
+
+
+def local_estimate(random_forest: float, knn: float) -> float:
+    return (random_forest + knn) / 2
+
+
+def local_is_confident(random_forest: float, knn: float, distance: float, thresholds: CascadeThresholds) -> bool:
+    """
+    Trust the local tier when the random forest and the neighbours agree,
+    and the item isn't far from everything in the vector store
+    """
+    return log_gap(random_forest, knn) <= thresholds.local_disagreement and distance <= thresholds.local_distance
+
+
+def specialist_is_confident(specialist: float, local: float, thresholds: CascadeThresholds) -> bool:
+    """
+    Trust the specialist when it agrees with the local estimate; otherwise escalate to the frontier model
+    """
+    return log_gap(specialist, local) <= thresholds.specialist_disagreement
@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from agents.vector_store import iter_store
+
+# Set RAG_CATEGORY_ROUTING=1 to search only the likely categories' shards of the vector store
+RAG_CATEGORY_ROUTING = os.getenv("RAG_CATEGORY_ROUTING", "0") == "1"
+CENTROIDS_PATH = os.getenv("RAG_CENTROIDS_PATH", "category_centroids.npz")
+
+
+class CategoryRouter:
+    """
+    Routes each vector store query to the category shards its product most likely belongs to
+    A nearest-centroid classifier over the embeddings gives a probability for each category;
+    the query searches the fewest categories whose probabilities add up to COVERAGE,
+    with a Chroma where filter on the category metadata, and falls back to the whole collection
+    when that would take more than MAX_SHARDS categories
+    Like CompactIndex, it answers query() and passes everything else through to the collection it wraps
+    """
+
+    COVERAGE = 0.9
+    MAX_SHARDS = 2
+    # The per-query lists of a Chroma query result
+    KEYS = ("ids", "documents", "metadatas", "distances", "embeddings")
+
+    def __init__(self, collection, categories: List[str], centroids: np.ndarray, temperature: float,
+                 coverage: float = COVERAGE, max_shards: int = MAX_SHARDS):
+        """
+        :param collection: a Chroma collection, or a CompactIndex over one
+        :param categories: the category names, in the order of the centroid rows
+        :param centroids: the unit-length mean embedding of each category, shape (categories, 384)
+        :param temperature: the softmax temperature that turns cosine similarities into probabilities
+        """
+        self.collection = collection
+        self.categories = list(categories)
+        self.centroids = centroids.astype(np.float32)
+        self.temperature = temperature
+        self.coverage = coverage
+        self.max_shards = max_shards
+        self.routed = 0
+        self.fallbacks = 0
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    @classmethod
+    def fit(cls, collection, sample: int = 20000, seed: int = 42) -> "CategoryRouter":
+        """
+        Average the embeddings of each category in one streaming pass over the collection, then pick
+        the temperature that minimises the log loss of the classifier on a random sample
+        """
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = defaultdict(int)
+        rng = np.random.default_rng(seed)
+        held_vectors, held_labels = [], []
+        rate = sample / max(collection.count(), 1)
+        for _, vectors, _, labels in iter_store(collection):
+            for category in np.unique(labels):
+                rows = vectors[labels == category]
+                sums[category] = sums.get(category, 0) + rows.sum(axis=0)
+                counts[category] += len(rows)
+            keep = rng.random(len(labels)) < rate
+            held_vectors.append(vectors[keep])
+            held_labels.append(labels[keep])
+        categories = [str(category) for category in sorted(sums)]
+        centroids = np.stack([sums[category] / counts[category] for category in categories])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        vectors, labels = np.concatenate(held_vectors), np.concatenate(held_labels)
+        truth = np.array([categories.index(label) for label in labels])
+        similarities = vectors @ centroids.T
+
+        def log_loss(temperature):
+            logits = similarities / temperature
+            logits -= logits.max(axis=1, keepdims=True)
+            log_probabilities = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+            return -log_probabilities[np.arange(len(truth)), truth].mean()
+        temperature = min(np.geomspace(0.005, 1, 40), key=log_loss)
+        return cls(collection, categories, centroids, float(temperature))
+
+    def save(self, path: str = CENTROIDS_PATH) -> None:
+        np.savez(path, categories=np.array(self.categories), centroids=self.centroids, temperature=self.temperature)
+
+    @classmethod
+    def load(cls, collection, path: str = CENTROIDS_PATH) -> "CategoryRouter":
+        with np.load(path) as arrays:
+            return cls(collection, [str(c) for c in arrays["categories"]], arrays["centroids"], float(arrays["temperature"]))
+
+    def probabilities(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        :return: the probability of each category for each vector, shape (n, categories)
+        """
+        logits = np.asarray(vectors, dtype=np.float32) @ self.centroids.T / self.temperature
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def classify(self, vectors: np.ndarray) -> List[Tuple[str, float]]:
+        """
+        :return: the most likely category of each vector, with its probability
+        """
+        probabilities = self.probabilities(vectors)
+        return [(self.categories[best], float(row[best])) for row, best in zip(probabilities, probabilities.argmax(axis=1))]
+
+    def shards_for(self, vectors: np.ndarray) -> List[Optional[Tuple[str, ...]]]:
+        """
+        :return: for each vector, the categories to search, or None to search the whole collection
+        """
+        shards = []
+        for row in self.probabilities(vectors):
+            order = np.argsort(-row)
+            needed = int(np.searchsorted(np.cumsum(row[order]), self.coverage)) + 1
+            shards.append(tuple(sorted(self.categories[i] for i in order[:needed])) if needed <= self.max_shards else None)
+        return shards
+
+    @staticmethod
+    def where(shard: Tuple[str, ...]) -> Dict:
+        return {"category": shard[0]} if len(shard) == 1 else {"category": {"$in": list(shard)}}
+
+    def query(self, query_embeddings, n_results: int = 10, include=('documents', 'metadatas', 'distances'), **kwargs) -> Dict[str, list]:
+        """
+        Query each group of embeddings that share the same shards with one filtered query, and return
+        the results in the original order, in the shape of Chroma's collection.query result
+        """
+        vectors = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        groups: Dict[Optional[Tuple[str, ...]], List[int]] = defaultdict(list)
+        for i, shard in enumerate(self.shards_for(vectors)):
+            groups[shard].append(i)
+        self.fallbacks += len(groups.get(None, []))
+        self.routed += len(vectors) - len(groups.get(None, []))
+        answers: List[Optional[Dict[str, list]]] = [None] * len(vectors)
+        for shard, rows in groups.items():
+            where = self.where(shard) if shard else None
+            result = self.collection.query(query_embeddings=vectors[rows].astype(float).tolist(), n_results=n_results,
+                                           include=include, where=where, **kwargs)
+            for position, row in enumerate(rows):
+                answers[row] = {key: result[key][position] for key in self.KEYS if result.get(key) is not None}
+        keys = answers[0].keys() if answers else ["ids"]
+        return {key: [answer[key] for answer in answers] for key in keys}
+
+
+def evaluate(collection, router: CategoryRouter, size: int = 250, k: int = 5) -> None:
+    """
+    On the test items: how often the classifier names the right category, how often queries fall back
+    to a global search, how many of the global nearest neighbours the routed search still finds, and latency
+    """
+    import pickle
+    from agents.embeddings import get_encoder
+    with open("test.pkl", "rb") as file:
+        test = pickle.load(file)[:size]
+    texts = [item.prompt.split("to the nearest dollar?\n\n")[1].split("\n\nPrice is $")[0] for item in test]
+    vectors = np.asarray(get_encoder().encode(texts), dtype=np.float32)
+    predicted = router.classify(vectors)
+    accuracy = np.mean([category == item.category for (category, _), item in zip(predicted, test)])
+    print(f"Category accuracy {accuracy:.1%}, temperature {router.temperature:.3f}")
+    timings = {}
+    results = {}
+    for title, searcher in (("Global", collection), ("Routed", router)):
+        start = time.perf_counter()
+        results[title] = searcher.query(query_embeddings=vectors.astype(float).tolist(), n_results=k,
+                                        include=['metadatas', 'distances'])
+        timings[title] = (time.perf_counter() - start) * 1000 / size
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(results["Routed"]["ids"], results["Global"]["ids"])])
+    same = np.mean([np.mean([m['category'] == item.category for m in metadatas])
+                    for metadatas, item in zip(results["Routed"]["metadatas"], test)])
+    print(f"Fallbacks {router.fallbacks / size:.1%}, overlap with global neighbours {overlap:.1%}, "
+          f"neighbours in the item's own category {same:.1%}")
+    for title, milliseconds in timings.items():
+        print(f"{title:<8} {milliseconds:,.2f} ms/query")
+
+
+if __name__ == "__main__":
+    import chromadb
+    from agents.vector_index import open_collection
+    task = sys.argv[1] if len(sys.argv) > 1 else "evaluate"
+    collection = chromadb.PersistentClient(path="products_vectorstore").get_or_create_collection('products')
+    if task == "build":
+        router = CategoryRouter.fit(collection)
+        router.save()
+        print(f"Saved {len(router.categories)} category centroids to {CENTROIDS_PATH}")
+    if task == "evaluate":
+        collection = open_collection(collection, routing=False)
+        evaluate(collection, CategoryRouter.load(collection))
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import numpy as np
+
+LEAF = -1
+
+
+class CompactForest:
+    """
+    A flattened, read-only copy of a fitted sklearn RandomForestRegressor
+    All trees are concatenated into a handful of float32 / int32 node arrays,
+    saved as .npy files that can be memory-mapped at load time,
+    and a whole batch is pushed through every tree at once with numpy gathers
+    """
+
+    ARRAYS = ("feature", "threshold", "left", "right", "value", "roots")
+
+    def __init__(self, feature, threshold, left, right, value, roots, max_depth: int, n_features: int):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.n_features = n_features
+
+    @classmethod
+    def from_sklearn(cls, model) -> "CompactForest":
+        """
+        Flatten every estimator of a fitted RandomForestRegressor into shared node arrays
+        Leaves point back to themselves so that traversal can run a fixed number of steps
+        """
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            count = tree.node_count
+            index = np.arange(offset, offset + count, dtype=np.int32)
+            is_leaf = tree.children_left == LEAF
+            left = np.where(is_leaf, index, tree.children_left + offset).astype(np.int32)
+            right = np.where(is_leaf, index, tree.children_right + offset).astype(np.int32)
+            feature = np.where(is_leaf, 0, tree.feature).astype(np.int32)
+            threshold = cls.round_down(np.where(is_leaf, np.inf, tree.threshold))
+            features.append(feature)
+            thresholds.append(threshold)
+            lefts.append(left)
+            rights.append(right)
+            values.append(tree.value[:, 0, 0].astype(np.float32))
+            roots.append(offset)
+            max_depth = max(max_depth, tree.max_depth)
+            offset += count
+        return cls(
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            left=np.concatenate(lefts),
+            right=np.concatenate(rights),
+            value=np.concatenate(values),
+            roots=np.array(roots, dtype=np.int32),
+            max_depth=int(max_depth),
+            n_features=int(model.n_features_in_),
+        )
+
+    @staticmethod
+    def round_down(thresholds: np.ndarray) -> np.ndarray:
+        """
+        Cast float64 split thresholds to the largest float32 not above them
+        sklearn compares float32 inputs against float64 thresholds, so rounding down
+        keeps x <= threshold giving exactly the same branch for every float32 x
+        """
+        rounded = thresholds.astype(np.float32)
+        above = rounded.astype(np.float64) > thresholds
+        rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+        return rounded
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Predict a batch of rows, averaging the leaf value reached in every tree
+        :param X: array of shape (n, n_features)
+        :return: array of shape (n,) of predictions
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X[None, :]
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], self.roots.shape[0])).copy()
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.value[nodes].mean(axis=1, dtype=np.float64)
+
+    def save(self, path: str) -> None:
+        """
+        Write each node array as an uncompressed .npy file (so it can be memory-mapped),
+        plus a small json file with the shape of the forest
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        meta = {"max_depth": self.max_depth, "n_features": self.n_features, "n_trees": int(self.roots.shape[0])}
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump(meta, file, indent=2)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "CompactForest":
+        """
+        Load a forest written by save, memory-mapping the node arrays by default
+        """
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode) for name in cls.ARRAYS}
+        return cls(max_depth=meta["max_depth"], n_features=meta["n_features"], **arrays)
+
+    def verify(self, model, X, tolerance: float = 1e-3) -> float:
+        """
+        Check that this forest agrees with the sklearn model it came from
+        :return: the largest absolute difference between the two sets of predictions
+        """
+        expected = model.predict(np.asarray(X, dtype=np.float32))
+        difference = float(np.max(np.abs(self.predict(X) - expected)))
+        if difference > tolerance * max(1.0, float(np.max(np.abs(expected)))):
+            raise ValueError(f"Compact forest disagrees with sklearn model by {difference}")
+        return difference
+
+
+def export(pickle_path: str = "random_forest_model.pkl", path: str = "random_forest_compact", samples: int = 1000) -> CompactForest:
+    """
+    Convert a pickled RandomForestRegressor into the compact format and verify it
+    on random unit vectors shaped like the MiniLM embeddings
+    """
+    import joblib
+    model = joblib.load(pickle_path)
+    forest = CompactForest.from_sklearn(model)
+    X = np.random.default_rng(42).standard_normal((samples, forest.n_features)).astype(np.float32)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    difference = forest.verify(model, X)
+    forest.save(path)
+    print(f"Saved {forest.roots.shape[0]} trees / {forest.value.shape[0]} nodes to {path} (max difference {difference:.6f})")
+    return forest
+
+
+if __name__ == "__main__":
+    export(*sys.argv[1:3])
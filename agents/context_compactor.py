@@ -0,0 +1,150 @@
+import os
+import re
+import sys
+from typing import List, Set, Tuple
+import numpy as np
+
+# Upper bound on the tokens the neighbour context may add to a frontier prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("FRONTIER_CONTEXT_TOKENS", "320"))
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?;])\s+")
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def words(text: str) -> Set[str]:
+    return set(WORD.findall(text.lower()))
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+class ContextCompactor:
+    """
+    Shrinks the RAG context pasted into frontier prompts, where input tokens dominate latency and cost:
+    1. Near-identical neighbours (the same product listed twice) are dropped
+    2. Fewer neighbours are kept when their prices agree, more when they are spread out
+    3. Each neighbour keeps its title and the sentences that overlap most with the product being priced
+    4. The whole context is held to a token budget, counted with the project's tokenizer
+    """
+
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET, min_k: int = 2, max_k: int = 5,
+                 duplicate_similarity: float = 0.8, price_spread: float = 0.5, sentences: int = 2, tokenizer=None):
+        """
+        :param token_budget: the most tokens the compacted neighbours may use in total
+        :param min_k: neighbours kept when their prices agree
+        :param max_k: neighbours kept when the standard deviation of their log prices reaches price_spread
+        :param duplicate_similarity: word-set Jaccard similarity above which a neighbour counts as a duplicate
+        :param sentences: sentences kept from the body of each neighbour, after its title
+        :param tokenizer: defaults to Item.tokenizer, the Llama tokenizer the products were curated with
+        """
+        self.token_budget = token_budget
+        self.min_k = min_k
+        self.max_k = max_k
+        self.duplicate_similarity = duplicate_similarity
+        self.price_spread = price_spread
+        self.sentences = sentences
+        self._tokenizer = tokenizer
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from items import Item
+            self._tokenizer = Item.tokenizer
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def dedupe(self, documents: List[str]) -> List[int]:
+        """
+        :return: the indices of the neighbours to keep, closest first, skipping near-duplicates of kept ones
+        """
+        kept, seen = [], []
+        for i, document in enumerate(documents):
+            document_words = words(document)
+            if any(jaccard(document_words, other) >= self.duplicate_similarity for other in seen):
+                continue
+            kept.append(i)
+            seen.append(document_words)
+        return kept
+
+    def choose_k(self, prices: List[float]) -> int:
+        """
+        How many neighbours to show: agreeing prices need little evidence, scattered ones need more
+        """
+        if len(prices) < 2:
+            return len(prices)
+        spread = float(np.std(np.log1p(np.maximum(prices, 0))))
+        k = self.min_k + round((self.max_k - self.min_k) * min(1.0, spread / self.price_spread))
+        return min(k, len(prices))
+
+    def trim(self, document: str, query: Set[str]) -> str:
+        """
+        Keep the title line and the body sentences with the most words in common with the query, in their original order
+        """
+        title, _, body = document.partition("\n")
+        sentences = [sentence for sentence in SENTENCE_SPLIT.split(body) if sentence.strip()]
+        if len(sentences) <= self.sentences:
+            return document
+        ranked = sorted(range(len(sentences)), key=lambda i: (-len(words(sentences[i]) & query), i))
+        keep = sorted(ranked[:self.sentences])
+        return title + "\n" + " ".join(sentences[i] for i in keep)
+
+    def compact(self, description: str, documents: List[str], prices: List[float]) -> Tuple[List[str], List[float]]:
+        """
+        Compact the neighbours of one product, which arrive closest first
+        :return: the documents and prices to put in the prompt
+        """
+        query = words(description)
+        kept = self.dedupe(documents)
+        kept = kept[:self.choose_k([prices[i] for i in kept])]
+        compacted, compacted_prices, used = [], [], 0
+        for i in kept:
+            text = self.trim(documents[i], query)
+            tokens = self.count_tokens(text)
+            if used + tokens > self.token_budget:
+                if compacted:
+                    break
+                text = self.tokenizer.decode(self.tokenizer.encode(text, add_special_tokens=False)[:self.token_budget])
+                tokens = self.token_budget
+            compacted.append(text)
+            compacted_prices.append(prices[i])
+            used += tokens
+        return compacted, compacted_prices
+
+
+def evaluate(size: int = 100, db: str = "products_vectorstore"):
+    """
+    Price the first size test items with the frontier agent, with and without compaction,
+    and compare accuracy with Tester alongside the prompt tokens each mode sends
+    """
+    import pickle
+    import chromadb
+    from dotenv import load_dotenv
+    from testing import Tester
+    from agents.frontier_agent_gemini import FrontierAgentGemini
+    load_dotenv(override=True)
+    with open('test.pkl', 'rb') as file:
+        test = pickle.load(file)[:size]
+    collection = chromadb.PersistentClient(path=db).get_or_create_collection('products')
+    agent = FrontierAgentGemini(collection)
+    compactor = ContextCompactor()
+    tokens = {"Full context": [], "Compacted": []}
+
+    def pricer(title, compact):
+        def price(item):
+            text = item.prompt.split("to the nearest dollar?\n\n")[1].split("\n\nPrice is $")[0]
+            agent.compactor = compactor if compact else None
+            result = agent.price(text)
+            tokens[title].append(agent.last_prompt_tokens)
+            return result
+        return price
+
+    Tester.compare({title: pricer(title, title == "Compacted") for title in tokens}, test, size=size)
+    for title, counts in tokens.items():
+        print(f"{title:<20} {sum(counts) / len(counts):,.0f} prompt tokens on average")
+
+
+if __name__ == "__main__":
+    evaluate(*map(int, sys.argv[1:2]))
@@ -1,3 +1,4 @@
+import os
 from pydantic import BaseModel
 from typing import List, Dict, Self, Optional
 from bs4 import BeautifulSoup
@@ -5,7 +6,10 @@ import re
 import feedparser
 from tqdm import tqdm
 import requests
+import httpx
+import asyncio
 import time
+import hashlib
 
 feeds = [
     "https://www.dealnews.com/c142/Electronics/?rss=1",
@@ -15,6 +19,11 @@ feeds = [
         "https://www.dealnews.com/c196/Home-Garden/?rss=1",
        ]
 
+# The most deal pages afetch downloads at once
+FETCH_CONCURRENCY = 5
+# The most characters of a page's details, and of its features, that a ScrapedDeal keeps
+MAX_DETAIL_CHARACTERS = int(os.getenv("SCANNER_MAX_DETAIL_CHARACTERS", "4000"))
+
 def extract(html_snippet: str) -> str:
     """
     Use Beautiful Soup to clean up this HTML snippet and extract useful text
@@ -31,6 +40,20 @@ def extract(html_snippet: str) -> str:
         result = html_snippet
     return result.replace('\n', ' ')
 
+def shorten(text: str, limit: int) -> str:
+    """
+    Cut text to at most limit characters, at the end of a sentence if there is one in the last third,
+    otherwise at a word boundary
+    """
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    sentence = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    if sentence >= limit * 2 // 3:
+        return cut[:sentence + 1]
+    return cut.rsplit(" ", 1)[0] + " ..."
+
 class ScrapedDeal:
     """
     A class to represent a Deal retrieved from an RSS feed
@@ -42,22 +65,25 @@ class ScrapedDeal:
     details: str
     features: str
 
-    def __init__(self, entry: Dict[str, str]):
+    def __init__(self, entry: Dict[str, str], page: Optional[bytes] = None):
         """
         Populate this instance based on the provided dict
+        :param page: the deal's web page, if already downloaded; otherwise it is fetched here
         """
         self.title = entry['title']
         self.summary = extract(entry['summary'])
         self.url = entry['links'][0]['href']
-        stuff = requests.get(self.url).content
+        stuff = page if page is not None else requests.get(self.url).content
         soup = BeautifulSoup(stuff, 'html.parser')
         content = soup.find('div', class_='content-section').get_text()
         content = content.replace('\nmore', '').replace('\n', ' ')
         if "Features" in content:
-            self.details, self.features = content.split("Features")
+            details, features = content.split("Features", 1)
         else:
-            self.details = content
-            self.features = ""
+            details, features = content, ""
+        # Only the start of a long page is kept, so a scan holds bounded text per deal
+        self.details = shorten(details, MAX_DETAIL_CHARACTERS)
+        self.features = shorten(features, MAX_DETAIL_CHARACTERS)
 
     def __repr__(self):
         """
@@ -65,11 +91,16 @@ class ScrapedDeal:
         """
         return f"<{self.title}>"
 
-    def describe(self):
+    def describe(self, max_characters: Optional[int] = None):
         """
         Return a longer string to describe this deal for use in calling a model
+        :param max_characters: if given, the details and features are shortened to share this many characters
         """
-        return f"Title: {self.title}\nDetails: {self.details.strip()}\nFeatures: {self.features.strip()}\nURL: {self.url}"
+        details, features = self.details.strip(), self.features.strip()
+        if max_characters is not None and len(details) + len(features) > max_characters:
+            features = shorten(features, max(max_characters - len(details), max_characters // 3))
+            details = shorten(details, max_characters - len(features))
+        return f"Title: {self.title}\nDetails: {details}\nFeatures: {features}\nURL: {self.url}"
 
     @classmethod
     def fetch(cls, show_progress : bool = False) -> List[Self]:
@@ -85,6 +116,28 @@ class ScrapedDeal:
                 time.sleep(0.5)
         return deals
 
+    @classmethod
+    async def afetch(cls) -> List[Self]:
+        """
+        Retrieve all deals from the selected RSS feeds, downloading the feeds and then
+        the deal pages concurrently, at most FETCH_CONCURRENCY pages at a time
+        Each page is parsed as soon as it arrives, so only the pages in flight are held in memory
+        """
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+        async with httpx.AsyncClient(follow_redirects=True, timeout=30) as client:
+
+            async def get(url: str) -> bytes:
+                async with semaphore:
+                    response = await client.get(url)
+                    return response.content
+
+            async def scrape(entry: Dict[str, str]) -> Self:
+                return cls(entry, await get(entry['links'][0]['href']))
+
+            feeds_content = await asyncio.gather(*(get(feed_url) for feed_url in feeds))
+            entries = [entry for content in feeds_content for entry in feedparser.parse(content).entries[:10]]
+            return await asyncio.gather(*(scrape(entry) for entry in entries))
+
 class Deal(BaseModel):
     """
     A class to Represent a Deal with a summary description
@@ -106,4 +159,14 @@ class Opportunity(BaseModel):
     """
     deal: Deal
     estimate: float
-    discount: float
\ No newline at end of file
+    discount: float
+    id: Optional[str] = None
+    created: Optional[float] = None
+
+    @staticmethod
+    def make_id(url: Optional[str], description: str) -> str:
+        """
+        A short, stable identifier for an opportunity, derived from its deal
+        """
+        key = url or description
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
\ No newline at end of file
@@ -1,8 +1,10 @@
 import os
+from typing import List
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from agents.deals import Opportunity
 from agents.agent import Agent
+from agents.notifications import NotificationDispatcher
 
 DO_EMAIL = True
 
@@ -11,17 +13,21 @@ class EmailingAgent(Agent):
     name = "Emailing Agent"
     color = Agent.WHITE
 
+    OUTBOX_FILENAME = "outbox_email.json"
+
     def __init__(self):
         self.log("Messaging Agent is initializing")
         if DO_EMAIL:
             self.sendgrid_api_key = os.getenv('SENDGRID_API_KEY', 'your-fallback-api-key')
+            self.sendgrid_host = os.getenv('SENDGRID_HOST')
             self.email_sender = os.getenv('EMAIL_SENDER', 'sender@example.com')
             self.email_receiver = os.getenv('EMAIL_RECEIVER', 'receiver@example.com')
+            self.dispatcher = NotificationDispatcher(self.send_digest, self.OUTBOX_FILENAME)
             self.log("Messaging Agent has initialized SendGrid")
 
     def send_email(self, subject, body):
         """
-        Send an email using SendGrid
+        Send an email using SendGrid, raising an exception if it fails so that it can be retried
         """
         self.log("Messaging Agent is sending an email via SendGrid")
         message = Mail(
@@ -31,21 +37,19 @@ class EmailingAgent(Agent):
             plain_text_content=body
         )
         try:
-            sg = SendGridAPIClient(self.sendgrid_api_key)
-            response = sg.send(message)
+            with self.span("alert", model="sendgrid"):
+                sg = SendGridAPIClient(self.sendgrid_api_key, host=self.sendgrid_host) if self.sendgrid_host else SendGridAPIClient(self.sendgrid_api_key)
+                response = sg.send(message)
             print(f"[DEBUG] Status code: {response.status_code}")
             print(f"[DEBUG] Body: {response.body}")
             self.log(f"Email sent. Status code: {response.status_code}")
         except Exception as e:
             print(f"[ERROR] SendGrid failed: {e}")
             self.log(f"Failed to send email via SendGrid: {e}")
+            raise
 
-    def alert(self, opportunity: Opportunity):
-        """
-        Make an alert about the specified Opportunity
-        """
-        subject = "Deal Alert!"
-        body = (
+    def body_for(self, opportunity: Opportunity) -> str:
+        return (
             f"Deal Alert! 🎯\n"
             f"Price: ${opportunity.deal.price:.2f}\n"
             f"Estimate: ${opportunity.estimate:.2f}\n"
@@ -53,6 +57,27 @@ class EmailingAgent(Agent):
             f"Description: {opportunity.deal.product_description[:60]}...\n"
             f"URL: {opportunity.deal.url}"
         )
+
+    def send_digest(self, opportunities: List[Opportunity]):
+        """
+        Send one email covering every opportunity in the digest
+        """
+        subject = "Deal Alert!" if len(opportunities) == 1 else f"{len(opportunities)} Deal Alerts!"
+        body = "\n\n".join(self.body_for(opportunity) for opportunity in opportunities)
+        self.send_email(subject, body)
+
+    def alert(self, opportunity: Opportunity, force: bool = False):
+        """
+        Make an alert about the specified Opportunity
+        The email is queued and sent in the background, batched with any other alerts
+        :param force: send it again even if it was already sent, as when the user picks it in the UI
+        """
         if DO_EMAIL:
-            self.send_email(subject, body)
-        self.log("Messaging Agent has completed")
+            self.dispatcher.enqueue(opportunity, force)
+        self.log("Messaging Agent has queued the alert")
+
+    async def aalert(self, opportunity: Opportunity):
+        """
+        The async variant of alert; queuing never blocks, as delivery already happens on the dispatcher's thread
+        """
+        self.alert(opportunity)
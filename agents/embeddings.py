@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import threading
+from typing import Dict, List
+import numpy as np
+
+# "torch" for the SentenceTransformer, or "onnx" for the int8-quantised ONNX export of the same model
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH", "minilm_onnx")
+MAX_LENGTH = 256
+
+
+class OnnxEncoder:
+    """
+    all-MiniLM-L6-v2 as an int8 dynamically-quantised ONNX model, run with onnxruntime
+    and the Rust tokenizers library, so neither torch nor sentence_transformers is imported
+    Texts are sorted by length and batched, and each batch is padded only to its own longest text;
+    the output matches SentenceTransformer.encode: mean pooling, then L2 normalisation
+    """
+
+    MODEL_FILENAME = "model_int8.onnx"
+
+    def __init__(self, path: str = ONNX_PATH, batch_size: int = 32, threads: int = 0):
+        """
+        :param path: the directory written by export
+        :param threads: onnxruntime intra-op threads, 0 for its default
+        """
+        import onnxruntime
+        from tokenizers import Tokenizer
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(path, self.MODEL_FILENAME), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.inputs = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_LENGTH)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        self.batch_size = batch_size
+
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        feed = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: value for name, value in feed.items() if name in self.inputs})[0]
+        mask = feed["attention_mask"][:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: array of shape (n, 384) of float32, in the order of texts
+        """
+        vectors = np.zeros((len(texts), 384), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            vectors[batch] = self.encode_batch([texts[i] for i in batch])
+        return vectors
+
+
+def export(path: str = ONNX_PATH, model_name: str = MODEL_NAME) -> str:
+    """
+    Export MiniLM to ONNX with dynamic batch and sequence axes, then quantise its weights to int8
+    Needs torch, transformers and onnxruntime; the encoder itself only needs onnxruntime and tokenizers
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    os.makedirs(path, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(path)
+    sample = tokenizer(["An example product description"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    full_precision = os.path.join(path, "model.onnx")
+    torch.onnx.export(model, tuple(sample[name] for name in names), full_precision, input_names=names,
+                      output_names=["last_hidden_state"], opset_version=14,
+                      dynamic_axes={name: {0: "batch", 1: "sequence"} for name in names + ["last_hidden_state"]})
+    quantize_dynamic(full_precision, os.path.join(path, OnnxEncoder.MODEL_FILENAME), weight_type=QuantType.QInt8)
+    os.remove(full_precision)
+    return path
+
+
+_encoders: Dict[str, object] = {}
+_lock = threading.Lock()
+
+
+def get_encoder(backend: str = None):
+    """
+    The process-wide sentence encoder for the configured backend, loaded once and shared by every agent
+    Both backends offer encode(texts) returning an (n, 384) float32 array
+    """
+    backend = backend or EMBEDDING_BACKEND
+    with _lock:
+        if backend not in _encoders:
+            if backend == "onnx":
+                _encoders[backend] = OnnxEncoder()
+            elif backend == "torch":
+                from sentence_transformers import SentenceTransformer
+                _encoders[backend] = SentenceTransformer(MODEL_NAME, device="cpu")
+            else:
+                raise ValueError(f"Unknown EMBEDDING_BACKEND {backend}, expected torch or onnx")
+        return _encoders[backend]
+
+
+def verify(texts: List[str], tolerance: float = 0.98) -> Dict[str, float]:
+    """
+    Check that the ONNX encoder agrees with the torch model: every cosine similarity must reach tolerance
+    """
+    expected = np.asarray(get_encoder("torch").encode(texts), dtype=np.float32)
+    actual = get_encoder("onnx").encode(texts)
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    similarities = (expected * actual).sum(axis=1)
+    result = {"min": float(similarities.min()), "mean": float(similarities.mean())}
+    if result["min"] < tolerance:
+        raise ValueError(f"ONNX embeddings disagree with the torch model: {result}")
+    return result
+
+
+def benchmark(texts: List[str], backends: List[str] = ("torch", "onnx"), batch_size: int = 32) -> Dict[str, float]:
+    """
+    Sentences per second for each backend, after one warm-up batch
+    """
+    results = {}
+    for backend in backends:
+        encoder = get_encoder(backend)
+        encoder.encode(texts[:batch_size])
+        start = time.perf_counter()
+        for offset in range(0, len(texts), batch_size):
+            encoder.encode(texts[offset:offset + batch_size])
+        results[backend] = len(texts) / (time.perf_counter() - start)
+    return results
+
+
+def item_texts(size: int) -> List[str]:
+    """
+    The descriptions of the first size test Items, as they were written to the vector store
+    """
+    import pickle
+    with open("test.pkl", "rb") as file:
+        items = pickle.load(file)[:size]
+    return [item.prompt.split("to the nearest dollar?\n\n")[1].split("\n\nPrice is $")[0] for item in items]
+
+
+if __name__ == "__main__":
+    task = sys.argv[1] if len(sys.argv) > 1 else "all"
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    if task in ("export", "all"):
+        print(f"Exported to {export()}")
+    if task in ("verify", "all"):
+        print(f"Cosine similarity to the torch model: {verify(item_texts(size))}")
+    if task in ("benchmark", "all"):
+        for backend, rate in benchmark(item_texts(size)).items():
+            print(f"{backend:<6} {rate:,.0f} sentences/second")
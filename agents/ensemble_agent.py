@@ -1,48 +1,292 @@
-import pandas as pd
+import asyncio
+import numpy as np
+from typing import Dict, List, Tuple
 from sklearn.linear_model import LinearRegression
 import joblib
+import os
 
 from agents.agent import Agent
 from agents.specialist_agent import SpecialistAgent
 from agents.frontier_agent_gemini import FrontierAgentGemini
 from agents.random_forest_agent import RandomForestAgent
+from agents.knn_price_agent import KnnPriceAgent
+from agents.pricing_context import PricingContext
+from agents.model_store import ModelStore
+from agents.vector_index import collection_version
+from agents.cascade import CascadeThresholds, local_estimate, local_is_confident, specialist_is_confident
 
 class EnsembleAgent(Agent):
 
     name = "Ensemble Agent"
     color = Agent.YELLOW
-    
-    def __init__(self, collection):
+
+    MODEL_FILENAME = 'ensemble_model.pkl'
+    STORE_NAME = 'ensemble'
+    # The stacker may be fit with or without the kNN estimate; older models keep working until refit
+    FEATURE_SETS = [
+        ['Specialist', 'Frontier', 'RandomForest', 'Knn', 'Min', 'Max'],
+        ['Specialist', 'Frontier', 'RandomForest', 'Min', 'Max'],
+    ]
+    # Cascade mode answers from the local models when they are confident, escalating only when needed
+    CASCADE = os.getenv("ENSEMBLE_CASCADE", "0") == "1"
+
+    def __init__(self, collection, store: ModelStore = None, cascade: bool = None):
         """
         Create an instance of Ensemble, by creating each of the models
         And loading the weights of the Ensemble
+        A version published to the model store (python training.py ensemble) wins over ensemble_model.pkl
         """
         self.log("Initializing Ensemble Agent")
-        self.specialist = SpecialistAgent()
+        self.store = store or ModelStore()
+        self.cascade = self.CASCADE if cascade is None else cascade
+        self.thresholds = CascadeThresholds.load()
+        self.last_tier = "frontier"
         self.frontier = FrontierAgentGemini(collection)
-        self.random_forest = RandomForestAgent()
-        self.model = joblib.load('ensemble_model.pkl')
+        # The sub-agents share one encoder, and each deal is encoded once into a PricingContext
+        self.specialist = SpecialistAgent(store=self.store, vectorizer=self.frontier.model)
+        self.random_forest = RandomForestAgent(store=self.store, vectorizer=self.frontier.model)
+        self.knn = KnnPriceAgent(collection, vectorizer=self.frontier.model)
+        self.version = None
+        self.last_components = {}
+        current = self.store.current(self.STORE_NAME)
+        if current:
+            self.load_version(*current)
+        else:
+            self.set_model(joblib.load(self.MODEL_FILENAME))
         self.log("Ensemble Agent is ready")
 
-    def price(self, description: str) -> float:
+    def set_model(self, model: LinearRegression):
+        """
+        Check once that the pickled model was fit on one of our feature sets, in our order,
+        then keep just its inputs and coefficients so that pricing is a plain dot product
+        """
+        coef = np.asarray(model.coef_, dtype=np.float64).ravel()
+        names = getattr(model, 'feature_names_in_', None)
+        if names is not None:
+            features = list(names)
+            if features not in self.FEATURE_SETS:
+                raise ValueError(f"Ensemble model was fit on columns {features}, expected one of {self.FEATURE_SETS}")
+        else:
+            matching = [features for features in self.FEATURE_SETS if len(features) == coef.shape[0]]
+            if not matching:
+                raise ValueError(f"Ensemble model has {coef.shape[0]} coefficients, which matches no feature set")
+            features = matching[0]
+        if coef.shape[0] != len(features):
+            raise ValueError(f"Ensemble model has {coef.shape[0]} coefficients, expected {len(features)}")
+        self.weights = (features[:-2], coef, float(np.ravel(model.intercept_)[0]))
+        self.model = model
+
+    @property
+    def inputs(self) -> List[str]:
+        """
+        The sub-model estimates the current stacker takes, before its Min and Max columns
+        """
+        return self.weights[0]
+
+    def load_version(self, version: int, path: str):
+        """
+        Load a published stacker version, then swap it in with a single assignment
+        """
+        self.set_model(joblib.load(os.path.join(path, "model.pkl")))
+        self.version = version
+        self.log(f"Ensemble Agent is using model version {version}")
+
+    def refresh(self):
+        """
+        Pick up a newly published stacker without a restart
+        """
+        update = self.store.changed(self.STORE_NAME, self.version)
+        if update:
+            self.load_version(*update)
+
+    def versions(self) -> Dict[str, object]:
+        """
+        The versions of the stacker and of each sub-model, after picking up any newly published ones,
+        so that an estimate made by older models can be told apart from one the current models would make
+        "specialist" is the backend that would answer now; see versions_for for the one that did
+        """
+        self.refresh()
+        self.random_forest.refresh()
+        return {
+            "ensemble": self.version,
+            "random_forest": self.random_forest.version,
+            **self.specialist.versions(),
+            "frontier": self.frontier.MODEL,
+            "knn": collection_version(self.knn.collection),
+            "cascade": self.cascade,
+        }
+
+    @staticmethod
+    def versions_for(versions: Dict[str, object], components: Dict[str, object]) -> Dict[str, object]:
+        """
+        The versions behind one estimate: versions, with the specialist backend that actually served it,
+        so that an estimate the local head made while Modal was down isn't reused once Modal is back
+        """
+        return {**versions, "specialist": components.get("SpecialistSource", versions["specialist"])}
+
+    def contexts_for(self, descriptions: List[str]) -> List[PricingContext]:
+        """
+        Encode several descriptions and retrieve their neighbours in one go, to pass to price or price_batch
+        """
+        return self.frontier.contexts_for(descriptions)
+
+    def price(self, description: str, context: PricingContext = None) -> float:
         """
         Run this ensemble model
         Ask each of the models to price the product
         Then use the Linear Regression model to return the weighted price
         :param description: the description of a product
+        :param context: its pricing context, if already built; otherwise it is built here, once, for all the models
         :return: an estimate of its price
         """
-        self.log("Running Ensemble Agent - collaborating with specialist, frontier and random forest agents")
-        specialist = self.specialist.price(description)
-        frontier = self.frontier.price(description)
-        random_forest = self.random_forest.price(description)
-        X = pd.DataFrame({
-            'Specialist': [specialist],
-            'Frontier': [frontier],
-            'RandomForest': [random_forest],
-            'Min': [min(specialist, frontier, random_forest)],
-            'Max': [max(specialist, frontier, random_forest)],
-        })
-        y = max(0, self.model.predict(X)[0])
+        if self.cascade:
+            return self.price_cascade(description, context)[0]
+        self.log("Running Ensemble Agent - collaborating with specialist, frontier, random forest and kNN agents")
+        self.refresh()
+        self.last_tier = "frontier"
+        context = context or self.frontier.context_for(description)
+        specialist, source = self.specialist.estimate(description, context)
+        components = {
+            'Specialist': specialist,
+            'SpecialistSource': source,
+            'Frontier': self.frontier.price(description, context=context),
+            'RandomForest': self.random_forest.price(description, context=context),
+            'Knn': self.knn.price(description, context=context),
+        }
+        y = float(self.combine(components)[0])
+        self.last_components = components
         self.log(f"Ensemble Agent complete - returning ${y:.2f}")
-        return y
\ No newline at end of file
+        return y
+
+    def price_cascade(self, description: str, context: PricingContext = None) -> Tuple[float, str]:
+        """
+        Price a product with a confidence-gated cascade:
+        1. The random forest and the kNN agent; answer if they agree and the item has close neighbours
+        2. Otherwise the fine-tuned specialist; answer if it agrees with the local estimate
+        3. Otherwise the frontier model too, combined by the linear stacker
+        :return: the estimate, and the tier that answered ("local", "specialist" or "frontier")
+        """
+        self.log("Running Ensemble Agent in cascade mode")
+        self.refresh()
+        with self.span("cascade"):
+            context = context or self.frontier.context_for(description)
+            random_forest = self.random_forest.price(description, context=context)
+            knn = self.knn.price(description, context=context)
+            local = local_estimate(random_forest, knn)
+            components = {'RandomForest': random_forest, 'Knn': knn}
+            if local_is_confident(random_forest, knn, float(np.mean(context.distances)), self.thresholds):
+                result, tier = local, "local"
+            else:
+                components['Specialist'], components['SpecialistSource'] = self.specialist.estimate(description, context)
+                if specialist_is_confident(components['Specialist'], local, self.thresholds):
+                    result, tier = components['Specialist'], "specialist"
+                else:
+                    components['Frontier'] = self.frontier.price(description, context=context)
+                    result, tier = float(self.combine(components)[0]), "frontier"
+        self.last_components = components
+        self.last_tier = tier
+        self.log(f"Ensemble Agent cascade answered at the {tier} tier - returning ${result:.2f}")
+        return max(0.0, result), tier
+
+    async def aprice_components(self, description: str, context: PricingContext = None) -> Tuple[float, Dict[str, float]]:
+        """
+        The async variant of price: the sub-agents are awaited concurrently on the event loop
+        :return: the estimate, and the estimate of each sub-model, since last_components is shared by concurrent calls;
+        SpecialistSource records whether Modal or the local head gave the Specialist estimate
+        """
+        if self.cascade:
+            result, _, components = await self.acascade(description, context)
+            return result, components
+        self.log("Running Ensemble Agent - collaborating with specialist, frontier, random forest and kNN agents")
+        self.refresh()
+        context = context or await asyncio.to_thread(self.frontier.context_for, description)
+        (specialist, source), frontier, random_forest, knn = await asyncio.gather(
+            self.specialist.aestimate(description, context),
+            self.frontier.aprice(description, context),
+            self.random_forest.aprice(description, context),
+            self.knn.aprice(description, context),
+        )
+        components = {'Specialist': specialist, 'SpecialistSource': source, 'Frontier': frontier,
+                      'RandomForest': random_forest, 'Knn': knn}
+        y = float(self.combine(components)[0])
+        self.last_components = components
+        self.last_tier = "frontier"
+        self.log(f"Ensemble Agent complete - returning ${y:.2f}")
+        return y, components
+
+    async def aprice(self, description: str, context: PricingContext = None) -> float:
+        return (await self.aprice_components(description, context))[0]
+
+    async def acascade(self, description: str, context: PricingContext = None) -> Tuple[float, str, Dict[str, float]]:
+        """
+        The async variant of price_cascade
+        :return: the estimate, the tier that answered, and the sub-model estimates used
+        """
+        self.log("Running Ensemble Agent in cascade mode")
+        self.refresh()
+        with self.span("cascade"):
+            context = context or await asyncio.to_thread(self.frontier.context_for, description)
+            random_forest, knn = await asyncio.gather(self.random_forest.aprice(description, context),
+                                                      self.knn.aprice(description, context))
+            local = local_estimate(random_forest, knn)
+            components = {'RandomForest': random_forest, 'Knn': knn}
+            if local_is_confident(random_forest, knn, float(np.mean(context.distances)), self.thresholds):
+                result, tier = local, "local"
+            else:
+                components['Specialist'], components['SpecialistSource'] = await self.specialist.aestimate(description, context)
+                if specialist_is_confident(components['Specialist'], local, self.thresholds):
+                    result, tier = components['Specialist'], "specialist"
+                else:
+                    components['Frontier'] = await self.frontier.aprice(description, context)
+                    result, tier = float(self.combine(components)[0]), "frontier"
+        self.last_components = components
+        self.last_tier = tier
+        self.log(f"Ensemble Agent cascade answered at the {tier} tier - returning ${result:.2f}")
+        return max(0.0, result), tier, components
+
+    def combine(self, components: Dict[str, List[float]]) -> np.ndarray:
+        """
+        Combine sub-model estimates with the linear stacker
+        :param components: estimates keyed by name ('Specialist', 'Frontier', 'RandomForest', 'Knn'),
+        each a number or a list with one entry per product; any the stacker wasn't fit on are ignored
+        :return: array of shape (n,) of non-negative prices
+        """
+        with self.span("combine", model="linear_regression"):
+            inputs, coef, intercept = self.weights
+            estimates = np.column_stack([np.atleast_1d(np.asarray(components[name], dtype=np.float64)) for name in inputs])
+            X = np.column_stack([estimates, estimates.min(axis=1), estimates.max(axis=1)])
+            return np.maximum(0, X @ coef + intercept)
+
+    def prefilter(self, descriptions: List[str], contexts: List[PricingContext] = None) -> np.ndarray:
+        """
+        A cheap, local estimate for many products: the average of the random forest price
+        and the median price of the RAG neighbours. No LLM is called
+        :param descriptions: the descriptions of the products
+        :param contexts: their pricing contexts, if already built
+        :return: array of estimated prices
+        """
+        self.log(f"Ensemble Agent is pre-pricing {len(descriptions)} products locally")
+        contexts = contexts or self.contexts_for(descriptions)
+        random_forests = np.array(self.random_forest.price_batch(descriptions, contexts))
+        medians = np.array([np.median(context.prices) if context.prices else np.nan for context in contexts])
+        return np.where(np.isnan(medians), random_forests, (random_forests + medians) / 2)
+
+    def price_batch(self, descriptions: List[str], contexts: List[PricingContext] = None) -> List[float]:
+        """
+        Price several products, combining all of their sub-model estimates in one operation
+        :param descriptions: the descriptions of the products
+        :param contexts: their pricing contexts, if already built
+        :return: an estimate of each price
+        """
+        self.log(f"Running Ensemble Agent on a batch of {len(descriptions)} products")
+        self.refresh()
+        contexts = contexts or self.contexts_for(descriptions)
+        components = {
+            'Specialist': [self.specialist.price(description, context=context) for description, context in zip(descriptions, contexts)],
+            'Frontier': self.frontier.price_batch(descriptions, contexts),
+            'RandomForest': self.random_forest.price_batch(descriptions, contexts),
+            'Knn': self.knn.price_batch(descriptions, contexts),
+        }
+        results = self.combine(components).tolist()
+        self.log("Ensemble Agent completed the batch")
+        return results
@@ -2,16 +2,18 @@
 
 import os
 import re
+import asyncio
 import math
 import json
 from typing import List, Dict
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from sentence_transformers import SentenceTransformer
 from datasets import load_dataset
 import chromadb
 from items import Item
 from testing import Tester
 from agents.agent import Agent
+from agents.embeddings import get_encoder
 
 
 class FrontierAgent(Agent):
@@ -30,14 +32,16 @@ class FrontierAgent(Agent):
         deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
         if deepseek_api_key:
             self.client = OpenAI(api_key=deepseek_api_key, base_url="https://api.deepseek.com")
+            self.async_client = AsyncOpenAI(api_key=deepseek_api_key, base_url="https://api.deepseek.com")
             self.MODEL = "deepseek-chat"
             self.log("Frontier Agent is set up with DeepSeek")
         else:
             self.client = OpenAI()
+            self.async_client = AsyncOpenAI()
             self.MODEL = "gpt-4o-mini"
             self.log("Frontier Agent is setting up with OpenAI")
         self.collection = collection
-        self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        self.model = get_encoder()
         self.log("Frontier Agent is ready")
 
     def make_context(self, similars: List[str], prices: List[float]) -> str:
@@ -76,8 +80,9 @@ class FrontierAgent(Agent):
         Return a list of items similar to the given one by looking in the Chroma datastore
         """
         self.log("Frontier Agent is performing a RAG search of the Chroma datastore to find 5 similar products")
-        vector = self.model.encode([description])
-        results = self.collection.query(query_embeddings=vector.astype(float).tolist(), n_results=5)
+        with self.span("find_similars", model="all-MiniLM-L6-v2"):
+            vector = self.model.encode([description])
+            results = self.collection.query(query_embeddings=vector.astype(float).tolist(), n_results=5)
         documents = results['documents'][0][:]
         prices = [m['price'] for m in results['metadatas'][0][:]]
         self.log("Frontier Agent has found similar products")
@@ -91,6 +96,17 @@ class FrontierAgent(Agent):
         match = re.search(r"[-+]?\d*\.\d+|\d+", s)
         return float(match.group()) if match else 0.0
 
+    def complete(self, messages: List[Dict[str, str]]) -> str:
+        """
+        One chat completion from OpenAI or DeepSeek: the reply to messages
+        """
+        response = self.client.chat.completions.create(model=self.MODEL, messages=messages, seed=42, max_tokens=5)
+        return response.choices[0].message.content
+
+    async def acomplete(self, messages: List[Dict[str, str]]) -> str:
+        response = await self.async_client.chat.completions.create(model=self.MODEL, messages=messages, seed=42, max_tokens=5)
+        return response.choices[0].message.content
+
     def price(self, description: str) -> float:
         """
         Make a call to OpenAI or DeepSeek to estimate the price of the described product,
@@ -100,15 +116,21 @@ class FrontierAgent(Agent):
         """
         documents, prices = self.find_similars(description)
         self.log(f"Frontier Agent is about to call {self.MODEL} with context including 5 similar products")
-        response = self.client.chat.completions.create(
-            model=self.MODEL, 
-            messages=self.messages_for(description, documents, prices),
-            seed=42,
-            max_tokens=5
-        )
-        reply = response.choices[0].message.content
+        with self.span("price", model=self.MODEL):
+            reply = self.complete(self.messages_for(description, documents, prices))
+        result = self.get_price(reply)
+        self.log(f"Frontier Agent completed - predicting ${result:.2f}")
+        return result
+
+    async def aprice(self, description: str) -> float:
+        """
+        The async variant of price, using the async OpenAI client
+        The RAG search runs in a worker thread since encoding is CPU-bound
+        """
+        documents, prices = await asyncio.to_thread(self.find_similars, description)
+        self.log(f"Frontier Agent is about to call {self.MODEL} with context including 5 similar products")
+        with self.span("price", model=self.MODEL):
+            reply = await self.acomplete(self.messages_for(description, documents, prices))
         result = self.get_price(reply)
         self.log(f"Frontier Agent completed - predicting ${result:.2f}")
         return result
-    
-        
\ No newline at end of file
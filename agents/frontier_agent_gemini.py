@@ -1,9 +1,11 @@
 # imports
 import os
 import re
+import time
+import asyncio
 import math
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import google.generativeai as genai
 from sentence_transformers import SentenceTransformer
 from datasets import load_dataset
@@ -11,6 +13,11 @@ import chromadb
 from items import Item
 from testing import Tester
 from agents.agent import Agent
+from agents.pricing_context import PricingContext
+from agents.context_compactor import ContextCompactor
+from agents.workers import get_pool
+from agents.embeddings import get_encoder
+from agents.hedging import hedger
 import torch
 
 class FrontierAgentGemini(Agent):
@@ -19,14 +26,34 @@ class FrontierAgentGemini(Agent):
     color = Agent.BLUE
 
     MODEL = "gemini-2.5-flash"
+    # Set FRONTIER_COMPACT_CONTEXT=1 to trim and dedupe the RAG neighbours before they go in the prompt
+    COMPACT_CONTEXT = os.getenv("FRONTIER_COMPACT_CONTEXT", "0") == "1"
+    # price_batch packs items into one request until either limit is reached
+    BATCH_SIZE = int(os.getenv("FRONTIER_BATCH_SIZE", "16"))
+    BATCH_TOKEN_BUDGET = int(os.getenv("FRONTIER_BATCH_TOKENS", "12000"))
+    # A batched request that fails (a 429, a timeout) is retried whole, after 2, 4, 8... seconds
+    BATCH_RETRIES = 4
+    BATCH_BACKOFF = 2.0
+    # Set FRONTIER_HEDGE=duplicate to re-send slow Gemini requests, or alternative to ask OpenAI/DeepSeek as well
+    HEDGE = os.getenv("FRONTIER_HEDGE", "")
+    # Each Gemini request gives up after this many seconds, so a hedged request that loses can't hold a thread for long
+    REQUEST_TIMEOUT = float(os.getenv("FRONTIER_REQUEST_TIMEOUT", "30"))
+    BATCH_SYSTEM_MESSAGE = ("You estimate prices of items. You will be given several numbered items to price, "
+                            "each with some similar products and their prices for context. "
+                            "Reply only with a JSON array of numbers: the price of each item in dollars, in the same order, with no explanation")
 
-    def __init__(self, collection):
+    def __init__(self, collection, compactor: ContextCompactor = None):
         import google.generativeai as genai  
         genai.configure(api_key=os.getenv("GEMINI_API_KEY2"))
         self.genai = genai
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = SentenceTransformer("all-MiniLM-L6-v2", "cpu")
+        self.model = get_encoder()
         self.collection = collection
+        self.compactor = compactor or (ContextCompactor() if self.COMPACT_CONTEXT else None)
+        self.pool = get_pool()
+        self.last_prompt_tokens = 0
+        self.hedge = self.HEDGE
+        self.alternative = None
         self.log("Frontier Agent is ready")
 
     def make_context(self, similars: List[str], prices: List[float]) -> str:
@@ -48,41 +75,264 @@ class FrontierAgentGemini(Agent):
     
     def find_similars(self, description: str):
  
+        return self.context_for(description).similars
+
+    def find_neighbours(self, description: str):
+        """
+        Like find_similars, but also return the distance to each neighbour
+        """
+        context = self.context_for(description)
+        return context.documents, context.prices, context.distances
+
+    def context_for(self, description: str) -> PricingContext:
+        """
+        Encode the description and find its 5 most similar products, once, for every agent that needs them
+        """
         self.log("Frontier Agent is performing a RAG search of the Chroma datastore to find 5 similar products")
-        vector = self.model.encode([description])
-        results = self.collection.query(query_embeddings=vector.astype(float).tolist(), n_results=5)
-        documents = results['documents'][0][:]
-        prices = [m['price'] for m in results['metadatas'][0][:]]
+        with self.span("find_similars", model="all-MiniLM-L6-v2"):
+            context = PricingContext.build(description, self.model, self.collection)
         self.log("Frontier Agent has found similar products")
-        return documents, prices
-    
+        return context
+
+    def contexts_for(self, descriptions: List[str]) -> List[PricingContext]:
+        """
+        Build the pricing contexts for several descriptions with one encode and one query
+        """
+        self.log(f"Frontier Agent is performing a RAG search for {len(descriptions)} products")
+        with self.span("find_similars_batch", model="all-MiniLM-L6-v2"):
+            return PricingContext.build_batch(descriptions, self.pool or self.model, self.collection)
+
+    def find_similars_batch(self, descriptions: List[str]):
+        """
+        Look up the 5 most similar products for several descriptions with one encode and one query
+        :return: a list of documents and a list of prices for each description
+        """
+        contexts = self.contexts_for(descriptions)
+        return [context.documents for context in contexts], [context.prices for context in contexts]
+
     def get_price(self, s) -> float:
 
         s = s.replace('$','').replace(',','')
         match = re.search(r"[-+]?\d*\.\d+|\d+", s)
         return float(match.group()) if match else 0.0
     
-    def price(self, description: str) -> float:
-        documents, prices = self.find_similars(description)
+    def prompt_for(self, description: str, context: PricingContext) -> str:
+        """
+        The Gemini prompt for one product, with its (optionally compacted) RAG context
+        Also records its size in last_prompt_tokens
+        """
+        documents, prices = context.similars
+        if self.compactor:
+            documents, prices = self.compactor.compact(description, documents, prices)
+        # Convert OpenAI-style messages to a single prompt
+        prompt = "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in self.messages_for(description, documents, prices)]) # make the prompt the gemini way (different from openai)
+        self.last_prompt_tokens = len(Item.tokenizer.encode(prompt, add_special_tokens=False))
+        self.log(f"Frontier Agent is about to call {self.MODEL} with context including {len(documents)} similar products")
+        return prompt
+
+    def generate(self, prompt: str) -> str:
+        """
+        One Gemini request: the reply to prompt
+        """
+        model = self.genai.GenerativeModel(self.MODEL)
+        return model.generate_content(prompt, request_options={"timeout": self.REQUEST_TIMEOUT}).text
+
+    async def agenerate(self, prompt: str) -> str:
+        model = self.genai.GenerativeModel(self.MODEL)
+        return (await model.generate_content_async(prompt, request_options={"timeout": self.REQUEST_TIMEOUT})).text
+
+    def attempts(self, prompt: str, description: str, context: PricingContext, asynchronous: bool = False) -> List[Tuple[str, object]]:
+        """
+        The requests to hedge between: Gemini, then either Gemini again or the OpenAI/DeepSeek frontier agent
+        with the same RAG context
+        """
+        generate = self.agenerate if asynchronous else self.generate
+        attempts = [(self.MODEL, lambda: generate(prompt))]
+        if self.hedge == "duplicate":
+            attempts.append((self.MODEL, lambda: generate(prompt)))
+        elif self.hedge == "alternative":
+            if self.alternative is None:
+                from agents.frontier_agent import FrontierAgent
+                self.alternative = FrontierAgent(self.collection)
+            messages = self.alternative.messages_for(description, *context.similars)
+            complete = self.alternative.acomplete if asynchronous else self.alternative.complete
+            attempts.append((self.alternative.MODEL, lambda: complete(messages)))
+        return attempts
+
+    def request(self, prompt: str, description: str, context: PricingContext) -> str:
+        """
+        Ask for the price, hedged if FRONTIER_HEDGE is set
+        """
+        if not self.hedge:
+            return self.generate(prompt)
+        reply, backend = hedger.run(self.attempts(prompt, description, context))
+        if backend != self.MODEL:
+            self.log(f"Frontier Agent's hedged request to {backend} answered first")
+        return reply
+
+    async def arequest(self, prompt: str, description: str, context: PricingContext) -> str:
+        if not self.hedge:
+            return await self.agenerate(prompt)
+        reply, backend = await hedger.arun(self.attempts(prompt, description, context, asynchronous=True))
+        if backend != self.MODEL:
+            self.log(f"Frontier Agent's hedged request to {backend} answered first")
+        return reply
+
+    def price(self, description: str, context: PricingContext = None) -> float:
+        """
+        :param context: the neighbours already retrieved for this description, to skip the RAG search
+        """
+        context = context or self.context_for(description)
+        prompt = self.prompt_for(description, context)
         retries = 8
         done = False
         reply = None
-        self.log(f"Frontier Agent is about to call {self.MODEL} with context including 5 similar products")
-        while not done and retries > 0:
-            try:
-                model = self.genai.GenerativeModel(self.MODEL)
-                # Convert OpenAI-style messages to a single prompt
-                prompt = "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in self.messages_for(description, documents, prices)]) # make the prompt the gemini way (different from openai)
-                response = model.generate_content(prompt)
-                reply = response.text
-                done = True
-            except Exception as e:
-                print(f"Error: {e}")
-                retries -= 1
+        with self.span("price", model=self.MODEL) as span:
+            span.tokens = self.last_prompt_tokens
+            while not done and retries > 0:
+                try:
+                    reply = self.request(prompt, description, context)
+                    done = True
+                except Exception as e:
+                    print(f"Error: {e}")
+                    retries -= 1
+            if reply is None:
+                span.outcome = "error"
+
+        if reply is None:
+            return "ERROR: Gemini failed after retries"
+        result = self.get_price(reply)
+        self.log(f"Frontier Agent completed - predicting ${result:.2f}")
+        return result
 
+    async def aprice(self, description: str, context: PricingContext = None) -> float:
+        """
+        The async variant of price, using Gemini's async client
+        The RAG search, if needed, runs in a worker thread since encoding is CPU-bound
+        """
+        context = context or await asyncio.to_thread(self.context_for, description)
+        prompt = self.prompt_for(description, context)
+        retries = 8
+        reply = None
+        with self.span("price", model=self.MODEL) as span:
+            span.tokens = self.last_prompt_tokens
+            while reply is None and retries > 0:
+                try:
+                    reply = await self.arequest(prompt, description, context)
+                except Exception as e:
+                    print(f"Error: {e}")
+                    retries -= 1
+            if reply is None:
+                span.outcome = "error"
         if reply is None:
             return "ERROR: Gemini failed after retries"
         result = self.get_price(reply)
         self.log(f"Frontier Agent completed - predicting ${result:.2f}")
         return result
-    
\ No newline at end of file
+
+    def batch_section(self, number: int, description: str, documents: List[str], prices: List[float]) -> str:
+        """
+        The part of a batched prompt for one item: its own RAG context, then the item itself
+        """
+        section = f"Item {number}\n\n" + self.make_context(documents, prices)
+        return section + f"Item {number} to price:\n{description}\n\n"
+
+    def plan_batches(self, sections: List[str]) -> List[List[int]]:
+        """
+        Group consecutive items into requests of at most BATCH_SIZE items and BATCH_TOKEN_BUDGET prompt tokens
+        :return: the item indices of each request
+        """
+        batches, batch, used = [], [], 0
+        for i, section in enumerate(sections):
+            tokens = len(Item.tokenizer.encode(section, add_special_tokens=False))
+            if batch and (len(batch) >= self.BATCH_SIZE or used + tokens > self.BATCH_TOKEN_BUDGET):
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(i)
+            used += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def parse_prices(self, reply: str, count: int) -> Optional[List[float]]:
+        """
+        Read a JSON array of count prices from the reply
+        :return: the prices, or None if the reply isn't such an array
+        """
+        text = re.sub(r"```(json)?", "", reply or "").strip()
+        start, end = text.find("["), text.rfind("]") + 1
+        try:
+            values = json.loads(text[start:end]) if start != -1 and end > start else None
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(values, list) or len(values) != count:
+            return None
+        try:
+            return [float(value) if isinstance(value, (int, float)) else self.get_price(str(value)) for value in values]
+        except (TypeError, ValueError):
+            return None
+
+    def generate_batch(self, prompt: str) -> str:
+        """
+        One structured-output request, retried with exponential backoff if the API fails
+        Raises the last error once BATCH_RETRIES retries have failed
+        """
+        for attempt in range(self.BATCH_RETRIES + 1):
+            try:
+                model = self.genai.GenerativeModel(self.MODEL)
+                return model.generate_content(prompt, generation_config={"response_mime_type": "application/json"}).text
+            except Exception as e:
+                if attempt == self.BATCH_RETRIES:
+                    raise
+                delay = self.BATCH_BACKOFF * 2 ** attempt
+                self.log(f"Frontier Agent batch request failed ({e}) - retrying in {delay:g}s")
+                time.sleep(delay)
+
+    def price_group(self, items: List[Tuple[str, List[str], List[float]]], contexts: List[PricingContext]) -> List[float]:
+        """
+        Price a group of items with one structured-output request
+        If a reply arrives but can't be parsed, split the group in two and try each half; a single item falls back to price
+        API errors are not a reason to split: the same request is retried with backoff, then the error is raised
+        :param items: the description, neighbour documents and neighbour prices of each item
+        """
+        if len(items) == 1:
+            return [self.price(items[0][0], contexts[0])]
+        prompt = f"System: {self.BATCH_SYSTEM_MESSAGE}\n"
+        prompt += "User: " + "".join(self.batch_section(number, *item) for number, item in enumerate(items, start=1))
+        prompt += f"Reply with a JSON array of exactly {len(items)} prices."
+        with self.span("price_batch", model=self.MODEL) as span:
+            span.tokens = len(Item.tokenizer.encode(prompt, add_special_tokens=False))
+            reply = self.generate_batch(prompt)
+            results = self.parse_prices(reply, len(items))
+            if results is None:
+                span.outcome = "split"
+        if results is not None:
+            return results
+        self.log(f"Frontier Agent could not read {len(items)} prices from one reply - splitting the batch")
+        half = len(items) // 2
+        return self.price_group(items[:half], contexts[:half]) + self.price_group(items[half:], contexts[half:])
+
+    def price_batch(self, descriptions: List[str], contexts: List[PricingContext] = None) -> List[float]:
+        """
+        Price several products with as few requests as possible: each request packs several items,
+        each with its own RAG context, and asks for a JSON array of prices back
+        :param descriptions: the descriptions of the products
+        :param contexts: their pricing contexts, if already built
+        :return: an estimate of each price
+        """
+        contexts = contexts or self.contexts_for(descriptions)
+        items = []
+        for description, context in zip(descriptions, contexts):
+            documents, prices = context.similars
+            if self.compactor:
+                documents, prices = self.compactor.compact(description, documents, prices)
+            items.append((description, documents, prices))
+        batches = self.plan_batches([self.batch_section(1, *item) for item in items])
+        self.log(f"Frontier Agent is pricing {len(descriptions)} products in {len(batches)} calls to {self.MODEL}")
+        results = [0.0] * len(descriptions)
+        for batch in batches:
+            prices = self.price_group([items[i] for i in batch], [contexts[i] for i in batch])
+            for i, price in zip(batch, prices):
+                results[i] = price
+        self.log("Frontier Agent completed the batch")
+        return results
@@ -0,0 +1,278 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+# A request is hedged once it has taken longer than this percentile of its backend's recent latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# At most this fraction of all requests may be hedged, across every agent
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+# The hedge delay used until a backend has MIN_SAMPLES latencies on record
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "5"))
+
+
+class LatencyHistogram:
+    """
+    The recent latencies of one backend, in a sliding window, for percentile estimates
+    """
+
+    def __init__(self, window: int = 500):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self.lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class HedgeBudget:
+    """
+    Allows a hedge only while hedges stay under fraction of all requests, plus a small burst,
+    so that a slow backend can't double the load on every backend at once
+    """
+
+    def __init__(self, fraction: float = HEDGE_BUDGET, burst: int = 5):
+        self.fraction = fraction
+        self.burst = burst
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.fraction * self.requests + self.burst:
+                return False
+            self.hedges += 1
+            return True
+
+
+class SpawnedCall:
+    """
+    A blocking attempt that starts a remote call with spawn and waits for its result, for Hedger.run
+    Unlike a plain blocking call, it can be cancelled when it loses: the remote call is cancelled
+    and the thread waiting on it is released, rather than held until the call finishes
+    """
+
+    def __init__(self, spawn: Callable[[], Any], timeout: float = None):
+        """
+        :param spawn: starts the call, returning a handle with get(timeout=...) and cancel(), such as Modal's FunctionCall
+        :param timeout: the most seconds to wait for the result
+        """
+        self.spawn = spawn
+        self.timeout = timeout
+        self.call = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def __call__(self) -> Any:
+        with self.lock:
+            if self.cancelled:
+                raise CancelledError()
+            self.call = self.spawn()
+        return self.call.get(timeout=self.timeout)
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            if self.call is not None:
+                self.call.cancel()
+
+
+class Hedger:
+    """
+    Runs a remote request with hedging: the first attempt starts at once, and if it hasn't answered
+    within the HEDGE_PERCENTILE latency of its backend, the next attempt is started alongside it -
+    a duplicate of the same request, or the same question to an alternative backend
+    The first answer wins and the other attempts are cancelled; an attempt that fails starts the next
+    straight away, without using the budget
+    Every attempt's latency, timed from when it starts running, goes into its backend's histogram;
+    a cancelled attempt records the time it had run for, a lower bound, so that slow tails still push the hedge delay up
+    Blocking attempts run on a thread pool per backend, so calls abandoned on one backend can't hold up another's;
+    an attempt with a cancel method, such as a SpawnedCall, is cancelled when it loses rather than left to run
+    """
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, budget: HedgeBudget = None,
+                 default_delay: float = HEDGE_DEFAULT_DELAY, threads: int = 8):
+        """
+        :param threads: the size of each backend's thread pool
+        """
+        self.percentile = percentile
+        self.budget = budget or HedgeBudget()
+        self.default_delay = default_delay
+        self.threads = threads
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.executors: Dict[str, ThreadPoolExecutor] = {}
+        self.hedges: Dict[str, int] = {}
+        self.wins: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def executor(self, backend: str) -> ThreadPoolExecutor:
+        with self.lock:
+            if backend not in self.executors:
+                self.executors[backend] = ThreadPoolExecutor(self.threads, thread_name_prefix=f"hedge-{backend}")
+            return self.executors[backend]
+
+    def histogram(self, backend: str) -> LatencyHistogram:
+        with self.lock:
+            if backend not in self.histograms:
+                self.histograms[backend] = LatencyHistogram()
+            return self.histograms[backend]
+
+    def record(self, backend: str, seconds: float) -> None:
+        self.histogram(backend).record(seconds)
+
+    def delay_for(self, backend: str) -> float:
+        """
+        How long to wait for backend before hedging
+        """
+        histogram = self.histogram(backend)
+        if len(histogram) < self.MIN_SAMPLES:
+            return self.default_delay
+        return histogram.percentile(self.percentile)
+
+    def count(self, counter: Dict[str, int], backend: str) -> None:
+        with self.lock:
+            counter[backend] = counter.get(backend, 0) + 1
+
+    def run(self, attempts: List[Tuple[str, Callable[[], Any]]], timeout: float = None) -> Tuple[Any, str]:
+        """
+        Hedge blocking calls, each run in a thread from its backend's pool
+        A thread can't be interrupted: a losing call is cancelled if it has a cancel method,
+        and otherwise runs on in the background and its result is dropped
+        :param attempts: (backend, function) pairs, in the order to try them
+        :param timeout: give up after this many seconds overall, raising TimeoutError
+        :return: the first result, and the backend that produced it
+        """
+        self.budget.request()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        remaining = list(attempts)
+        primary = remaining[0][0]
+        pending = {}
+        errors = []
+        hedging = True
+
+        def timed(backend: str, function: Callable[[], Any]) -> Any:
+            started = time.perf_counter()
+            try:
+                return function()
+            finally:
+                self.record(backend, time.perf_counter() - started)
+
+        def launch():
+            backend, function = remaining.pop(0)
+            pending[self.executor(backend).submit(timed, backend, function)] = (backend, function)
+
+        launch()
+        try:
+            while pending:
+                wait_for = self.delay_for(primary) if remaining and hedging else None
+                if deadline is not None:
+                    wait_for = max(0.0, min(wait_for if wait_for is not None else timeout, deadline - time.monotonic()))
+                done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+                for future in done:
+                    backend, _ = pending.pop(future)
+                    if future.exception() is None:
+                        self.count(self.wins, backend)
+                        return future.result(), backend
+                    errors.append(future.exception())
+                    if remaining:
+                        launch()
+                if not done:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError(f"No reply from {primary} within {timeout:g}s")
+                    if remaining and hedging:
+                        hedging = self.budget.try_hedge()
+                        if hedging:
+                            self.count(self.hedges, remaining[0][0])
+                            launch()
+            raise errors[-1]
+        finally:
+            for future, (_, function) in pending.items():
+                if not future.cancel() and hasattr(function, "cancel"):
+                    function.cancel()
+
+    async def arun(self, attempts: List[Tuple[str, Callable[[], Awaitable]]], timeout: float = None) -> Tuple[Any, str]:
+        """
+        The async variant of run: each attempt is a coroutine function, and losing attempts are cancelled
+        """
+        self.budget.request()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        remaining = list(attempts)
+        primary = remaining[0][0]
+        pending = {}
+        errors = []
+        hedging = True
+
+        def launch():
+            backend, function = remaining.pop(0)
+            pending[asyncio.ensure_future(function())] = (backend, time.perf_counter(), function)
+
+        launch()
+        try:
+            while pending:
+                wait_for = self.delay_for(primary) if remaining and hedging else None
+                if deadline is not None:
+                    wait_for = max(0.0, min(wait_for if wait_for is not None else timeout, deadline - time.monotonic()))
+                done, _ = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend, started, _ = pending.pop(task)
+                    self.record(backend, time.perf_counter() - started)
+                    if task.exception() is None:
+                        self.count(self.wins, backend)
+                        return task.result(), backend
+                    errors.append(task.exception())
+                    if remaining:
+                        launch()
+                if not done:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError(f"No reply from {primary} within {timeout:g}s")
+                    if remaining and hedging:
+                        hedging = self.budget.try_hedge()
+                        if hedging:
+                            self.count(self.hedges, remaining[0][0])
+                            launch()
+            raise errors[-1]
+        finally:
+            for task, (backend, started, function) in pending.items():
+                task.cancel()
+                if hasattr(function, "cancel"):
+                    function.cancel()
+                self.record(backend, time.perf_counter() - started)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        For each backend: its p50, p95 and p99 latency, and how often it was hedged to and won
+        """
+        with self.lock:
+            backends = list(self.histograms)
+        return {backend: {
+            "samples": len(self.histograms[backend]),
+            "p50": self.histograms[backend].percentile(50),
+            "p95": self.histograms[backend].percentile(95),
+            "p99": self.histograms[backend].percentile(99),
+            "hedges": self.hedges.get(backend, 0),
+            "wins": self.wins.get(backend, 0),
+        } for backend in backends}
+
+
+# The process-wide hedger, so that every agent shares the latency histograms and one budget
+hedger = Hedger()
@@ -0,0 +1,75 @@
+import asyncio
+import numpy as np
+from typing import List
+from sentence_transformers import SentenceTransformer
+from agents.agent import Agent
+from agents.pricing_context import PricingContext
+from agents.embeddings import get_encoder
+
+
+class KnnPriceAgent(Agent):
+    """
+    A local pricer built directly on the vector store: the price of a product is the
+    distance-weighted average, in log space, of the prices of its nearest neighbours
+    It needs no network and no model beyond the shared sentence encoder
+    """
+
+    name = "KNN Price Agent"
+    color = Agent.CYAN
+
+    K = 5
+    EPSILON = 1e-6
+
+    def __init__(self, collection, vectorizer: SentenceTransformer = None):
+        """
+        :param collection: the Chroma collection of products with prices
+        :param vectorizer: an already-loaded encoder to share, e.g. the frontier agent's
+        """
+        self.log("KNN Price Agent is initializing")
+        self.collection = collection
+        self.vectorizer = vectorizer or get_encoder()
+        self.log("KNN Price Agent is ready")
+
+    @classmethod
+    def estimate(cls, prices, distances) -> np.ndarray:
+        """
+        Vectorised kNN regression over a batch
+        :param prices: neighbour prices, shape (n, k) (or (k,) for one product)
+        :param distances: the matching distances, same shape
+        :return: the estimates, shape (n,) (or a scalar for one product)
+        """
+        prices = np.maximum(np.asarray(prices, dtype=np.float64), 0)
+        weights = 1.0 / (np.asarray(distances, dtype=np.float64) + cls.EPSILON)
+        logs = np.log1p(prices)
+        return np.expm1((weights * logs).sum(axis=-1) / weights.sum(axis=-1))
+
+    def price(self, description: str, context: PricingContext = None) -> float:
+        """
+        :param context: the pricing context for this description, whose neighbours are used rather than querying again
+        """
+        if context is None:
+            return self.price_batch([description])[0]
+        with self.span("price", model="knn"):
+            return float(self.estimate(context.prices, context.distances))
+
+    async def aprice(self, description: str, context: PricingContext = None) -> float:
+        """
+        The async variant of price; without a context, the encode and query run in a worker thread
+        """
+        if context is None:
+            return await asyncio.to_thread(self.price, description)
+        return self.price(description, context)
+
+    def price_batch(self, descriptions: List[str], contexts: List[PricingContext] = None) -> List[float]:
+        """
+        Price several products with one encode and one vector store query, unless their contexts are given
+        """
+        self.log(f"KNN Price Agent is pricing {len(descriptions)} products")
+        if not contexts:
+            with self.span("find_similars", model="all-MiniLM-L6-v2"):
+                contexts = PricingContext.build_batch(descriptions, self.vectorizer, self.collection, self.K)
+        with self.span("price_batch", model="knn"):
+            prices = np.array([context.prices for context in contexts])
+            estimates = self.estimate(prices, np.array([context.distances for context in contexts]))
+        self.log("KNN Price Agent completed")
+        return estimates.tolist()
@@ -2,8 +2,10 @@ import os
 # from twilio.rest import Client
 from agents.deals import Opportunity
 import http.client
-import urllib
+import urllib.parse
+from typing import List
 from agents.agent import Agent
+from agents.notifications import NotificationDispatcher
 
 # Uncomment the Twilio lines if you wish to use Twilio
 
@@ -15,6 +17,8 @@ class MessagingAgent(Agent):
     name = "Messaging Agent"
     color = Agent.WHITE
 
+    OUTBOX_FILENAME = "outbox_push.json"
+
     def __init__(self):
         """
         Set up this object to either do push notifications via Pushover,
@@ -32,7 +36,10 @@ class MessagingAgent(Agent):
         if DO_PUSH:
             self.pushover_user = os.getenv('PUSHOVER_USER', 'your-pushover-user-if-not-using-env')
             self.pushover_token = os.getenv('PUSHOVER_TOKEN', 'your-pushover-user-if-not-using-env')
+            self.pushover_url = urllib.parse.urlsplit(os.getenv('PUSHOVER_URL', 'https://api.pushover.net:443'))
             self.log("Messaging Agent has initialized Pushover")
+        if DO_TEXT or DO_PUSH:
+            self.dispatcher = NotificationDispatcher(self.send_digest, self.OUTBOX_FILENAME)
 
     def message(self, text):
         """
@@ -47,33 +54,53 @@ class MessagingAgent(Agent):
 
     def push(self, text):
         """
-        Send a Push Notification using the Pushover API
+        Send a Push Notification using the Pushover API, raising an exception if it fails
         """
         self.log("Messaging Agent is sending a push notification")
-        conn = http.client.HTTPSConnection("api.pushover.net:443")
-        conn.request("POST", "/1/messages.json",
-          urllib.parse.urlencode({
-            "token": self.pushover_token,
-            "user": self.pushover_user,
-            "message": text,
-            "sound": "cashregister"
-          }), { "Content-type": "application/x-www-form-urlencoded" })
-        conn.getresponse()
+        with self.span("alert", model="pushover"):
+            connection = http.client.HTTPConnection if self.pushover_url.scheme == "http" else http.client.HTTPSConnection
+            conn = connection(self.pushover_url.netloc, timeout=30)
+            conn.request("POST", "/1/messages.json",
+              urllib.parse.urlencode({
+                "token": self.pushover_token,
+                "user": self.pushover_user,
+                "message": text,
+                "sound": "cashregister"
+              }), { "Content-type": "application/x-www-form-urlencoded" })
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise RuntimeError(f"Pushover returned status {response.status}")
 
-    def alert(self, opportunity: Opportunity):
-        """
-        Make an alert about the specified Opportunity
-        """
+    def text_for(self, opportunity: Opportunity) -> str:
         text = f"Deal Alert! Price=${opportunity.deal.price:.2f}, "
         text += f"Estimate=${opportunity.estimate:.2f}, "
         text += f"Discount=${opportunity.discount:.2f} :"
         text += opportunity.deal.product_description[:10]+'... '
         text += opportunity.deal.url
+        return text
+
+    def send_digest(self, opportunities: List[Opportunity]):
+        """
+        Send one text and/or push notification covering every opportunity in the digest
+        """
+        text = "\n".join(self.text_for(opportunity) for opportunity in opportunities)
         if DO_TEXT:
             self.message(text)
         if DO_PUSH:
             self.push(text)
-        self.log("Messaging Agent has completed")
-        
-    
-        
\ No newline at end of file
+
+    def alert(self, opportunity: Opportunity, force: bool = False):
+        """
+        Make an alert about the specified Opportunity
+        The notification is queued and sent in the background, batched with any other alerts
+        :param force: send it again even if it was already sent, as when the user picks it in the UI
+        """
+        if DO_TEXT or DO_PUSH:
+            self.dispatcher.enqueue(opportunity, force)
+        self.log("Messaging Agent has queued the alert")
+
+    async def aalert(self, opportunity: Opportunity):
+        """
+        The async variant of alert; queuing never blocks, as delivery already happens on the dispatcher's thread
+        """
+        self.alert(opportunity)
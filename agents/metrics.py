@@ -0,0 +1,215 @@
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+# Set AGENT_METRICS=0 to switch every span into a no-op
+METRICS_ENABLED = os.getenv("AGENT_METRICS", "1") != "0"
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span:
+    """
+    A timed stage of an Agent's work, used as a context manager
+    On exit, the duration, outcome, cache hit flag and any prompt tokens are recorded in the registry
+    """
+
+    __slots__ = ("registry", "key", "start", "outcome", "cache_hit", "tokens")
+
+    def __init__(self, registry, key: Tuple[str, str, str]):
+        self.registry = registry
+        self.key = key
+        self.start = 0.0
+        self.outcome = None
+        self.cache_hit = False
+        self.tokens = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def relabel(self, model: str) -> None:
+        """
+        Record the span under another model, e.g. the backend that actually served a hedged request
+        """
+        self.key = (self.key[0], self.key[1], model)
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        outcome = "error" if exc_type is not None else (self.outcome or "ok")
+        self.registry.record(self.key, duration, outcome, self.cache_hit, self.tokens)
+        return False
+
+
+class NullSpan:
+    """
+    A span that records nothing, handed out when metrics are disabled
+    Attribute writes such as span.cache_hit = True are silently dropped
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+    def relabel(self, model: str) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class StageStats:
+    """
+    Running totals for one (agent, stage, model) combination
+    """
+
+    __slots__ = ("buckets", "total", "count", "outcomes", "cache_hits", "tokens")
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.outcomes: Dict[str, int] = {}
+        self.cache_hits = 0
+        self.tokens = 0
+
+
+class MetricsRegistry:
+    """
+    Collects span timings from all Agents and renders them in the Prometheus text format
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stats: Dict[Tuple[str, str, str], StageStats] = {}
+        self.server = None
+
+    def span(self, agent: str, stage: str, model: Optional[str] = None):
+        """
+        Return a context manager that times a stage, or the shared no-op span if disabled
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, (agent, stage, model or ""))
+
+    def record(self, key: Tuple[str, str, str], duration: float, outcome: str, cache_hit: bool = False, tokens: int = 0):
+        """
+        Add one completed span to the running totals
+        """
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StageStats()
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    stats.buckets[i] += 1
+                    break
+            stats.total += duration
+            stats.count += 1
+            stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+            if cache_hit:
+                stats.cache_hits += 1
+            stats.tokens += tokens
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def snapshot(self) -> Dict[Tuple[str, str, str], Dict]:
+        """
+        Return a plain-dict copy of the current totals, handy in notebooks
+        """
+        with self.lock:
+            return {
+                key: {
+                    "count": stats.count,
+                    "mean_seconds": stats.total / stats.count if stats.count else 0.0,
+                    "outcomes": dict(stats.outcomes),
+                    "cache_hits": stats.cache_hits,
+                    "tokens": stats.tokens,
+                }
+                for key, stats in self.stats.items()
+            }
+
+    @staticmethod
+    def labels(key: Tuple[str, str, str], **extra) -> str:
+        agent, stage, model = key
+        pairs = {"agent": agent, "stage": stage, "model": model, **extra}
+        body = ",".join(f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in pairs.items())
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        """
+        Render all totals in the Prometheus exposition format
+        """
+        lines = [
+            "# HELP agent_stage_duration_seconds Time spent in each agent stage",
+            "# TYPE agent_stage_duration_seconds histogram",
+        ]
+        with self.lock:
+            items = sorted(self.stats.items())
+            for key, stats in items:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f"agent_stage_duration_seconds_bucket{self.labels(key, le=bound)} {cumulative}")
+                lines.append(f"agent_stage_duration_seconds_bucket{self.labels(key, le='+Inf')} {stats.count}")
+                lines.append(f"agent_stage_duration_seconds_sum{self.labels(key)} {stats.total:.6f}")
+                lines.append(f"agent_stage_duration_seconds_count{self.labels(key)} {stats.count}")
+            lines.append("# HELP agent_stage_total Completed agent stages by outcome")
+            lines.append("# TYPE agent_stage_total counter")
+            for key, stats in items:
+                for outcome, count in sorted(stats.outcomes.items()):
+                    lines.append(f"agent_stage_total{self.labels(key, outcome=outcome)} {count}")
+            lines.append("# HELP agent_stage_cache_hits_total Agent stages served from a cache")
+            lines.append("# TYPE agent_stage_cache_hits_total counter")
+            for key, stats in items:
+                lines.append(f"agent_stage_cache_hits_total{self.labels(key)} {stats.cache_hits}")
+            lines.append("# HELP agent_stage_prompt_tokens_total Prompt tokens sent to models by agent stages")
+            lines.append("# TYPE agent_stage_prompt_tokens_total counter")
+            for key, stats in items:
+                if stats.tokens:
+                    lines.append(f"agent_stage_prompt_tokens_total{self.labels(key)} {stats.tokens}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, host: str = "0.0.0.0"):
+        """
+        Expose /metrics over HTTP from a daemon thread, for a Prometheus scraper
+        """
+        if self.server:
+            return self.server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+
+registry = MetricsRegistry(enabled=METRICS_ENABLED)
@@ -0,0 +1,80 @@
+import os
+import re
+import shutil
+import time
+from typing import Callable, Optional, Tuple
+
+MODELS_DIR = "models"
+CURRENT = "CURRENT"
+
+
+class ModelStore:
+    """
+    A directory of versioned model artifacts: models/<name>/v0001, v0002, ...
+    Each name has a CURRENT file naming the live version. New versions are written
+    to a temporary directory, renamed into place, and only then is CURRENT swapped
+    with os.replace, so readers always see either the old or the new model, never half of one
+    """
+
+    def __init__(self, root: str = MODELS_DIR, check_interval: float = 5.0):
+        self.root = root
+        self.check_interval = check_interval
+        self.checked = {}
+
+    def path_for(self, name: str, version: int) -> str:
+        return os.path.join(self.root, name, f"v{version:04d}")
+
+    def versions(self, name: str) -> list:
+        folder = os.path.join(self.root, name)
+        if not os.path.isdir(folder):
+            return []
+        found = [re.fullmatch(r"v(\d+)", entry) for entry in os.listdir(folder)]
+        return sorted(int(match.group(1)) for match in found if match)
+
+    def current(self, name: str) -> Optional[Tuple[int, str]]:
+        """
+        Return the live (version, path) for this model name, or None if nothing is published
+        """
+        try:
+            with open(os.path.join(self.root, name, CURRENT), "r") as file:
+                version = int(file.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+        return version, self.path_for(name, version)
+
+    def changed(self, name: str, version: Optional[int]) -> Optional[Tuple[int, str]]:
+        """
+        Cheap poll used on the pricing path: at most once every check_interval seconds,
+        return the live (version, path) if it differs from the version the caller holds
+        """
+        now = time.monotonic()
+        if now - self.checked.get(name, -self.check_interval) < self.check_interval:
+            return None
+        self.checked[name] = now
+        current = self.current(name)
+        if current and current[0] != version:
+            return current
+        return None
+
+    def publish(self, name: str, write: Callable[[str], None], keep: int = 3) -> int:
+        """
+        Publish a new version of a model
+        :param name: the model name, e.g. "random_forest"
+        :param write: a function that writes the artifacts into the directory it is given
+        :param keep: how many old versions to retain on disk
+        :return: the new version number
+        """
+        version = (self.versions(name) or [0])[-1] + 1
+        final = self.path_for(name, version)
+        staging = final + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        write(staging)
+        os.replace(staging, final)
+        pointer = os.path.join(self.root, name, CURRENT)
+        with open(pointer + ".tmp", "w") as file:
+            file.write(str(version))
+        os.replace(pointer + ".tmp", pointer)
+        for old in self.versions(name)[:-keep]:
+            shutil.rmtree(self.path_for(name, old), ignore_errors=True)
+        return version
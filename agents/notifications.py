@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+from agents.deals import Opportunity
+
+DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "60"))
+MAX_ATTEMPTS = 6
+BACKOFF = 15.0
+SENT_HISTORY = 1000
+
+
+class Outbox:
+    """
+    A small persistent queue of opportunities waiting to be notified, stored as json
+    Pending alerts survive a restart, and each URL is only queued or sent once, unless resent on request
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.pending: List[Dict] = []
+        self.sent: List[str] = []
+        if os.path.exists(filename):
+            with open(filename, "r") as file:
+                data = json.load(file)
+            self.pending = data.get("pending", [])
+            self.sent = data.get("sent", [])[-SENT_HISTORY:]
+
+    def save(self) -> None:
+        with self.lock:
+            temporary = self.filename + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump({"pending": self.pending, "sent": self.sent}, file, indent=2)
+            os.replace(temporary, self.filename)
+
+    @staticmethod
+    def key_for(opportunity: Opportunity) -> str:
+        return opportunity.deal.url or opportunity.deal.product_description
+
+    def add(self, opportunity: Opportunity, force: bool = False) -> bool:
+        """
+        Queue an opportunity, unless the same URL is already queued or was already sent
+        :param force: queue it even if it was already sent, for a resend the user asked for
+        :return: True if it was queued
+        """
+        key = self.key_for(opportunity)
+        with self.lock:
+            if (key in self.sent and not force) or any(entry["key"] == key for entry in self.pending):
+                return False
+            now = time.time()
+            self.pending.append({"key": key, "opportunity": opportunity.dict(), "queued": now, "next_attempt": now, "attempts": 0})
+            self.save()
+            return True
+
+    def next_due(self, window: float) -> Optional[float]:
+        """
+        The time at which the next digest should go out: once the oldest alert
+        has waited for the batching window, or a failed one is ready to retry
+        """
+        with self.lock:
+            if not self.pending:
+                return None
+            return max(min(entry["queued"] for entry in self.pending) + window,
+                       min(entry["next_attempt"] for entry in self.pending))
+
+    def due(self, now: float) -> List[Dict]:
+        with self.lock:
+            return [entry for entry in self.pending if entry["next_attempt"] <= now]
+
+    def complete(self, entries: List[Dict]) -> None:
+        with self.lock:
+            keys = {entry["key"] for entry in entries}
+            self.pending = [entry for entry in self.pending if entry["key"] not in keys]
+            # Only the most recent sends are remembered, in memory as in the file
+            self.sent = ([key for key in self.sent if key not in keys] + list(keys))[-SENT_HISTORY:]
+            self.save()
+
+    def retry(self, entries: List[Dict], max_attempts: int, backoff: float) -> List[Dict]:
+        """
+        Schedule failed entries for another attempt with exponential backoff
+        :return: the entries given up on after max_attempts
+        """
+        with self.lock:
+            dropped = []
+            for entry in entries:
+                entry["attempts"] += 1
+                entry["next_attempt"] = time.time() + backoff * 2 ** (entry["attempts"] - 1)
+                if entry["attempts"] >= max_attempts:
+                    dropped.append(entry)
+            keys = {entry["key"] for entry in dropped}
+            self.pending = [entry for entry in self.pending if entry["key"] not in keys]
+            self.save()
+            return dropped
+
+
+class NotificationDispatcher:
+    """
+    Delivers alerts from a background thread so that alerting never blocks the planner or the UI
+    Opportunities queued within the digest window go out together in one delivery,
+    and failed deliveries are retried with exponential backoff
+    """
+
+    def __init__(self, deliver: Callable[[List[Opportunity]], None], outbox_filename: str, window: float = DIGEST_WINDOW,
+                 max_attempts: int = MAX_ATTEMPTS, backoff: float = BACKOFF):
+        """
+        :param deliver: sends a digest of one or more opportunities, raising an exception on failure
+        :param outbox_filename: where pending alerts are persisted
+        :param window: seconds to wait for more alerts before sending a digest
+        """
+        self.deliver = deliver
+        self.outbox = Outbox(outbox_filename)
+        self.window = window
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.loop, name="notification-dispatcher", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, opportunity: Opportunity, force: bool = False) -> bool:
+        """
+        Queue an alert and return immediately
+        :param force: queue it even if it was already sent
+        """
+        queued = self.outbox.add(opportunity, force)
+        self.wakeup.set()
+        return queued
+
+    def loop(self) -> None:
+        while not self.stopped:
+            due_at = self.outbox.next_due(self.window)
+            timeout = None if due_at is None else max(0.0, due_at - time.time())
+            if self.wakeup.wait(timeout):
+                self.wakeup.clear()
+                continue
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Deliver everything that is due now as a single digest
+        :return: the number of opportunities delivered
+        """
+        entries = self.outbox.due(time.time())
+        if not entries:
+            return 0
+        opportunities = [Opportunity(**entry["opportunity"]) for entry in entries]
+        try:
+            self.deliver(opportunities)
+        except Exception as e:
+            logging.warning(f"Notification delivery of {len(entries)} alerts failed: {e}")
+            for entry in self.outbox.retry(entries, self.max_attempts, self.backoff):
+                logging.error(f"Giving up on notification for {entry['key']} after {entry['attempts']} attempts")
+            return 0
+        self.outbox.complete(entries)
+        return len(entries)
+
+    def stop(self, flush: bool = True) -> None:
+        """
+        Stop the background thread, by default sending anything still pending first
+        """
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+        if flush:
+            for entry in self.outbox.pending:
+                entry["next_attempt"] = 0
+            self.flush()
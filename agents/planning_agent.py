@@ -1,10 +1,15 @@
-from typing import Optional, List
+import os
+import asyncio
+from typing import Dict, Optional, List, Tuple
 from agents.agent import Agent
 from agents.deals import ScrapedDeal, DealSelection, Deal, Opportunity
 from agents.scanner_agent import ScannerAgent
 from agents.ensemble_agent import EnsembleAgent
 from agents.messaging_agent import MessagingAgent
 from agents.emailing_agent import EmailingAgent
+from agents.pricing_log import PricingLog
+from agents.pricing_context import PricingContext
+from agents.price_cache import PriceCache
 
 
 class PlanningAgent(Agent):
@@ -12,6 +17,11 @@ class PlanningAgent(Agent):
     name = "Planning Agent"
     color = Agent.GREEN
     DEAL_THRESHOLD = 50
+    # High-volume mode prices every scraped deal locally, then escalates the top few to the full ensemble
+    HIGH_VOLUME = os.getenv("PLANNER_HIGH_VOLUME", "0") == "1"
+    ESCALATE_TOP_K = int(os.getenv("PLANNER_ESCALATE_TOP_K", "5"))
+    # Deals priced before, and unchanged since, reuse their estimate; set PLANNER_PRICE_CACHE=0 to always re-price
+    PRICE_CACHE = os.getenv("PLANNER_PRICE_CACHE", "1") == "1"
 
     def __init__(self, collection):
         """
@@ -22,38 +32,149 @@ class PlanningAgent(Agent):
         self.ensemble = EnsembleAgent(collection)
         #self.messenger = MessagingAgent()
         self.emailer = EmailingAgent()
+        self.pricing_log = PricingLog()
+        self.cache = PriceCache() if self.PRICE_CACHE else None
         self.log("Planning Agent is ready")
 
-    def run(self, deal: Deal) -> Opportunity:
+    def cached(self, deal: Deal, versions: Dict) -> Optional[Opportunity]:
         """
-        Run the workflow for a particular deal
+        :return: the opportunity from the price cache, if this deal was priced by the current models
+        and its description and price haven't changed since; otherwise None
+        """
+        hit = self.cache.get(deal.product_description, deal.price, deal.url, versions) if self.cache else None
+        if hit is None:
+            return None
+        estimate = hit[0]
+        self.log(f"Planning Agent found an unchanged deal in the price cache, estimated at ${estimate:.2f}")
+        return Opportunity(deal=deal, estimate=estimate, discount=estimate - deal.price)
+
+    def remember(self, deal: Deal, versions: Dict, estimate: float, components: Dict[str, object]) -> None:
+        if self.cache:
+            versions = self.ensemble.versions_for(versions, components)
+            self.cache.put(deal.product_description, deal.price, deal.url, versions, estimate, components)
+
+    def split_cached(self, deals: List[Deal]) -> Tuple[List[Opportunity], List[Deal], Dict]:
+        """
+        Separate the deals the cache can answer from those that need pricing
+        :return: the cached opportunities, the deals still to price, and the current model versions
+        """
+        versions = self.ensemble.versions()
+        hits = [self.cached(deal, versions) for deal in deals]
+        fresh = [deal for deal, hit in zip(deals, hits) if hit is None]
+        if len(fresh) < len(deals):
+            self.log(f"Planning Agent is reusing {len(deals) - len(fresh)} cached estimates and pricing {len(fresh)} deals")
+        return [hit for hit in hits if hit], fresh, versions
+
+    def run(self, deal: Deal, context: PricingContext = None, versions: Dict = None) -> Opportunity:
+        """
+        Run the workflow for a particular deal, unless the price cache already holds it
         :param deal: the deal, summarized from an RSS scrape
+        :param context: the deal's pricing context, if already built
+        :param versions: the current model versions, if already looked up
         :returns: an opportunity including the discount
         """
-        self.log("Planning Agent is pricing up a potential deal")
-        estimate = self.ensemble.price(deal.product_description)
+        versions = versions or self.ensemble.versions()
+        with self.span("run") as span:
+            opportunity = self.cached(deal, versions)
+            if opportunity:
+                span.cache_hit = True
+                return opportunity
+            self.log("Planning Agent is pricing up a potential deal")
+            estimate = self.ensemble.price(deal.product_description, context)
+        components = self.ensemble.last_components
+        self.pricing_log.append(deal.product_description, deal.price, components)
+        self.remember(deal, versions, estimate, components)
         discount = estimate - deal.price
         self.log(f"Planning Agent has processed a deal with discount ${discount:.2f}")
         return Opportunity(deal=deal, estimate=estimate, discount=discount)
 
+    def shortlist(self, deals: List[Deal], contexts: List[PricingContext]) -> List[Tuple[Deal, PricingContext]]:
+        """
+        Rank deals by the discount implied by the cheap local estimate,
+        and keep the top ESCALATE_TOP_K for the expensive specialist and frontier models
+        """
+        estimates = self.ensemble.prefilter([deal.product_description for deal in deals], contexts)
+        ranked = sorted(zip(deals, contexts, estimates), key=lambda entry: entry[2] - entry[0].price, reverse=True)
+        shortlist = [(deal, context) for deal, context, _ in ranked[:self.ESCALATE_TOP_K]]
+        self.log(f"Planning Agent pre-priced {len(deals)} deals and is escalating {len(shortlist)}")
+        return shortlist
+
     def plan(self, memory: List[str] = []) -> Optional[Opportunity]:
         """
         Run the full workflow:
         1. Use the ScannerAgent to find deals from RSS feeds
         2. Use the EnsembleAgent to estimate them
+           (in high-volume mode, every deal is pre-priced locally and only the top few are fully estimated)
         3. Use the MessagingAgent to send a notification of deals
         :param memory: a list of URLs that have been surfaced in the past
         :return: an Opportunity if one was surfaced, otherwise None
         """
         self.log("Planning Agent is kicking off a run")
-        selection = self.scanner.scan_gemini(memory=memory)
-        if selection:
-            opportunities = [self.run(deal) for deal in selection.deals[:5]]
-            opportunities.sort(key=lambda opp: opp.discount, reverse=True)
-            best = opportunities[0]
-            self.log(f"Planning Agent has identified the best deal has discount ${best.discount:.2f}")
-            if best.discount > self.DEAL_THRESHOLD:
+        with self.span("scan"):
+            selection = self.scanner.scan_gemini(memory=memory, select_all=self.HIGH_VOLUME)
+        if selection and selection.deals:
+            deals = selection.deals if self.HIGH_VOLUME else selection.deals[:5]
+            opportunities, deals, versions = self.split_cached(deals)
+            if deals:
+                # Every deal is encoded and looked up in the vector store once, in a single batch
+                contexts = self.ensemble.contexts_for([deal.product_description for deal in deals])
+                pairs = self.shortlist(deals, contexts) if self.HIGH_VOLUME else list(zip(deals, contexts))
+                opportunities += [self.run(deal, context, versions) for deal, context in pairs]
+            best = self.choose(opportunities)
+            if best:
                 self.emailer.alert(best)
             self.log("Planning Agent has completed a run")
-            return best if best.discount > self.DEAL_THRESHOLD else None
+            return best
+        return None
+
+    def choose(self, opportunities: List[Opportunity]) -> Optional[Opportunity]:
+        """
+        :return: the opportunity with the biggest discount, if that is over DEAL_THRESHOLD
+        """
+        opportunities.sort(key=lambda opp: opp.discount, reverse=True)
+        best = opportunities[0]
+        self.log(f"Planning Agent has identified the best deal has discount ${best.discount:.2f}")
+        return best if best.discount > self.DEAL_THRESHOLD else None
+
+    async def arun(self, deal: Deal, context: PricingContext = None, versions: Dict = None) -> Opportunity:
+        """
+        The async variant of run
+        """
+        versions = versions or await asyncio.to_thread(self.ensemble.versions)
+        with self.span("run") as span:
+            opportunity = self.cached(deal, versions)
+            if opportunity:
+                span.cache_hit = True
+                return opportunity
+            self.log("Planning Agent is pricing up a potential deal")
+            estimate, components = await self.ensemble.aprice_components(deal.product_description, context)
+        self.pricing_log.append(deal.product_description, deal.price, components)
+        await asyncio.to_thread(self.remember, deal, versions, estimate, components)
+        discount = estimate - deal.price
+        self.log(f"Planning Agent has processed a deal with discount ${discount:.2f}")
+        return Opportunity(deal=deal, estimate=estimate, discount=discount)
+
+    async def aplan(self, memory: List[str] = []) -> Optional[Opportunity]:
+        """
+        The async variant of plan: the deals are priced concurrently, and every model call is awaited
+        on one event loop; the CPU-bound encoding and local models run in worker threads
+        """
+        self.log("Planning Agent is kicking off a run")
+        with self.span("scan"):
+            selection = await self.scanner.ascan(memory=memory, select_all=self.HIGH_VOLUME)
+        if selection and selection.deals:
+            deals = selection.deals if self.HIGH_VOLUME else selection.deals[:5]
+            opportunities, deals, versions = await asyncio.to_thread(self.split_cached, deals)
+            if deals:
+                contexts = await asyncio.to_thread(self.ensemble.contexts_for, [deal.product_description for deal in deals])
+                if self.HIGH_VOLUME:
+                    pairs = await asyncio.to_thread(self.shortlist, deals, contexts)
+                else:
+                    pairs = list(zip(deals, contexts))
+                opportunities += await asyncio.gather(*(self.arun(deal, context, versions) for deal, context in pairs))
+            best = self.choose(opportunities)
+            if best:
+                await self.emailer.aalert(best)
+            self.log("Planning Agent has completed a run")
+            return best
         return None
\ No newline at end of file
@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+PRICE_CACHE_FILENAME = "price_cache.json"
+# Entries older than this are priced again even if nothing else has changed
+PRICE_CACHE_TTL_DAYS = float(os.getenv("PRICE_CACHE_TTL_DAYS", "7"))
+# Query parameters that identify a campaign rather than a deal: these names exactly, and any name with these prefixes
+TRACKING_PARAMETERS = {"ref", "ref_", "cmp", "fbclid", "gclid"}
+TRACKING_PREFIXES = ("utm_", "mc_")
+
+
+def normalize_url(url: str) -> str:
+    """
+    The same deal page however it was linked: lower-case scheme and host, no fragment,
+    no tracking parameters, the remaining parameters sorted, and no trailing slash
+    """
+    parts = urlsplit(url.strip())
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if key.lower() not in TRACKING_PARAMETERS and not key.lower().startswith(TRACKING_PREFIXES))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ""))
+
+
+def content_hash(description: str, price: float) -> str:
+    return hashlib.sha256(f"{' '.join(description.split())}\n{price:.2f}".encode()).hexdigest()
+
+
+class PriceCache:
+    """
+    The ensemble's estimate for each deal it has priced, with every sub-model's output, keyed by the
+    deal's normalised URL (or its content, when it has no URL)
+    An entry only answers while the deal's description and price hash the same, the models that priced it
+    are the current versions, and it is younger than PRICE_CACHE_TTL_DAYS; otherwise the deal is priced again
+    and the entry replaced. The cache is written to price_cache.json, via a temporary file, after every change
+    """
+
+    MAX_ENTRIES = 5000
+
+    def __init__(self, filename: str = PRICE_CACHE_FILENAME, ttl_days: float = PRICE_CACHE_TTL_DAYS):
+        self.filename = filename
+        self.ttl = ttl_days * 86400
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as file:
+                    self.entries = json.load(file)
+            except ValueError:
+                self.entries = {}
+
+    @staticmethod
+    def key_for(description: str, price: float, url: Optional[str]) -> str:
+        return normalize_url(url) if url else content_hash(description, price)
+
+    def get(self, description: str, price: float, url: Optional[str], versions: Dict) -> Optional[Tuple[float, Dict[str, object]]]:
+        """
+        :param versions: the versions of the models that would price the deal now
+        :return: the cached estimate and sub-model outputs, or None if the deal must be priced
+        """
+        with self.lock:
+            entry = self.entries.get(self.key_for(description, price, url))
+        if not entry or entry["hash"] != content_hash(description, price) or entry["versions"] != versions:
+            return None
+        if time.time() - entry["time"] > self.ttl:
+            return None
+        return entry["estimate"], entry["components"]
+
+    def put(self, description: str, price: float, url: Optional[str], versions: Dict,
+            estimate: float, components: Dict[str, object]) -> None:
+        entry = {"hash": content_hash(description, price), "versions": versions, "time": time.time(),
+                 "estimate": float(estimate), "components": dict(components)}
+        with self.lock:
+            self.entries[self.key_for(description, price, url)] = entry
+            if len(self.entries) > self.MAX_ENTRIES:
+                oldest = sorted(self.entries, key=lambda key: self.entries[key]["time"])
+                for key in oldest[:len(self.entries) - self.MAX_ENTRIES]:
+                    del self.entries[key]
+            temporary = self.filename + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump(self.entries, file)
+            os.replace(temporary, self.filename)
@@ -0,0 +1,49 @@
+import numpy as np
+from typing import List, Tuple
+
+
+class PricingContext:
+    """
+    The work about one product that several pricing models need, done once per deal:
+    the embedding of its description, and its nearest neighbours in the vector store
+    with their prices and distances
+    EnsembleAgent builds one for each deal and passes it to every sub-agent,
+    so no stage encodes the description or queries Chroma a second time
+    """
+
+    def __init__(self, description: str, vector: np.ndarray, documents: List[str], prices: List[float], distances: List[float]):
+        self.description = description
+        self.vector = vector
+        self.documents = documents
+        self.prices = prices
+        self.distances = distances
+
+    @property
+    def similars(self) -> Tuple[List[str], List[float]]:
+        return self.documents, self.prices
+
+    @classmethod
+    def build_batch(cls, descriptions: List[str], encoder, collection, k: int = 5) -> List["PricingContext"]:
+        """
+        Build contexts for several products with one encode and one vector store query
+        :param encoder: the SentenceTransformer shared by the agents
+        :param collection: the Chroma collection of products with prices
+        :param k: the number of neighbours to retrieve
+        """
+        vectors = np.asarray(encoder.encode(descriptions), dtype=np.float32)
+        results = collection.query(query_embeddings=vectors.astype(float).tolist(), n_results=k,
+                                   include=['documents', 'metadatas', 'distances'])
+        return [cls(description, vector, documents, [m['price'] for m in metadatas], distances)
+                for description, vector, documents, metadatas, distances
+                in zip(descriptions, vectors, results['documents'], results['metadatas'], results['distances'])]
+
+    @classmethod
+    def build(cls, description: str, encoder, collection, k: int = 5) -> "PricingContext":
+        return cls.build_batch([description], encoder, collection, k)[0]
+
+    @staticmethod
+    def stack(contexts: List["PricingContext"]) -> np.ndarray:
+        """
+        The embeddings of several contexts as one (n, d) array, ready for a batched model
+        """
+        return np.stack([context.vector for context in contexts])
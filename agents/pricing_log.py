@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import threading
+from typing import Dict, Iterator, Optional
+
+PRICING_LOG_FILENAME = "pricing_log.jsonl"
+
+
+class PricingLog:
+    """
+    An append-only jsonl record of every deal we price: the description, the price it is offered at,
+    and the estimate from each sub-model
+    The offer price is a discounted sale price, not what the product is worth, so it is never a training label;
+    only records given a value - a known price for the product, passed to append or joined on later with label -
+    are used to refit the ensemble stacker and to add trees to the random forest.
+    Records written before offer_price was split out hold it as "price", and are likewise not labelled
+    """
+
+    def __init__(self, filename: str = PRICING_LOG_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def append(self, description: str, offer_price: float, components: Dict[str, float], value: Optional[float] = None) -> None:
+        """
+        Record one priced deal
+        :param description: the product description that was priced
+        :param offer_price: the price the deal is offered at
+        :param components: the estimate from each sub-model, keyed by ensemble feature name
+        :param value: the product's known price, if there is one, used as the training label
+        """
+        record = {"time": time.time(), "description": description, "offer_price": offer_price, **components}
+        if value is not None:
+            record["value"] = value
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            with open(self.filename, "a") as file:
+                file.write(line)
+
+    def __iter__(self) -> Iterator[Dict]:
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "r") as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def labelled(self) -> Iterator[Dict]:
+        """
+        The records that carry a value label
+        """
+        return (record for record in self if (record.get("value") or 0) > 0)
+
+    @staticmethod
+    def key_for(description: str) -> str:
+        return " ".join(description.split()).lower()
+
+    def label(self, values: Dict[str, float]) -> int:
+        """
+        Join known prices onto the logged deals, matching descriptions regardless of case and whitespace,
+        and rewrite the log in place
+        :param values: known prices keyed by product description
+        :return: the number of records labelled
+        """
+        values = {self.key_for(description): float(value) for description, value in values.items() if value and value > 0}
+        with self.lock:
+            records = list(self)
+            labelled = 0
+            for record in records:
+                value = values.get(self.key_for(record["description"]))
+                if value is not None:
+                    record["value"] = value
+                    labelled += 1
+            temporary = self.filename + ".tmp"
+            with open(temporary, "w") as file:
+                file.writelines(json.dumps(record) + "\n" for record in records)
+            os.replace(temporary, self.filename)
+        return labelled
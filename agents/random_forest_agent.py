@@ -2,11 +2,18 @@
 
 import os
 import re
+import asyncio
 import torch
 from typing import List
 from sentence_transformers import SentenceTransformer
 import joblib
 from agents.agent import Agent
+from agents.compact_forest import CompactForest
+from agents.model_store import ModelStore
+from agents.pricing_context import PricingContext
+from agents.workers import get_pool
+from agents.embeddings import get_encoder
+from agents.vector_index import VectorCompressor
 
 
 
@@ -15,25 +22,115 @@ class RandomForestAgent(Agent):
     name = "Random Forest Agent"
     color = Agent.MAGENTA
 
-    def __init__(self):
+    MODEL_FILENAME = 'random_forest_model.pkl'
+    COMPACT_MODEL_PATH = 'random_forest_compact'
+    STORE_NAME = 'random_forest'
+
+    def __init__(self, store: ModelStore = None, vectorizer: SentenceTransformer = None):
         """
         Initialize this object by loading in the saved model weights
         and the SentenceTransformer vector encoding model
+        A version published to the model store (python training.py) wins over the files
+        in the working directory; the compact, memory-mapped forest is preferred over the pickle
+        :param vectorizer: an already-loaded encoder to share, e.g. the frontier agent's
         """
         self.log("Random Forest Agent is initializing")
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.vectorizer = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2', "cpu")
-        self.model = joblib.load('random_forest_model.pkl')
+        self.vectorizer = vectorizer or get_encoder()
+        self.store = store or ModelStore()
+        self.version = None
+        # A version trained on PCA-reduced embeddings ships the compressor that reduces them
+        self.compressor = None
+        # With PRICER_WORKERS set, batches are encoded and run through the forest in worker processes
+        self.pool = get_pool()
+        current = self.store.current(self.STORE_NAME)
+        if current:
+            self.load_version(*current)
+        elif os.path.isdir(self.COMPACT_MODEL_PATH):
+            self.model_path = self.COMPACT_MODEL_PATH
+            self.model = CompactForest.load(self.COMPACT_MODEL_PATH)
+            self.log("Random Forest Agent loaded the compact forest")
+        else:
+            self.model_path = self.MODEL_FILENAME
+            self.model = joblib.load(self.MODEL_FILENAME)
         self.log("Random Forest Agent is ready")
 
-    def price(self, description: str) -> float:
+    @staticmethod
+    def load_model(path: str):
+        """
+        Load a compact forest directory or a pickled model file
+        """
+        return CompactForest.load(path) if os.path.isdir(path) else joblib.load(path)
+
+    def load_version(self, version: int, path: str):
+        """
+        Load a published model version, then swap it in with a single assignment
+        """
+        compact = os.path.join(path, "compact")
+        model_path = compact if os.path.isdir(compact) else os.path.join(path, "model.pkl")
+        compressor = VectorCompressor.find(path)
+        self.model = self.load_model(model_path)
+        self.compressor = compressor
+        self.model_path = model_path
+        self.version = version
+        self.log(f"Random Forest Agent is using model version {version}")
+
+    def refresh(self):
+        """
+        Pick up a newly published model version without a restart
+        """
+        update = self.store.changed(self.STORE_NAME, self.version)
+        if update:
+            self.load_version(*update)
+
+    def features(self, vectors):
+        """
+        The forest's inputs for these embeddings: the embeddings themselves, or their PCA projection
+        """
+        return self.compressor.project(vectors) if self.compressor else vectors
+
+    def price(self, description: str, context: PricingContext = None) -> float:
         """
         Use a Random Forest model to estimate the price of the described item
         :param description: the product to be estimated
+        :param context: the pricing context for this description, whose embedding is used rather than encoding again
         :return: the price as a float
         """        
         self.log("Random Forest Agent is starting a prediction")
-        vector = self.vectorizer.encode([description])
-        result = max(0, self.model.predict(vector)[0])
+        self.refresh()
+        if context:
+            vector = context.vector.reshape(1, -1)
+        else:
+            with self.span("encode", model="all-MiniLM-L6-v2"):
+                vector = self.vectorizer.encode([description])
+        with self.span("price", model="random_forest"):
+            result = max(0, self.model.predict(self.features(vector))[0])
         self.log(f"Random Forest Agent completed - predicting ${result:.2f}")
-        return result
\ No newline at end of file
+        return result
+
+    async def aprice(self, description: str, context: PricingContext = None) -> float:
+        """
+        The async variant of price; the CPU-bound encode and forest traversal run in a worker thread
+        """
+        return await asyncio.to_thread(self.price, description, context)
+
+    def price_batch(self, descriptions: List[str], contexts: List[PricingContext] = None) -> List[float]:
+        """
+        Estimate the prices of several items with one encode and one forest traversal
+        :param descriptions: the products to be estimated
+        :param contexts: their pricing contexts, if already built, to skip the encode
+        :return: the prices as a list of floats
+        """
+        self.log(f"Random Forest Agent is starting a batch of {len(descriptions)} predictions")
+        self.refresh()
+        if contexts:
+            vectors = PricingContext.stack(contexts)
+        else:
+            with self.span("encode", model="all-MiniLM-L6-v2"):
+                vectors = (self.pool or self.vectorizer).encode(descriptions)
+        with self.span("price_batch", model="random_forest"):
+            vectors = self.features(vectors)
+            predictions = self.pool.predict(self.model_path, vectors) if self.pool else self.model.predict(vectors)
+            results = [max(0, float(y)) for y in predictions]
+        self.log("Random Forest Agent completed the batch")
+        return results
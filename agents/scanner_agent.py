@@ -6,8 +6,11 @@ from openai import OpenAI
 from sentence_transformers import SentenceTransformer
 from agents.deals import Deal, ScrapedDeal, DealSelection
 from agents.agent import Agent
+from agents.embeddings import get_encoder
 from pydantic import BaseModel
-from typing import List, Dict, Self, Optional
+from typing import Iterable, Iterator, List, Dict, Self, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 from bs4 import BeautifulSoup
 import re
 import feedparser
@@ -18,6 +21,13 @@ import time
 class ScannerAgent(Agent):
 
     MODEL = "gemini-2.5-flash"
+    # Each deal is cut to DEAL_TOKENS in the prompt, and the deals are sent in chunks of at most CHUNK_TOKENS,
+    # CONCURRENCY chunks at a time; token counts are estimated at CHARACTERS_PER_TOKEN
+    DEAL_TOKENS = int(os.getenv("SCANNER_DEAL_TOKENS", "400"))
+    CHUNK_TOKENS = int(os.getenv("SCANNER_CHUNK_TOKENS", "12000"))
+    CONCURRENCY = int(os.getenv("SCANNER_CONCURRENCY", "4"))
+    CHARACTERS_PER_TOKEN = 4
+    SELECTION_SIZE = 5
 
     SYSTEM_PROMPT = """You identify and summarize the 5 most detailed deals from a list, by selecting deals that have the most detailed, high quality description and the most clear price.
     Respond strictly in JSON with no explanation, using this format. You should provide the price as a number derived from the description. If the price of a deal isn't clear, do not include that deal in your response.
@@ -44,6 +54,24 @@ class ScannerAgent(Agent):
 
     USER_PROMPT_SUFFIX = "\n\nStrictly respond in JSON and include exactly 5 deals, no more."
 
+    # High-volume mode: summarize every deal with a clear price rather than picking 5
+    ALL_SYSTEM_PROMPT = SYSTEM_PROMPT.replace(
+        "You identify and summarize the 5 most detailed deals from a list, by selecting deals that have the most detailed, high quality description and the most clear price.",
+        "You summarize every deal from a list that has a clear price.",
+    ).replace(
+        "Most important is that you respond with the 5 deals that have the most detailed product description with price.",
+        "Most important is that you respond with every deal that has a clear price, with a thorough product description.",
+    )
+    ALL_USER_PROMPT_PREFIX = """Respond with every deal from this list that has a clear price greater than 0, in the same JSON format.
+    Respond strictly in JSON, and only JSON. You should rephrase the description to be a summary of the product itself, not the terms of the deal.
+    Be careful with products that are described as "$XXX off" or "reduced by $XXX" - this isn't the actual price of the product. Leave out any deal where you are not highly confident about the price.
+    
+    Deals:
+    
+    """
+
+    ALL_USER_PROMPT_SUFFIX = "\n\nStrictly respond in JSON and include every deal with a clear price."
+
     name = "Scanner Agent"
     color = Agent.CYAN
 
@@ -53,7 +81,7 @@ class ScannerAgent(Agent):
         genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
         self.genai = genai
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = SentenceTransformer("all-MiniLM-L6-v2", "cpu")
+        self.model = get_encoder()
         self.log("Scanner Agent is ready")
     
     def fetch_deals(self, memory) -> List[ScrapedDeal]:
@@ -63,18 +91,48 @@ class ScannerAgent(Agent):
         """
         self.log("Scanner Agent is about to fetch deals from RSS feed")
         urls = [opp.deal.url for opp in memory]
-        scraped = ScrapedDeal.fetch()
+        with self.span("fetch_deals"):
+            scraped = ScrapedDeal.fetch()
         result = [scrape for scrape in scraped if scrape.url not in urls]
         self.log(f"Scanner Agent received {len(result)} deals not already scraped")
         return result
 
-    def make_user_prompt(self, scraped) -> str:
+    def describe(self, scrape: ScrapedDeal) -> str:
+        """
+        The deal as it goes in the prompt, its details and features cut to the per-deal budget
+        """
+        return scrape.describe(max_characters=self.DEAL_TOKENS * self.CHARACTERS_PER_TOKEN)
+
+    def chunks(self, descriptions: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Group descriptions, in order, into chunks that each fit CHUNK_TOKENS
+        """
+        chunk, used = [], 0
+        for description in descriptions:
+            tokens = len(description) // self.CHARACTERS_PER_TOKEN
+            if chunk and used + tokens > self.CHUNK_TOKENS:
+                yield chunk
+                chunk, used = [], 0
+            chunk.append(description)
+            used += tokens
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def finalist(deal: Deal) -> str:
         """
-        Create a user prompt for Gemini based on the scraped deals provided
+        A deal already selected from a chunk, as it goes in the prompt of the final selection
         """
-        user_prompt = self.USER_PROMPT_PREFIX
-        user_prompt += '\n\n'.join([scrape.describe() for scrape in scraped])
-        user_prompt += self.USER_PROMPT_SUFFIX
+        return f"Details: {deal.product_description}\nPrice: ${deal.price:.2f}\nURL: {deal.url}"
+
+    def make_user_prompt(self, descriptions: List[str], select_all: bool = False) -> str:
+        """
+        Create a user prompt for Gemini based on the deal descriptions provided
+        :param select_all: ask for every deal with a clear price, instead of the best 5
+        """
+        user_prompt = self.ALL_USER_PROMPT_PREFIX if select_all else self.USER_PROMPT_PREFIX
+        user_prompt += '\n\n'.join(descriptions)
+        user_prompt += self.ALL_USER_PROMPT_SUFFIX if select_all else self.USER_PROMPT_SUFFIX
         return user_prompt
     
     @staticmethod
@@ -118,72 +176,186 @@ class ScannerAgent(Agent):
             return text[start:end]
         return text
     
-    def scan_gemini(self, memory: List[str] = []) -> Optional[DealSelection]:
+    def prompt_for(self, descriptions: List[str], select_all: bool = False) -> str:
+        """
+        The full Gemini prompt, system and user parts combined, for one chunk of deal descriptions
+        """
+        user_prompt = self.make_user_prompt(descriptions, select_all=select_all)
+        system_prompt = self.ALL_SYSTEM_PROMPT if select_all else self.SYSTEM_PROMPT
+        return f"{system_prompt}\n\n{user_prompt}"
+
+    def parse_selection(self, reply: str) -> DealSelection:
+        """
+        Turn Gemini's reply into a selection of deals with a price above 0
+        Raises json.JSONDecodeError or ValueError if the reply can't be read
+        """
+        print("RAW Gemini reply:\n", repr(reply))  # Debug: show raw text
+        clean_text = self.extract_json(reply)
+        print("Cleaned JSON text:\n", clean_text)  # Debug: show stripped version
+        parsed = json.loads(clean_text)
+        print("Parsed JSON type:", type(parsed))  # Debug: show type
+        
+        # Determine deal list location
+        deals_data = None
+        if isinstance(parsed, dict):
+            print("Parsed keys:", parsed.keys())  # Extra debug
+            for key in ["selected_deals", "deals", "promising_deals"]:
+                deals_data = parsed.get(key)
+                if deals_data:
+                    break
+        elif isinstance(parsed, list):
+            deals_data = parsed
+        else:
+            raise ValueError("Parsed JSON is not a list or dict")
+        
+        if not deals_data:
+            raise ValueError("No deals found in parsed JSON")
+        
+        deals = [
+            Deal(
+                title=deal.get("title", ""),  # Add default for title
+                product_description=deal["product_description"],
+                price=self.parse_price(deal["price"]),
+                url=deal.get("url")  # Use .get() since URL might not exist
+            )
+            for deal in deals_data
+        ]
+        
+        # Filter out deals with price <= 0
+        deals = [deal for deal in deals if deal.price > 0]
+        self.log(f"Scanner Agent received {len(deals)} selected deals with price>0 from Gemini")
+        
+        return DealSelection(deals=deals)
+
+    def select(self, descriptions: List[str], select_all: bool = False) -> List[Deal]:
+        """
+        Ask Gemini to select from one chunk of deals
+        :return: the deals selected, or none if the call or its reply failed
+        """
+        try:
+            with self.span("scan_gemini", model=self.MODEL):
+                model = genai.GenerativeModel(self.MODEL)
+                reply = model.generate_content(self.prompt_for(descriptions, select_all=select_all)).text
+            return self.parse_selection(reply).deals
+        except Exception as e:
+            self.log(f"❌ Error selecting from a chunk of {len(descriptions)} deals: {e}")
+            return []
+
+    async def aselect(self, descriptions: List[str], select_all: bool = False) -> List[Deal]:
+        """
+        The async variant of select
+        """
+        try:
+            with self.span("scan_gemini", model=self.MODEL):
+                model = genai.GenerativeModel(self.MODEL)
+                reply = (await model.generate_content_async(self.prompt_for(descriptions, select_all=select_all))).text
+            return self.parse_selection(reply).deals
+        except Exception as e:
+            self.log(f"❌ Error selecting from a chunk of {len(descriptions)} deals: {e}")
+            return []
+
+    @staticmethod
+    def merge(selections: List[List[Deal]]) -> List[Deal]:
+        """
+        Combine the chunks' selections, dropping repeated URLs
+        """
+        deals, seen = [], set()
+        for deal in (deal for selection in selections for deal in selection):
+            if deal.url and deal.url in seen:
+                continue
+            seen.add(deal.url)
+            deals.append(deal)
+        return deals
+
+    def narrow(self, candidates: List[Deal], chosen: List[List[Deal]], detail: Dict[str, int]) -> List[Deal]:
+        """
+        Keep the candidates that a round of final selection chose, matched by URL so that each keeps its first summary
+        If the round chose none of them, or didn't narrow them down, fall back to the SELECTION_SIZE candidates
+        whose scraped listings were the most detailed
+        :param detail: the length of each scraped deal's description, by URL
+        """
+        urls = {deal.url for selection in chosen for deal in selection}
+        kept = [deal for deal in candidates if deal.url in urls]
+        if not kept or len(kept) >= len(candidates):
+            self.log("Scanner Agent's final selection failed - keeping the most detailed listings")
+            return sorted(candidates, key=lambda deal: detail.get(deal.url, 0), reverse=True)[:self.SELECTION_SIZE]
+        return kept
+
+    def select_chunks(self, chunks: List[List[str]], select_all: bool = False) -> List[List[Deal]]:
+        """
+        Select from every chunk, up to CONCURRENCY chunks at once
+        """
+        with ThreadPoolExecutor(max_workers=self.CONCURRENCY) as executor:
+            return list(executor.map(lambda chunk: self.select(chunk, select_all), chunks))
+
+    async def aselect_chunks(self, chunks: List[List[str]], select_all: bool = False) -> List[List[Deal]]:
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+
+        async def select(chunk: List[str]) -> List[Deal]:
+            async with semaphore:
+                return await self.aselect(chunk, select_all)
+
+        return list(await asyncio.gather(*(select(chunk) for chunk in chunks)))
+
+    def scan_gemini(self, memory: List[str] = [], select_all: bool = False) -> Optional[DealSelection]:
         """
         Call Gemini to provide a high potential list of deals with good descriptions and prices
+        The deals are selected chunk by chunk, up to CONCURRENCY chunks at once, and the selections merged;
+        unless select_all, the chunks' picks then go through further selection calls until 5 remain
         :param memory: a list of URLs representing deals already raised
+        :param select_all: return every new deal with a clear price, not just the best 5
         :return: a selection of good deals, or None if there aren't any
         """
         try:
-            # First fetch the deals
             scraped = self.fetch_deals(memory)
             if not scraped:
                 self.log("No new deals found to process")
                 return None
-            
-            # Create the user prompt with the scraped deals
-            user_prompt = self.make_user_prompt(scraped)
-            
-            # Combine system and user prompts for Gemini
-            full_prompt = f"{self.SYSTEM_PROMPT}\n\n{user_prompt}"
-            
-            self.log("Scanner Agent is calling Gemini")
-            model = genai.GenerativeModel(self.MODEL)
-            response = model.generate_content(full_prompt)
-            reply = response.text
-            
-            print("RAW Gemini reply:\n", repr(reply))  # Debug: show raw text
-            clean_text = self.extract_json(reply)
-            print("Cleaned JSON text:\n", clean_text)  # Debug: show stripped version
-            parsed = json.loads(clean_text)
-            print("Parsed JSON type:", type(parsed))  # Debug: show type
-            
-            # Determine deal list location
-            deals_data = None
-            if isinstance(parsed, dict):
-                print("Parsed keys:", parsed.keys())  # Extra debug
-                for key in ["selected_deals", "deals", "promising_deals"]:
-                    deals_data = parsed.get(key)
-                    if deals_data:
-                        break
-            elif isinstance(parsed, list):
-                deals_data = parsed
-            else:
-                raise ValueError("Parsed JSON is not a list or dict")
-            
-            if not deals_data:
-                raise ValueError("No deals found in parsed JSON")
-            
-            deals = [
-                Deal(
-                    title=deal.get("title", ""),  # Add default for title
-                    product_description=deal["product_description"],
-                    price=self.parse_price(deal["price"]),
-                    url=deal.get("url")  # Use .get() since URL might not exist
-                )
-                for deal in deals_data
-            ]
-            
-            # Filter out deals with price <= 0
-            deals = [deal for deal in deals if deal.price > 0]
-            self.log(f"Scanner Agent received {len(deals)} selected deals with price>0 from Gemini")
-            
-            return DealSelection(deals=deals)
-            
-        except json.JSONDecodeError as e:
-            self.log(f"❌ JSON parsing error: {e}")
-            print(f"❌ JSON parsing error: {e}")
+            detail = {scrape.url: len(scrape.describe()) for scrape in scraped}
+            chunks = list(self.chunks(self.describe(scrape) for scrape in scraped))
+            self.log(f"Scanner Agent is calling Gemini on {len(scraped)} deals in {len(chunks)} chunks")
+            deals = self.merge(self.select_chunks(chunks, select_all))
+            while not select_all and len(deals) > self.SELECTION_SIZE:
+                self.log(f"Scanner Agent is making a final selection from {len(deals)} deals")
+                chosen = self.select_chunks(list(self.chunks(self.finalist(deal) for deal in deals)))
+                deals = self.narrow(deals, chosen, detail)
+            return DealSelection(deals=deals) if deals else None
         except Exception as e:
             self.log(f"❌ Error in scan_gemini: {e}")
             print(f"❌ Error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+    async def afetch_deals(self, memory) -> List[ScrapedDeal]:
+        """
+        Like fetch_deals, but downloading the feeds and deal pages concurrently
+        """
+        self.log("Scanner Agent is about to fetch deals from RSS feed")
+        urls = [opp.deal.url for opp in memory]
+        with self.span("fetch_deals"):
+            scraped = await ScrapedDeal.afetch()
+        result = [scrape for scrape in scraped if scrape.url not in urls]
+        self.log(f"Scanner Agent received {len(result)} deals not already scraped")
+        return result
+
+    async def ascan(self, memory: List[str] = [], select_all: bool = False) -> Optional[DealSelection]:
+        """
+        The async variant of scan_gemini, using async HTTP and Gemini's async client
+        """
+        try:
+            scraped = await self.afetch_deals(memory)
+            if not scraped:
+                self.log("No new deals found to process")
+                return None
+            detail = {scrape.url: len(scrape.describe()) for scrape in scraped}
+            chunks = list(self.chunks(self.describe(scrape) for scrape in scraped))
+            self.log(f"Scanner Agent is calling Gemini on {len(scraped)} deals in {len(chunks)} chunks")
+            deals = self.merge(await self.aselect_chunks(chunks, select_all))
+            while not select_all and len(deals) > self.SELECTION_SIZE:
+                self.log(f"Scanner Agent is making a final selection from {len(deals)} deals")
+                chosen = await self.aselect_chunks(list(self.chunks(self.finalist(deal) for deal in deals)))
+                deals = self.narrow(deals, chosen, detail)
+            return DealSelection(deals=deals) if deals else None
+        except Exception as e:
+            self.log(f"❌ Error in ascan: {e}")
+            print(f"❌ Error: {e}")
+        return None
@@ -1,29 +1,220 @@
+import os
+import time
+import asyncio
+from typing import Dict, Tuple
 import modal
 from agents.agent import Agent
+from agents.model_store import ModelStore
+from agents.pricing_context import PricingContext
+from agents.specialist_head import SpecialistHead
+from agents.hedging import hedger, SpawnedCall
 
 
 class SpecialistAgent(Agent):
     """
     An Agent that runs our fine-tuned LLM that's running remotely on Modal
+    If Modal fails, or takes longer than SLO_SECONDS, the product is priced instead by a local linear head
+    over the MiniLM embeddings, trained to imitate the specialist; Modal is then skipped for COOLDOWN_SECONDS
+    so that a cold or unreachable container doesn't stall every deal in turn
+    Until a head has been published there is nothing to fall back on, so Modal is waited on without the SLO
     """
 
     name = "Specialist Agent"
     color = Agent.RED
 
-    def __init__(self):
+    MODEL = "pricer-service"
+    HEAD_MODEL = SpecialistHead.MODEL
+    SLO_SECONDS = float(os.getenv("SPECIALIST_SLO_SECONDS", "10"))
+    COOLDOWN_SECONDS = float(os.getenv("SPECIALIST_COOLDOWN_SECONDS", "60"))
+    # Set SPECIALIST_OFFLINE=1 to always use the local head, e.g. for development and CI without Modal
+    OFFLINE = os.getenv("SPECIALIST_OFFLINE", "0") == "1"
+    # Set SPECIALIST_HEDGE=duplicate to re-send slow Modal calls, or head to race the local head against them
+    HEDGE = os.getenv("SPECIALIST_HEDGE", "")
+
+    def __init__(self, store: ModelStore = None, vectorizer=None, offline: bool = None):
         """
         Set up this Agent by creating an instance of the modal class
+        :param store: the model store holding the local head (python training.py specialist)
+        :param vectorizer: an already-loaded encoder to share for the local head, e.g. the frontier agent's
         """
-        self.log("Specialist Agent is initializing - connecting to modal")
-        Pricer = modal.Cls.from_name("pricer-service", "Pricer")
-        self.pricer = Pricer()
+        self.store = store or ModelStore()
+        self.vectorizer = vectorizer
+        self.head = None
+        self.head_version = None
+        self.unavailable_until = 0.0
+        self.warned_no_head = False
+        self.pricer = None
+        self.hedge = self.HEDGE
+        if self.OFFLINE if offline is None else offline:
+            self.log("Specialist Agent is initializing - offline, pricing with the local head")
+        else:
+            self.log("Specialist Agent is initializing - connecting to modal")
+            try:
+                Pricer = modal.Cls.from_name("pricer-service", "Pricer")
+                self.pricer = Pricer()
+            except Exception as error:
+                self.log(f"Specialist Agent could not connect to modal ({error}) - using the local head")
         self.log("Specialist Agent is ready")
-        
-    def price(self, description: str) -> float:
+
+    def remote_available(self) -> bool:
+        return self.pricer is not None and time.monotonic() >= self.unavailable_until
+
+    def versions(self) -> Dict[str, object]:
+        """
+        The backend that would answer now - Modal, or the local head while Modal is unavailable -
+        and the version of the local head in the model store
+        """
+        current = self.store.current(SpecialistHead.STORE_NAME)
+        return {
+            "specialist": self.MODEL if self.remote_available() else self.HEAD_MODEL,
+            "specialist_head": current[0] if current else None,
+        }
+
+    def remote_failed(self, error: Exception) -> None:
+        """
+        Skip Modal for the cooldown after a failure or a missed SLO
+        """
+        self.unavailable_until = time.monotonic() + self.COOLDOWN_SECONDS
+        timed_out = isinstance(error, (TimeoutError, modal.exception.TimeoutError))
+        reason = f"no reply within {self.SLO_SECONDS:g}s" if timed_out else repr(error)
+        self.log(f"Specialist Agent remote call failed ({reason}) - using the local head for {self.COOLDOWN_SECONDS:g}s")
+
+    def load_head(self) -> SpecialistHead:
+        """
+        The local head, loaded on first use and reloaded when a new version is published
+        """
+        update = self.store.changed(SpecialistHead.STORE_NAME, self.head_version)
+        if update:
+            self.head = SpecialistHead.load(update[1])
+            self.head_version = update[0]
+            self.log(f"Specialist Agent is using local head version {update[0]}")
+        if self.head is None:
+            raise RuntimeError("No local specialist head has been trained; run python training.py specialist")
+        return self.head
+
+    def head_available(self) -> bool:
+        """
+        Whether there is a local head to fall back on, loading it if one has been published
+        """
+        try:
+            self.load_head()
+            return True
+        except RuntimeError:
+            if not self.warned_no_head:
+                self.log("Specialist Agent has no local head yet - waiting on modal without the SLO; "
+                         "run python training.py specialist to train one")
+                self.warned_no_head = True
+            return False
+
+    def predict_locally(self, description: str, context: PricingContext = None) -> float:
+        """
+        The local head's estimate, from the context's embedding if there is one
+        """
+        head = self.load_head()
+        if context:
+            vector = context.vector.reshape(1, -1)
+        else:
+            from agents.embeddings import get_encoder
+            self.vectorizer = self.vectorizer or get_encoder()
+            vector = self.vectorizer.encode([description])
+        return float(head.predict(vector)[0])
+
+    def price_locally(self, description: str, context: PricingContext = None) -> float:
         """
-        Make a remote call to return the estimate of the price of this item
+        Price with the local head, timed under HEAD_MODEL
         """
-        self.log("Specialist Agent is calling remote fine-tuned model")
-        result = self.pricer.price.remote(description)
-        self.log(f"Specialist Agent completed - predicting ${result:.2f}")
+        with self.span("price", model=self.HEAD_MODEL):
+            result = self.predict_locally(description, context)
+        self.log(f"Specialist Agent completed with the local head - predicting ${result:.2f}")
         return result
+
+    def attempts(self, description: str, context: PricingContext, asynchronous: bool = False):
+        """
+        The calls to hedge between: Modal, then either Modal again or the local head
+        Blocking Modal calls are spawned, so that the one that loses is cancelled on Modal
+        """
+        def remote():
+            if asynchronous:
+                return self.MODEL, lambda: self.pricer.price.remote.aio(description)
+            return self.MODEL, SpawnedCall(lambda: self.pricer.price.spawn(description), self.SLO_SECONDS)
+        if self.hedge == "duplicate":
+            return [remote(), remote()]
+        if asynchronous:
+            local = (self.HEAD_MODEL, lambda: asyncio.to_thread(self.predict_locally, description, context))
+        else:
+            local = (self.HEAD_MODEL, lambda: self.predict_locally(description, context))
+        return [remote(), local]
+
+    def call_remote(self, description: str, context: PricingContext) -> Tuple[float, str]:
+        """
+        Call Modal within the SLO, hedged if SPECIALIST_HEDGE is set; with no local head, wait as long as it takes
+        :return: the estimate, and which of MODEL and HEAD_MODEL produced it
+        """
+        if not self.head_available():
+            return self.pricer.price.remote(description), self.MODEL
+        if self.hedge:
+            return hedger.run(self.attempts(description, context), timeout=self.SLO_SECONDS)
+        call = self.pricer.price.spawn(description)
+        try:
+            return call.get(timeout=self.SLO_SECONDS), self.MODEL
+        except Exception:
+            call.cancel()
+            raise
+
+    async def acall_remote(self, description: str, context: PricingContext) -> Tuple[float, str]:
+        if not await asyncio.to_thread(self.head_available):
+            return await self.pricer.price.remote.aio(description), self.MODEL
+        if self.hedge:
+            return await hedger.arun(self.attempts(description, context, asynchronous=True), timeout=self.SLO_SECONDS)
+        return await asyncio.wait_for(self.pricer.price.remote.aio(description), self.SLO_SECONDS), self.MODEL
+
+    def estimate(self, description: str, context: PricingContext = None) -> Tuple[float, str]:
+        """
+        Make a remote call to estimate the price of this item,
+        or use the local head if Modal is unavailable or too slow
+        :param context: the pricing context for this description, whose embedding the local head uses
+        :return: the estimate, and which of MODEL and HEAD_MODEL produced it, so the head's estimates
+        can be kept out of the data that the head and the stacker are trained on
+        """
+        if self.remote_available():
+            self.log("Specialist Agent is calling remote fine-tuned model")
+            try:
+                with self.span("price", model=self.MODEL) as span:
+                    result, backend = self.call_remote(description, context)
+                    span.relabel(backend)
+                where = "on modal" if backend == self.MODEL else "with the local head, which won the hedge"
+                self.log(f"Specialist Agent completed {where} - predicting ${result:.2f}")
+                return result, backend
+            except Exception as error:
+                if self.head is None:
+                    raise
+                self.remote_failed(error)
+        return self.price_locally(description, context), self.HEAD_MODEL
+
+    async def aestimate(self, description: str, context: PricingContext = None) -> Tuple[float, str]:
+        """
+        The async variant of estimate, using Modal's async remote call
+        """
+        if self.remote_available():
+            self.log("Specialist Agent is calling remote fine-tuned model")
+            try:
+                with self.span("price", model=self.MODEL) as span:
+                    result, backend = await self.acall_remote(description, context)
+                    span.relabel(backend)
+                where = "on modal" if backend == self.MODEL else "with the local head, which won the hedge"
+                self.log(f"Specialist Agent completed {where} - predicting ${result:.2f}")
+                return result, backend
+            except Exception as error:
+                if self.head is None:
+                    raise
+                self.remote_failed(error)
+        return await asyncio.to_thread(self.price_locally, description, context), self.HEAD_MODEL
+
+    def price(self, description: str, context: PricingContext = None) -> float:
+        """
+        Estimate the price of this item, from Modal or the local head
+        """
+        return self.estimate(description, context)[0]
+
+    async def aprice(self, description: str, context: PricingContext = None) -> float:
+        return (await self.aestimate(description, context))[0]
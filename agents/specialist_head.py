@@ -0,0 +1,46 @@
+import os
+import numpy as np
+
+
+class SpecialistHead:
+    """
+    A local stand-in for the fine-tuned specialist: a ridge regression from the shared MiniLM embeddings
+    to the log of the price, fit on the specialist's own logged estimates (python training.py specialist)
+    It runs in microseconds on CPU, so SpecialistAgent falls back to it when Modal is slow or unreachable
+    """
+
+    FILENAME = "head.npz"
+    STORE_NAME = "specialist_head"
+    # The backend name recorded when the head, not Modal, gives the Specialist estimate
+    MODEL = "specialist-head"
+
+    def __init__(self, weights: np.ndarray, bias: float):
+        self.weights = weights.astype(np.float32)
+        self.bias = float(bias)
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, prices: np.ndarray, alpha: float = 1.0) -> "SpecialistHead":
+        """
+        Solve the ridge regression in closed form, on log1p prices
+        :param alpha: the L2 penalty on the weights
+        """
+        X = np.asarray(vectors, dtype=np.float64)
+        y = np.log1p(np.maximum(np.asarray(prices, dtype=np.float64), 0))
+        mean, target = X.mean(axis=0), y.mean()
+        centred = X - mean
+        weights = np.linalg.solve(centred.T @ centred + alpha * np.eye(X.shape[1]), centred.T @ (y - target))
+        return cls(weights, target - mean @ weights)
+
+    def predict(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        :return: array of shape (n,) of non-negative prices
+        """
+        return np.maximum(0.0, np.expm1(np.asarray(vectors, dtype=np.float32) @ self.weights + self.bias))
+
+    def save(self, directory: str) -> None:
+        np.savez(os.path.join(directory, self.FILENAME), weights=self.weights, bias=self.bias)
+
+    @classmethod
+    def load(cls, directory: str) -> "SpecialistHead":
+        with np.load(os.path.join(directory, cls.FILENAME)) as arrays:
+            return cls(arrays["weights"], float(arrays["bias"]))
@@ -0,0 +1,351 @@
+import os
+import sys
+import time
+import logging
+from typing import Dict, Optional, Tuple
+import numpy as np
+from agents.vector_store import iter_store, load_store
+
+# Set VECTOR_INDEX_PATH to a directory written by "python -m agents.vector_index build"
+# to answer RAG queries from the compact index rather than from Chroma's own HNSW index
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "")
+
+
+class VectorCompressor:
+    """
+    A compact encoding of the 384-d embeddings: an optional PCA projection to fewer dimensions,
+    then scalar quantisation of each dimension to float16 or int8
+    PCA subtracts the mean and rotates, so squared L2 distances in the reduced space approximate
+    the original ones; int8 keeps one scale per dimension, fitted to the largest absolute value seen
+    """
+
+    FILENAME = "compressor.npz"
+
+    def __init__(self, mean: np.ndarray, components: Optional[np.ndarray], dtype: str = "int8", scale: Optional[np.ndarray] = None):
+        """
+        :param mean: the mean embedding, shape (384,)
+        :param components: the PCA projection, shape (384, dimensions), or None to keep every dimension
+        :param dtype: "float16" or "int8"
+        :param scale: for int8, the size of one quantisation step in each reduced dimension
+        """
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unknown vector dtype {dtype}, expected float16 or int8")
+        self.mean = mean.astype(np.float32)
+        self.components = None if components is None else components.astype(np.float32)
+        self.dtype = dtype
+        self.scale = None if scale is None else scale.astype(np.float32)
+
+    @property
+    def dimensions(self) -> int:
+        return len(self.mean) if self.components is None else self.components.shape[1]
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, dimensions: Optional[int] = None, dtype: str = "int8") -> "VectorCompressor":
+        """
+        Fit the PCA and the quantisation scales on a sample of the embeddings
+        :param dimensions: the number of principal components to keep, or None for no reduction
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        mean = vectors.mean(axis=0)
+        components = None
+        if dimensions and dimensions < vectors.shape[1]:
+            _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+            components = vt[:dimensions].T
+        compressor = cls(mean, components, dtype)
+        if dtype == "int8":
+            largest = np.abs(compressor.project(vectors)).max(axis=0)
+            compressor.scale = np.maximum(largest, 1e-6) / 127
+        return compressor
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        :return: the float32 vectors in the reduced space; this is what the random forest is trained on
+        """
+        centred = np.asarray(vectors, dtype=np.float32) - self.mean
+        return centred if self.components is None else centred @ self.components
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        reduced = self.project(vectors)
+        if self.dtype == "int8":
+            return np.clip(np.rint(reduced / self.scale), -127, 127).astype(np.int8)
+        return reduced.astype(np.float16)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        decoded = codes.astype(np.float32)
+        return decoded * self.scale if self.dtype == "int8" else decoded
+
+    def save(self, directory: str) -> None:
+        arrays = {"mean": self.mean, "dtype": np.array(self.dtype)}
+        if self.components is not None:
+            arrays["components"] = self.components
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        np.savez(os.path.join(directory, self.FILENAME), **arrays)
+
+    @classmethod
+    def load(cls, directory: str) -> "VectorCompressor":
+        with np.load(os.path.join(directory, cls.FILENAME)) as arrays:
+            return cls(arrays["mean"], arrays["components"] if "components" in arrays else None,
+                       str(arrays["dtype"]), arrays["scale"] if "scale" in arrays else None)
+
+    @classmethod
+    def find(cls, directory: str) -> Optional["VectorCompressor"]:
+        """
+        The compressor saved in directory, or None if there isn't one
+        """
+        return cls.load(directory) if os.path.exists(os.path.join(directory, cls.FILENAME)) else None
+
+
+class CompactIndex:
+    """
+    A brute-force nearest neighbour index over the compressed embeddings, memory-mapped from disk
+    A query scans the compact codes for RERANK times as many candidates as were asked for,
+    then fetches those candidates' full-precision embeddings from Chroma and re-ranks them exactly,
+    so the neighbours and distances returned are Chroma's own whenever the true neighbours are among the candidates
+    It answers query() in Chroma's result format and passes every other call through to the collection,
+    so it can stand in for the collection wherever the agents take one
+    Queries may filter on category, as Chroma's where={"category": ...} or {"category": {"$in": [...]}}
+    """
+
+    RERANK = 10
+    # Rows of codes decoded at a time, to bound the float32 working set of a scan
+    BLOCK = 65536
+
+    def __init__(self, directory: str, collection, rerank: int = RERANK):
+        """
+        :param directory: the directory written by build
+        :param collection: the Chroma collection the index was built from, for documents and full-precision re-ranking
+        :param rerank: candidates fetched per neighbour asked for; 0 returns the approximate neighbours without re-ranking
+        """
+        self.directory = directory
+        self.collection = collection
+        self.rerank = rerank
+        self.compressor = VectorCompressor.load(directory)
+        self.codes = np.load(os.path.join(directory, "codes.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(directory, "norms.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        # Indexes built before category filtering have no categories; they still answer unfiltered queries
+        self.category_codes, self.category_names = None, None
+        if os.path.exists(os.path.join(directory, "categories.npy")):
+            self.category_codes = np.load(os.path.join(directory, "categories.npy"), mmap_mode="r")
+            self.category_names = [str(name) for name in np.load(os.path.join(directory, "category_names.npy"))]
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        categories = self.category_codes.nbytes if self.category_codes is not None else 0
+        return self.codes.nbytes + self.norms.nbytes + self.ids.nbytes + categories
+
+    @classmethod
+    def build(cls, collection, directory: str, dimensions: Optional[int] = 128, dtype: str = "int8",
+              fit_size: int = 20000, seed: int = 42) -> "CompactIndex":
+        """
+        Compress every embedding in the collection: fit the compressor on a random sample,
+        then stream the whole store through it
+        """
+        count = collection.count()
+        compressor = VectorCompressor.fit(load_store(collection, fit_size, seed=seed)[1], dimensions, dtype)
+        os.makedirs(directory, exist_ok=True)
+        codes = np.lib.format.open_memmap(os.path.join(directory, "codes.npy"), mode="w+",
+                                          dtype=np.dtype(dtype), shape=(count, compressor.dimensions))
+        norms = np.empty(count, dtype=np.float32)
+        ids, categories = [], []
+        row = 0
+        for chunk_ids, vectors, _, chunk_categories in iter_store(collection):
+            encoded = compressor.encode(vectors)
+            codes[row:row + len(encoded)] = encoded
+            norms[row:row + len(encoded)] = (compressor.decode(encoded) ** 2).sum(axis=1)
+            ids.extend(chunk_ids)
+            categories.extend(chunk_categories)
+            row += len(encoded)
+        codes.flush()
+        del codes
+        np.save(os.path.join(directory, "norms.npy"), norms[:row])
+        np.save(os.path.join(directory, "ids.npy"), np.array(ids, dtype=bytes))
+        names, codes = np.unique(np.array(categories, dtype=str), return_inverse=True)
+        np.save(os.path.join(directory, "category_names.npy"), names)
+        np.save(os.path.join(directory, "categories.npy"), codes.astype(np.uint8))
+        compressor.save(directory)
+        return cls(directory, collection)
+
+    def allowed(self, where: Optional[Dict]) -> Optional[np.ndarray]:
+        """
+        The rows a where filter on category lets through, as a boolean mask, or None for every row
+        """
+        if not where:
+            return None
+        if list(where) != ["category"]:
+            raise ValueError(f"CompactIndex can only filter on category, not {where}")
+        if self.category_codes is None:
+            raise ValueError(f"The index in {self.directory} has no categories; rebuild the index to filter on category "
+                             "(python -m agents.vector_index build)")
+        wanted = where["category"]
+        wanted = wanted["$in"] if isinstance(wanted, dict) else [wanted]
+        codes = [self.category_names.index(name) for name in wanted if name in self.category_names]
+        return np.isin(self.category_codes, codes)
+
+    def candidates(self, queries: np.ndarray, count: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scan the compact codes for the count nearest rows to each query
+        :param allowed: a boolean mask of the rows that may be returned
+        :return: the rows, shape (queries, count), and their approximate squared distances, both nearest first;
+        if fewer than count rows are allowed, the remainder have infinite distances
+        """
+        reduced = self.compressor.project(queries)
+        count = min(count, len(self.codes))
+        best_rows = np.empty((len(reduced), 0), dtype=np.int64)
+        best_distances = np.empty((len(reduced), 0), dtype=np.float32)
+        for start in range(0, len(self.codes), self.BLOCK):
+            block = self.compressor.decode(self.codes[start:start + self.BLOCK])
+            distances = self.norms[start:start + len(block)] - 2 * (reduced @ block.T)
+            if allowed is not None:
+                distances[:, ~allowed[start:start + len(block)]] = np.inf
+            rows = np.broadcast_to(np.arange(start, start + len(block)), distances.shape)
+            distances = np.concatenate([best_distances, distances], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            keep = np.argpartition(distances, count - 1, axis=1)[:, :count]
+            best_distances = np.take_along_axis(distances, keep, axis=1)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+        order = np.argsort(best_distances, axis=1)
+        best_distances += (reduced ** 2).sum(axis=1, keepdims=True)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_distances, order, axis=1)
+
+    def query(self, query_embeddings, n_results: int = 10, include=('documents', 'metadatas', 'distances'),
+              where: Optional[Dict] = None) -> Dict[str, list]:
+        """
+        Find the n_results nearest products to each query embedding
+        :param where: an optional filter on category
+        :return: a dict in the shape of Chroma's collection.query result
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, len(self.compressor.mean))
+        rows, distances = self.candidates(queries, n_results * max(self.rerank, 1), self.allowed(where))
+        found_rows = [query_rows[np.isfinite(query_distances)] for query_rows, query_distances in zip(rows, distances)]
+        fetch = ['documents', 'metadatas'] + (['embeddings'] if self.rerank else [])
+        ids = [identifier.decode() for identifier in self.ids[np.unique(np.concatenate(found_rows))]]
+        if not ids:
+            return {key: [[] for _ in queries] for key in ["ids", "documents", "metadatas", "distances"]
+                    if key == "ids" or key in include}
+        fetched = self.collection.get(ids=ids, include=fetch)
+        position = {identifier: i for i, identifier in enumerate(fetched['ids'])}
+        full = np.asarray(fetched['embeddings'], dtype=np.float32) if self.rerank else None
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for query, query_rows, query_distances in zip(queries, found_rows, distances):
+            query_distances = query_distances[:len(query_rows)]
+            found = [position[identifier.decode()] for identifier in self.ids[query_rows]]
+            if self.rerank:
+                query_distances = ((full[found] - query) ** 2).sum(axis=1)
+            nearest = np.argsort(query_distances, kind="stable")[:n_results]
+            chosen = [found[i] for i in nearest]
+            results["ids"].append([fetched['ids'][i] for i in chosen])
+            results["documents"].append([fetched['documents'][i] for i in chosen])
+            results["metadatas"].append([fetched['metadatas'][i] for i in chosen])
+            results["distances"].append([float(query_distances[i]) for i in nearest])
+        return {key: value for key, value in results.items() if key == "ids" or key in include}
+
+
+def open_collection(collection, path: str = VECTOR_INDEX_PATH, routing: bool = None):
+    """
+    The collection as the agents should query it: through the compact index if VECTOR_INDEX_PATH names one,
+    and through the category router if RAG_CATEGORY_ROUTING is set
+    An index built without categories can't filter on them, so routing is then turned off with a warning
+    """
+    from agents.category_router import CategoryRouter, RAG_CATEGORY_ROUTING
+    if path and os.path.isdir(path):
+        collection = CompactIndex(path, collection)
+    routing = RAG_CATEGORY_ROUTING if routing is None else routing
+    if routing and isinstance(collection, CompactIndex) and collection.category_codes is None:
+        logging.warning(f"Category routing is off: the index in {path} has no categories; "
+                        "rebuild it with python -m agents.vector_index build to route by category")
+        routing = False
+    if routing:
+        collection = CategoryRouter.load(collection)
+    return collection
+
+
+def collection_version(collection) -> Dict[str, object]:
+    """
+    What the kNN and RAG lookups currently see: the number of products in the store, when the compact index
+    in front of it was built, and which centroids the category router uses, so that estimates made from
+    an older view of the store can be told apart
+    """
+    import hashlib
+    from agents.category_router import CategoryRouter
+    version = {}
+    while isinstance(collection, (CompactIndex, CategoryRouter)):
+        if isinstance(collection, CompactIndex):
+            version["index"] = os.stat(os.path.join(collection.directory, "codes.npy")).st_mtime_ns
+        else:
+            version["routing"] = hashlib.sha256(collection.centroids.tobytes()).hexdigest()[:16]
+        collection = collection.collection
+    version["products"] = collection.count()
+    return version
+
+
+def benchmark(collection, index: CompactIndex, size: int = 250, k: int = 5, forest_sample: int = 20000) -> None:
+    """
+    Compare the compact index with Chroma on memory, query latency, recall of the true neighbours,
+    and Tester accuracy of a kNN pricer built on each; then compare random forests trained
+    on full and on reduced embeddings
+    """
+    import pickle
+    from sklearn.ensemble import RandomForestRegressor
+    from testing import Tester
+    from agents.embeddings import get_encoder
+    from agents.knn_price_agent import KnnPriceAgent
+    with open("test.pkl", "rb") as file:
+        test = pickle.load(file)[:size]
+    texts = [item.prompt.split("to the nearest dollar?\n\n")[1].split("\n\nPrice is $")[0] for item in test]
+    vectors = np.asarray(get_encoder().encode(texts), dtype=np.float32)
+    queries = vectors.astype(float).tolist()
+
+    rows = len(index)
+    print(f"{'Vectors':<24} {rows:,}")
+    print(f"{'float64 lists':<24} {rows * 384 * 8 / 2 ** 20:>10,.1f} MB")
+    print(f"{'float32 array':<24} {rows * 384 * 4 / 2 ** 20:>10,.1f} MB")
+    print(f"{f'Compact ({index.compressor.dimensions}d {index.compressor.dtype})':<24} {index.nbytes / 2 ** 20:>10,.1f} MB")
+
+    searches = {"Chroma": collection, "Compact": index, "Compact, no re-rank": CompactIndex(index.directory, collection, rerank=0)}
+    results = {}
+    print(f"{'Search':<24} {'ms/query':>10} {'Recall':>8}")
+    for title, searcher in searches.items():
+        start = time.perf_counter()
+        results[title] = searcher.query(query_embeddings=queries, n_results=k, include=['metadatas', 'distances'])
+        elapsed = (time.perf_counter() - start) * 1000 / size
+        recall = np.mean([len(set(found) & set(truth)) / k
+                          for found, truth in zip(results[title]["ids"], results["Chroma"]["ids"])])
+        print(f"{title:<24} {elapsed:>10,.2f} {recall:>7.1%}")
+
+    def pricer(estimates):
+        lookup = {item.prompt: estimate for item, estimate in zip(test, estimates)}
+        return lambda item: lookup[item.prompt]
+
+    Tester.compare({f"kNN, {title}": pricer([KnnPriceAgent.estimate([m['price'] for m in metadatas], distances)
+                                             for metadatas, distances in zip(results[title]["metadatas"], results[title]["distances"])])
+                    for title in searches}, test, size=size)
+
+    _, X, y, _ = load_store(collection, forest_sample)
+    compressor = VectorCompressor.fit(X, index.compressor.dimensions, index.compressor.dtype)
+    full = RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=-1).fit(X, y)
+    reduced = RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=-1).fit(compressor.project(X), y)
+    forests = {"RF, 384d": full.predict(vectors),
+               f"RF, {compressor.dimensions}d": reduced.predict(compressor.project(vectors))}
+    Tester.compare({title: pricer(predictions) for title, predictions in forests.items()}, test, size=size)
+
+
+if __name__ == "__main__":
+    import chromadb
+    task = sys.argv[1] if len(sys.argv) > 1 else "benchmark"
+    path = VECTOR_INDEX_PATH or "vector_index"
+    collection = chromadb.PersistentClient(path="products_vectorstore").get_or_create_collection('products')
+    if task == "build":
+        dimensions = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+        dtype = sys.argv[3] if len(sys.argv) > 3 else "int8"
+        index = CompactIndex.build(collection, path, dimensions or None, dtype)
+        print(f"Built {len(index):,} vectors into {path}: {index.nbytes / 2 ** 20:,.1f} MB")
+    if task == "benchmark":
+        benchmark(collection, CompactIndex(path, collection))
@@ -0,0 +1,132 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+CHUNK_SIZE = 5000
+
+# (ids, float32 embeddings of shape (n, 384), float32 prices, categories), each an array of n rows
+Chunk = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def scan_categories(collection, chunk_size: int = CHUNK_SIZE) -> Tuple[List[str], np.ndarray]:
+    """
+    Read only the metadata of the whole store, without its embeddings
+    :return: the category names, and the index into them of every row's category, in store order
+    """
+    names: Dict[str, int] = {}
+    codes = []
+    offset = 0
+    while True:
+        result = collection.get(include=['metadatas'], limit=chunk_size, offset=offset)
+        if not len(result['ids']):
+            break
+        codes.append(np.array([names.setdefault(metadata.get('category', ''), len(names))
+                               for metadata in result['metadatas']], dtype=np.uint16))
+        offset += len(result['ids'])
+    return list(names), np.concatenate(codes) if codes else np.empty(0, dtype=np.uint16)
+
+
+def quotas(counts: np.ndarray, size: int) -> np.ndarray:
+    """
+    Share size rows as evenly as possible between the categories; a category with fewer rows
+    than its share gives all of them, and the rest of its share goes to the others
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    result = np.zeros_like(counts)
+    remaining = min(size, int(counts.sum()))
+    while remaining > 0:
+        open_ = np.flatnonzero(result < counts)
+        share = remaining // len(open_)
+        if share == 0:
+            largest = open_[np.argsort(-(counts - result)[open_], kind="stable")][:remaining]
+            result[largest] += 1
+            break
+        added = np.minimum(share, counts[open_] - result[open_])
+        result[open_] += added
+        remaining -= int(added.sum())
+    return result
+
+
+def sample_mask(collection, size: int, stratify: bool = False, chunk_size: int = CHUNK_SIZE, seed: int = 42) -> np.ndarray:
+    """
+    Choose size rows of the store at random, in one pass over its metadata
+    :param stratify: take equal numbers from each category rather than sampling uniformly
+    :return: a boolean mask over the rows, in store order
+    """
+    rng = np.random.default_rng(seed)
+    if stratify:
+        names, codes = scan_categories(collection, chunk_size)
+        mask = np.zeros(len(codes), dtype=bool)
+        for code, quota in enumerate(quotas(np.bincount(codes, minlength=len(names)), size)):
+            mask[rng.choice(np.flatnonzero(codes == code), quota, replace=False)] = True
+        return mask
+    count = collection.count()
+    mask = np.zeros(count, dtype=bool)
+    mask[rng.choice(count, min(size, count), replace=False)] = True
+    return mask
+
+
+def _read(collection, chunk_size: int, mask: Optional[np.ndarray]) -> Iterator[Chunk]:
+    offset = 0
+    while True:
+        result = collection.get(include=['embeddings', 'metadatas'], limit=chunk_size, offset=offset)
+        count = len(result['ids'])
+        if not count:
+            break
+        keep = slice(None) if mask is None else np.flatnonzero(mask[offset:offset + count])
+        offset += count
+        if mask is not None and not len(keep):
+            continue
+        ids = np.array(result['ids'])[keep]
+        vectors = np.asarray(result['embeddings'], dtype=np.float32)[keep]
+        metadatas = result['metadatas']
+        prices = np.array([metadata['price'] for metadata in metadatas], dtype=np.float32)[keep]
+        categories = np.array([metadata.get('category', '') for metadata in metadatas])[keep]
+        yield ids, vectors, prices, categories
+
+
+def iter_store(collection, chunk_size: int = CHUNK_SIZE, sample: Optional[int] = None, stratify: bool = False,
+               seed: int = 42) -> Iterator[Chunk]:
+    """
+    Stream the vector store as numpy chunks of chunk_size rows (the last may be shorter),
+    so that memory is bounded by the chunk size rather than by the size of the store
+    :param sample: if given, stream only this many rows, chosen at random in a first pass over the metadata
+    :param stratify: sample equally from each category
+    """
+    if stratify and not sample:
+        raise ValueError("Stratified sampling needs a sample size")
+    mask = sample_mask(collection, sample, stratify, chunk_size, seed) if sample else None
+    pending: List[Chunk] = []
+    buffered = 0
+    for chunk in _read(collection, chunk_size, mask):
+        pending.append(chunk)
+        buffered += len(chunk[0])
+        if buffered >= chunk_size:
+            joined = [np.concatenate(parts) for parts in zip(*pending)]
+            yield tuple(part[:chunk_size] for part in joined)
+            pending = [tuple(part[chunk_size:] for part in joined)]
+            buffered -= chunk_size
+    if buffered:
+        yield tuple(np.concatenate(parts) for parts in zip(*pending))
+
+
+def load_store(collection, sample: Optional[int] = None, stratify: bool = False, chunk_size: int = CHUNK_SIZE,
+               seed: int = 42) -> Chunk:
+    """
+    Read the whole store, or a sample of it, into arrays allocated once at their final size,
+    so the peak is the result plus one chunk rather than several copies of the store
+    """
+    total = min(sample, collection.count()) if sample else collection.count()
+    ids = np.empty(total, dtype=object)
+    prices = np.empty(total, dtype=np.float32)
+    categories = np.empty(total, dtype=object)
+    vectors = None
+    row = 0
+    for chunk_ids, chunk_vectors, chunk_prices, chunk_categories in iter_store(collection, chunk_size, sample, stratify, seed):
+        if vectors is None:
+            vectors = np.empty((total, chunk_vectors.shape[1]), dtype=np.float32)
+        end = row + len(chunk_ids)
+        ids[row:end], vectors[row:end], prices[row:end], categories[row:end] = chunk_ids, chunk_vectors, chunk_prices, chunk_categories
+        row = end
+    if vectors is None:
+        vectors = np.empty((0, 0), dtype=np.float32)
+    return ids[:row].astype(str), vectors[:row], prices[:row], categories[:row].astype(str)
@@ -0,0 +1,156 @@
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Tuple
+import numpy as np
+from agents.embeddings import EMBEDDING_BACKEND
+
+# Set PRICER_WORKERS to a number of processes to run embedding and tree inference in a worker pool
+PRICER_WORKERS = int(os.getenv("PRICER_WORKERS", "0"))
+DIMENSIONS = 384
+
+# State held by each worker process for its whole life
+_encoder = None
+# The forest last loaded, as (model_path, model); a new published version replaces it
+_model: Optional[Tuple[str, object]] = None
+
+
+def _init_worker(backend: str) -> None:
+    """
+    Load the encoder once per worker, with one thread each, since the parallelism comes from the processes
+    """
+    global _encoder
+    if backend == "onnx":
+        from agents.embeddings import OnnxEncoder
+        _encoder = OnnxEncoder(threads=1)
+    else:
+        import torch
+        from agents.embeddings import get_encoder
+        torch.set_num_threads(1)
+        _encoder = get_encoder(backend)
+
+
+def _attach(name: str, shape: Tuple[int, ...], dtype) -> Tuple[SharedMemory, np.ndarray]:
+    block = SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _encode(texts: List[str], output: str, shape: Tuple[int, int], start: int) -> None:
+    """
+    Encode texts straight into rows start: of the shared output array
+    """
+    block, vectors = _attach(output, shape, np.float32)
+    try:
+        vectors[start:start + len(texts)] = _encoder.encode(texts)
+    finally:
+        del vectors
+        block.close()
+
+
+def _predict(model_path: str, inputs: str, shape: Tuple[int, int], start: int, stop: int, output: str) -> None:
+    """
+    Run the forest at model_path over rows start:stop of the shared input array, writing into the shared output
+    Each worker keeps only the model it loaded last, so a superseded version is released once the next is used;
+    compact forests are memory-mapped, so workers share their pages
+    """
+    global _model
+    from agents.random_forest_agent import RandomForestAgent
+    if _model is None or _model[0] != model_path:
+        _model = None  # release the old forest before loading the new one
+        _model = (model_path, RandomForestAgent.load_model(model_path))
+    model = _model[1]
+    in_block, vectors = _attach(inputs, shape, np.float32)
+    out_block, predictions = _attach(output, (shape[0],), np.float64)
+    try:
+        predictions[start:stop] = model.predict(vectors[start:stop])
+    finally:
+        del vectors, predictions
+        in_block.close()
+        out_block.close()
+
+
+class WorkerPool:
+    """
+    Long-lived worker processes for the CPU-bound pricing stages: sentence embedding and random forest inference
+    Each worker loads its models once; batches are split across the workers, and vectors and predictions
+    travel through shared memory as numpy buffers rather than as pickled lists
+    A pool can stand in for a SentenceTransformer wherever only encode(texts) is called
+    """
+
+    # Batches smaller than this are split into fewer chunks, as each chunk costs a round trip
+    MIN_CHUNK = 16
+
+    def __init__(self, processes: int, backend: str = None):
+        """
+        :param backend: the embedding backend for the workers, by default EMBEDDING_BACKEND
+        """
+        context = multiprocessing.get_context("spawn")
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(processes, mp_context=context, initializer=_init_worker,
+                                            initargs=(backend or EMBEDDING_BACKEND,))
+
+    def chunks(self, count: int) -> List[Tuple[int, int]]:
+        size = max(self.MIN_CHUNK, -(-count // self.processes))
+        return [(start, min(start + size, count)) for start in range(0, count, size)]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts across the workers
+        :return: array of shape (n, 384) of float32
+        """
+        shape = (len(texts), DIMENSIONS)
+        block = SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 4))
+        try:
+            futures = [self.executor.submit(_encode, texts[start:stop], block.name, shape, start)
+                       for start, stop in self.chunks(len(texts))]
+            for future in futures:
+                future.result()
+            return np.ndarray(shape, dtype=np.float32, buffer=block.buf).copy()
+        finally:
+            block.close()
+            block.unlink()
+
+    def predict(self, model_path: str, vectors: np.ndarray) -> np.ndarray:
+        """
+        Run the random forest saved at model_path over the vectors, across the workers
+        :return: array of shape (n,) of predictions
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        shape = vectors.shape
+        inputs = SharedMemory(create=True, size=max(1, vectors.nbytes))
+        output = SharedMemory(create=True, size=max(1, shape[0] * 8))
+        try:
+            np.ndarray(shape, dtype=np.float32, buffer=inputs.buf)[:] = vectors
+            futures = [self.executor.submit(_predict, model_path, inputs.name, shape, start, stop, output.name)
+                       for start, stop in self.chunks(shape[0])]
+            for future in futures:
+                future.result()
+            return np.ndarray((shape[0],), dtype=np.float64, buffer=output.buf).copy()
+        finally:
+            for block in (inputs, output):
+                block.close()
+                block.unlink()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+_pool: Optional[WorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Optional[WorkerPool]:
+    """
+    The process-wide worker pool, started on first use, or None when PRICER_WORKERS is 0
+    """
+    global _pool
+    if PRICER_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(PRICER_WORKERS)
+            atexit.register(_pool.shutdown)
+        return _pool
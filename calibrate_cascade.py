@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import pickle
+import itertools
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from tqdm import tqdm
+from testing import Tester
+from agents.cascade import CascadeThresholds, TIER_COST, local_estimate, local_is_confident, specialist_is_confident
+
+DB = "products_vectorstore"
+RECORDS_FILENAME = "cascade_calibration.json"
+
+
+def description(item):
+    return item.prompt.split("to the nearest dollar?\n\n")[1].split("\n\nPrice is $")[0]
+
+
+def collect(ensemble, items, filename: str = RECORDS_FILENAME) -> List[Dict]:
+    """
+    Run every tier of the ensemble once for each test item and record the raw outputs,
+    so thresholds can then be searched offline without calling any model again
+    The records are cached in a json file, and only missing items are priced
+    """
+    records = []
+    if os.path.exists(filename):
+        with open(filename, "r") as file:
+            records = json.load(file)
+    for item in tqdm(items[len(records):]):
+        text = description(item)
+        context = ensemble.frontier.context_for(text)
+        random_forest = ensemble.random_forest.price(text, context=context)
+        knn = ensemble.knn.price(text, context=context)
+        specialist = ensemble.specialist.price(text, context=context)
+        frontier = ensemble.frontier.price(text, context=context)
+        components = {'Specialist': specialist, 'Frontier': frontier, 'RandomForest': random_forest, 'Knn': knn}
+        full = float(ensemble.combine(components)[0])
+        records.append({
+            "truth": item.price,
+            "random_forest": random_forest,
+            "knn": knn,
+            "distance": float(np.mean(context.distances)),
+            "specialist": specialist,
+            "full": full,
+        })
+        with open(filename, "w") as file:
+            json.dump(records, file)
+    return records
+
+
+def simulate(record: Dict, thresholds: CascadeThresholds) -> Tuple[float, str]:
+    """
+    The answer and tier the cascade would have produced for one record
+    """
+    local = local_estimate(record["random_forest"], record["knn"])
+    if local_is_confident(record["random_forest"], record["knn"], record["distance"], thresholds):
+        return local, "local"
+    if specialist_is_confident(record["specialist"], local, thresholds):
+        return record["specialist"], "specialist"
+    return record["full"], "frontier"
+
+
+def evaluate(records: List[Dict], thresholds: Optional[CascadeThresholds], tester: Tester) -> Dict:
+    """
+    Hit rate (Tester's "green"), average error and average relative cost of a set of thresholds
+    With thresholds=None, every item goes through the full ensemble
+    """
+    if not records:
+        raise ValueError("No calibration records to evaluate; check that test.pkl has items and the size argument is positive")
+    hits, errors, cost = 0, 0.0, 0.0
+    tiers = {tier: 0 for tier in TIER_COST}
+    for record in records:
+        guess, tier = simulate(record, thresholds) if thresholds else (record["full"], "frontier")
+        error = abs(guess - record["truth"])
+        hits += tester.color_for(error, record["truth"]) == "green"
+        errors += error
+        cost += TIER_COST[tier]
+        tiers[tier] += 1
+    size = len(records)
+    return {"hits": hits / size, "error": errors / size, "cost": cost / size, "tiers": tiers}
+
+
+def calibrate(records: List[Dict], tester: Tester, max_hit_loss: float = 0.01) -> Tuple[CascadeThresholds, Dict]:
+    """
+    Grid search for the cheapest thresholds whose hit rate is within max_hit_loss of the full ensemble
+    """
+    baseline = evaluate(records, None, tester)
+    target = baseline["hits"] - max_hit_loss
+    distances = np.array([record["distance"] for record in records])
+    gaps = np.linspace(0.05, 1.0, 20)
+    distance_cuts = np.quantile(distances, np.linspace(0.1, 1.0, 10))
+    best, best_result = CascadeThresholds(local_disagreement=0, local_distance=0, specialist_disagreement=0), baseline
+    for local_gap, distance_cut, specialist_gap in itertools.product(gaps, distance_cuts, gaps):
+        thresholds = CascadeThresholds(local_disagreement=float(local_gap), local_distance=float(distance_cut),
+                                       specialist_disagreement=float(specialist_gap))
+        result = evaluate(records, thresholds, tester)
+        if result["hits"] < target:
+            continue
+        if (result["cost"], result["error"]) < (best_result["cost"], best_result["error"]):
+            best, best_result = thresholds, result
+    return best, best_result
+
+
+if __name__ == "__main__":
+    import chromadb
+    from dotenv import load_dotenv
+    from agents.ensemble_agent import EnsembleAgent
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+    max_hit_loss = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    load_dotenv(override=True)
+    with open('test.pkl', 'rb') as file:
+        test = pickle.load(file)[:size]
+    collection = chromadb.PersistentClient(path=DB).get_or_create_collection('products')
+    ensemble = EnsembleAgent(collection, cascade=False)
+    records = collect(ensemble, test)[:size]
+    tester = Tester(lambda item: 0, test, title="Cascade", size=size)
+    print(f"Full ensemble: {evaluate(records, None, tester)}")
+    thresholds, result = calibrate(records, tester, max_hit_loss)
+    print(f"Cascade: {result}")
+    thresholds.save()
+    print(f"Saved {thresholds} to cascade_thresholds.json")
@@ -2,12 +2,18 @@ import os
 import sys
 import logging
 import json
-from typing import List, Optional
+import time
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
 from twilio.rest import Client
 from dotenv import load_dotenv
 import chromadb
 from agents.planning_agent import PlanningAgent
 from agents.deals import Opportunity
+from agents.metrics import registry
+from agents.vector_index import open_collection
+from agents.vector_store import load_store
 from sklearn.manifold import TSNE
 import numpy as np
 
@@ -38,56 +44,141 @@ class DealAgentFramework:
 
     DB = "products_vectorstore"
     MEMORY_FILENAME = "memory.json"
+    # Set ASYNC_AGENTS=1 to plan with arun, on one event loop, rather than run
+    ASYNC_AGENTS = os.getenv("ASYNC_AGENTS", "0") == "1"
+    SORT_KEYS = {
+        "created": lambda opp: opp.created or 0.0,
+        "discount": lambda opp: opp.discount,
+    }
 
     def __init__(self):
         init_logging()
         load_dotenv()
         client = chromadb.PersistentClient(path=self.DB)
+        # Guards self.memory and memory.json; several UI sessions may read while a run writes
+        self.memory_lock = threading.RLock()
+        self.agents_lock = threading.Lock()
         self.memory = self.read_memory()
-        self.collection = client.get_or_create_collection('products')
+        self.index_memory()
+        # With VECTOR_INDEX_PATH set, RAG queries go to the compact index, re-ranked against Chroma
+        self.collection = open_collection(client.get_or_create_collection('products'))
         self.planner = None
+        metrics_port = os.getenv("AGENT_METRICS_PORT")
+        if metrics_port and registry.enabled:
+            registry.serve(int(metrics_port))
 
     def init_agents_as_needed(self):
-        if not self.planner:
-            self.log("Initializing Agent Framework")
-            self.planner = PlanningAgent(self.collection)
-            self.log("Agent Framework is ready")
+        with self.agents_lock:
+            if not self.planner:
+                self.log("Initializing Agent Framework")
+                self.planner = PlanningAgent(self.collection)
+                self.log("Agent Framework is ready")
         
     def read_memory(self) -> List[Opportunity]:
         if os.path.exists(self.MEMORY_FILENAME):
             with open(self.MEMORY_FILENAME, "r") as file:
                 data = json.load(file)
             opportunities = [Opportunity(**item) for item in data]
+            for opportunity in opportunities:
+                if not opportunity.id:
+                    opportunity.id = Opportunity.make_id(opportunity.deal.url, opportunity.deal.product_description)
             return opportunities
         return []
 
+    def index_memory(self) -> None:
+        """
+        Rebuild the lookup by id and drop any cached sort orders
+        """
+        self.by_id: Dict[str, Opportunity] = {opportunity.id: opportunity for opportunity in self.memory}
+        self.sorted_cache: Dict[Tuple[str, bool], List[Opportunity]] = {}
+
+    def add_opportunity(self, opportunity: Opportunity) -> None:
+        opportunity.id = opportunity.id or Opportunity.make_id(opportunity.deal.url, opportunity.deal.product_description)
+        opportunity.created = opportunity.created or time.time()
+        with self.memory_lock:
+            self.memory.append(opportunity)
+            self.by_id[opportunity.id] = opportunity
+            self.sorted_cache = {}
+
+    def query_opportunities(self, page: int = 0, page_size: int = 10, sort_by: str = "created", descending: bool = True) -> Tuple[List[Opportunity], int]:
+        """
+        Return one page of stored opportunities, sorted server-side, and the total count
+        The sorted order is cached until a new opportunity is added
+        :param page: zero-based page number
+        :param sort_by: "created" or "discount"
+        """
+        key = (sort_by, descending)
+        with self.memory_lock:
+            ordered = self.sorted_cache.get(key)
+            if ordered is None:
+                sort_key = self.SORT_KEYS[sort_by]
+                # Ties (e.g. older opportunities saved without a created time) keep their order in memory
+                positions = sorted(range(len(self.memory)), key=lambda i: (sort_key(self.memory[i]), i), reverse=descending)
+                ordered = [self.memory[i] for i in positions]
+                self.sorted_cache[key] = ordered
+        start = max(0, page) * page_size
+        return ordered[start:start + page_size], len(ordered)
+
+    def get_opportunity(self, opportunity_id: str) -> Optional[Opportunity]:
+        return self.by_id.get(opportunity_id)
+
     def write_memory(self) -> None:
-        data = [opportunity.dict() for opportunity in self.memory]
-        with open(self.MEMORY_FILENAME, "w") as file:
-            json.dump(data, file, indent=2)
+        """
+        Write memory.json under the memory lock, via a temporary file so readers never see half of it
+        """
+        with self.memory_lock:
+            data = [opportunity.dict() for opportunity in self.memory]
+            temporary = self.MEMORY_FILENAME + ".tmp"
+            with open(temporary, "w") as file:
+                json.dump(data, file, indent=2)
+            os.replace(temporary, self.MEMORY_FILENAME)
 
     def log(self, message: str):
+        if not logging.root.isEnabledFor(logging.INFO):
+            return
         text = BG_BLUE + WHITE + "[Agent Framework] " + message + RESET
         logging.info(text)
 
     def run(self) -> List[Opportunity]:
         self.init_agents_as_needed()
         logging.info("Kicking off Planning Agent")
-        result = self.planner.plan(memory=self.memory)
+        with self.memory_lock:
+            memory = list(self.memory)
+        result = self.planner.plan(memory=memory)
+        logging.info(f"Planning Agent has completed and returned: {result}")
+        if result:
+            with self.memory_lock:
+                self.add_opportunity(result)
+                self.write_memory()
+        with self.memory_lock:
+            return list(self.memory)
+
+    async def arun(self) -> List[Opportunity]:
+        """
+        Like run, but with the whole plan scheduled on the running event loop:
+        feeds, deal pages and model calls are awaited concurrently rather than one after another
+        """
+        await asyncio.to_thread(self.init_agents_as_needed)
+        logging.info("Kicking off Planning Agent")
+        with self.memory_lock:
+            memory = list(self.memory)
+        result = await self.planner.aplan(memory=memory)
         logging.info(f"Planning Agent has completed and returned: {result}")
         if result:
-            self.memory.append(result)
-            self.write_memory()
-        return self.memory
+            with self.memory_lock:
+                self.add_opportunity(result)
+                self.write_memory()
+        with self.memory_lock:
+            return list(self.memory)
 
     @classmethod
     def get_plot_data(cls, max_datapoints=10000):
         client = chromadb.PersistentClient(path=cls.DB)
         collection = client.get_or_create_collection('products')
-        result = collection.get(include=['embeddings', 'documents', 'metadatas'], limit=max_datapoints)
-        vectors = np.array(result['embeddings'])
-        documents = result['documents']
-        categories = [metadata['category'] for metadata in result['metadatas']]
+        ids, vectors, _, categories = load_store(collection, sample=max_datapoints, stratify=True)
+        result = collection.get(ids=list(ids), include=['documents'])
+        documents_by_id = dict(zip(result['ids'], result['documents']))
+        documents = [documents_by_id[identifier] for identifier in ids]
         colors = [COLORS[CATEGORIES.index(c)] for c in categories]
         tsne = TSNE(n_components=3, random_state=42, n_jobs=-1)
         reduced_vectors = tsne.fit_transform(vectors)
@@ -95,5 +186,8 @@ class DealAgentFramework:
 
 
 if __name__=="__main__":
-    DealAgentFramework().run()
+    if DealAgentFramework.ASYNC_AGENTS:
+        asyncio.run(DealAgentFramework().arun())
+    else:
+        DealAgentFramework().run()
     
\ No newline at end of file
@@ -1,3 +1,9 @@
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from typing import List, Tuple
+
 # Foreground colors
 RED = '\033[31m'
 GREEN = '\033[32m'
@@ -31,5 +37,72 @@ def reformat(message):
         message = message.replace(key, f'<span style="color: {value}">')
     message = message.replace(RESET, '</span>')
     return message
-    
-    
\ No newline at end of file
+
+
+class LogStream(logging.Handler):
+    """
+    A single root-logger handler that keeps the most recent log lines, already
+    converted to HTML, in a bounded ring buffer
+    Readers block until something new arrives and only receive the lines they haven't seen,
+    so memory and per-message work stay flat no matter how long the app runs
+    """
+
+    def __init__(self, capacity: int = 200):
+        super().__init__(level=logging.INFO)
+        self.lines = deque(maxlen=capacity)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.setFormatter(logging.Formatter(
+            "[%(asctime)s] %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S %z",
+        ))
+
+    def emit(self, record):
+        try:
+            line = reformat(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        with self.condition:
+            self.sequence += 1
+            self.lines.append(line)
+            self.condition.notify_all()
+
+    def since(self, sequence: int) -> Tuple[int, List[str]]:
+        """
+        Return the latest sequence number and the lines logged after the given one
+        (or as many of them as are still in the buffer)
+        """
+        with self.condition:
+            missing = min(self.sequence - sequence, len(self.lines))
+            new_lines = list(islice(reversed(self.lines), missing))[::-1]
+            return self.sequence, new_lines
+
+    def wait(self, sequence: int, timeout: float = 1.0) -> Tuple[int, List[str]]:
+        """
+        Block until there are lines after the given sequence number, or the timeout passes
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > sequence, timeout)
+        return self.since(sequence)
+
+    def notify(self):
+        """
+        Wake up every waiting reader, e.g. when a run has finished
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    @classmethod
+    def install(cls, capacity: int = 200) -> "LogStream":
+        """
+        Attach one LogStream to the root logger, reusing it if one is already attached
+        """
+        root = logging.getLogger()
+        for handler in root.handlers:
+            if isinstance(handler, cls):
+                return handler
+        handler = cls(capacity)
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        return handler
@@ -0,0 +1,224 @@
+import os
+import re
+import sys
+import time
+import shutil
+import modal
+from modal import Volume, Image
+
+# When this container (or local process) started, to measure the cold start
+STARTED = time.time()
+
+# Setup - define our infrastructure with code!
+
+app = modal.App("pricer-service")
+image = Image.debian_slim().pip_install("huggingface", "torch", "transformers", "bitsandbytes", "accelerate", "peft", "safetensors")
+
+# This collects the secret from Modal.
+# Depending on your Modal configuration, you may need to replace "hf-secret" with "huggingface-secret"
+secrets = [modal.Secret.from_name("hf-secret")]
+
+# Constants
+GPU = "T4"
+BASE_MODEL = "meta-llama/Meta-Llama-3.1-8B"
+PROJECT_NAME = "pricer"
+HF_USER = "ed-donner"
+RUN_NAME = "2024-09-13_13.04.39"
+PROJECT_RUN_NAME = f"{PROJECT_NAME}-{RUN_NAME}"
+REVISION = "e8d637df551603dc86cd7a1598a8f44af4d7ae36"
+FINETUNED_MODEL = f"{HF_USER}/{PROJECT_RUN_NAME}"
+CACHE_DIR = "/cache"
+# The merged, pre-quantised model, written once to the cache volume
+SNAPSHOT_DIR = f"{CACHE_DIR}/snapshots/{PROJECT_RUN_NAME}-{REVISION[:8]}"
+
+# Change this to 1 if you want Modal to be always running, otherwise it will go cold after SCALEDOWN_WINDOW seconds
+MIN_CONTAINERS = 0
+SCALEDOWN_WINDOW = 300
+
+QUESTION = "How much does this cost to the nearest dollar?"
+PREFIX = "Price is $"
+
+hf_cache_volume = Volume.from_name("hf-hub-cache", create_if_missing=True)
+
+
+def quant_config():
+    import torch
+    from transformers import BitsAndBytesConfig
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_compute_dtype=torch.bfloat16,
+        bnb_4bit_quant_type="nf4"
+    )
+
+
+def build_snapshot(path: str, base_model: str = BASE_MODEL, adapter: str = FINETUNED_MODEL,
+                   revision: str = REVISION, quantize: bool = True) -> str:
+    """
+    Merge the LoRA adapter into the full-precision base weights, once, and save the result as safetensors
+    With quantize, the merged model is then quantised to 4 bits and saved that way, so that
+    loading it needs neither the adapter nor a fresh quantisation pass
+    The snapshot is written beside path and renamed into place, so a half-written one is never loaded
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from peft import PeftModel
+    staging = f"{path}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    base = AutoModelForCausalLM.from_pretrained(base_model, dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    merged = PeftModel.from_pretrained(base, adapter, revision=revision).merge_and_unload()
+    if quantize:
+        full_precision = f"{path}.merged"
+        merged.save_pretrained(full_precision, safe_serialization=True)
+        del base, merged
+        merged = AutoModelForCausalLM.from_pretrained(full_precision, quantization_config=quant_config(), device_map="auto")
+    merged.save_pretrained(staging, safe_serialization=True)
+    AutoTokenizer.from_pretrained(base_model).save_pretrained(staging)
+    if quantize:
+        shutil.rmtree(full_precision)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(staging, path)
+    return path
+
+
+def has_snapshot(path: str) -> bool:
+    return os.path.exists(os.path.join(path, "config.json"))
+
+
+class WarmPricer:
+    """
+    The fine-tuned pricer loaded from a merged snapshot
+    from_pretrained memory-maps the safetensors files, and a pre-quantised snapshot carries its
+    quantisation config, so start-up is a read of the weights rather than a rebuild of the model
+    Records how long loading took, and the time to the first generated token of each call
+    """
+
+    def __init__(self, path: str, device: str = None):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        start = time.perf_counter()
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.model = AutoModelForCausalLM.from_pretrained(path, device_map=self.device)
+        self.model.eval()
+        self.load_seconds = time.perf_counter() - start
+        self.first_call_first_token = None
+        self.last_first_token = None
+        self.calls = 0
+
+    def streamer(self, start: float):
+        """
+        A streamer that notes when generate produces its first new token; the first put is the prompt
+        """
+        from transformers.generation.streamers import BaseStreamer
+        pricer = self
+
+        class FirstTokenTimer(BaseStreamer):
+            puts = 0
+
+            def put(self, value):
+                self.puts += 1
+                if self.puts == 2:
+                    pricer.last_first_token = time.perf_counter() - start
+
+            def end(self):
+                pass
+        return FirstTokenTimer()
+
+    def price(self, description: str) -> float:
+        import torch
+        from transformers import set_seed
+        set_seed(42)
+        start = time.perf_counter()
+        prompt = f"{QUESTION}\n\n{description}\n\n{PREFIX}"
+        inputs = self.tokenizer.encode(prompt, return_tensors="pt").to(self.model.device)
+        attention_mask = torch.ones(inputs.shape, device=self.model.device)
+        with torch.inference_mode():
+            outputs = self.model.generate(inputs, attention_mask=attention_mask, max_new_tokens=5, num_return_sequences=1,
+                                          streamer=self.streamer(start), pad_token_id=self.tokenizer.eos_token_id)
+        self.calls += 1
+        if self.first_call_first_token is None:
+            self.first_call_first_token = self.last_first_token
+        result = self.tokenizer.decode(outputs[0])
+        contents = result.split(PREFIX)[-1]
+        contents = contents.replace(',', '')
+        match = re.search(r"[-+]?\d*\.\d+|\d+", contents)
+        return float(match.group()) if match else 0
+
+    def stats(self) -> dict:
+        return {
+            "load_seconds": self.load_seconds,
+            "first_call_first_token_seconds": self.first_call_first_token,
+            "last_first_token_seconds": self.last_first_token,
+            "calls": self.calls,
+        }
+
+
+@app.function(image=image.env({"HF_HUB_CACHE": CACHE_DIR}), secrets=secrets, gpu=GPU, memory=32768, timeout=3600,
+              volumes={CACHE_DIR: hf_cache_volume})
+def snapshot():
+    """
+    Build the snapshot ahead of the first request: modal run playground/pricer_service_warm_modal.py::snapshot
+    """
+    build_snapshot(SNAPSHOT_DIR)
+    hf_cache_volume.commit()
+    return SNAPSHOT_DIR
+
+
+@app.cls(
+    image=image.env({"HF_HUB_CACHE": CACHE_DIR}),
+    secrets=secrets,
+    gpu=GPU,
+    memory=32768,
+    timeout=1800,
+    min_containers=MIN_CONTAINERS,
+    scaledown_window=SCALEDOWN_WINDOW,
+    volumes={CACHE_DIR: hf_cache_volume}
+)
+class Pricer:
+
+    @modal.enter()
+    def setup(self):
+        if not has_snapshot(SNAPSHOT_DIR):
+            print("No snapshot on the volume yet - merging and quantising, once")
+            build_snapshot(SNAPSHOT_DIR)
+            hf_cache_volume.commit()
+        self.pricer = WarmPricer(SNAPSHOT_DIR)
+        self.cold_start_seconds = time.time() - STARTED
+        print(f"Cold start {self.cold_start_seconds:.1f}s, of which loading the snapshot {self.pricer.load_seconds:.1f}s")
+
+    @modal.method()
+    def price(self, description: str) -> float:
+        result = self.pricer.price(description)
+        print(f"First token after {self.pricer.last_first_token:.3f}s")
+        return result
+
+    @modal.method()
+    def stats(self) -> dict:
+        """
+        Cold-start and first-token latencies of this container
+        """
+        return {"cold_start_seconds": self.cold_start_seconds, **self.pricer.stats()}
+
+
+@app.local_entrypoint()
+def main(description: str = "Quadcast HyperX condenser mic, connects via usb-c to your computer for crystal clear audio"):
+    pricer = Pricer()
+    print(f"Price: ${pricer.price.remote(description):,.2f}")
+    print(pricer.stats.remote())
+
+
+if __name__ == "__main__":
+    # Run locally against any small causal LM and LoRA adapter, e.g. for testing on a laptop:
+    # python playground/pricer_service_warm_modal.py <base model> <adapter> [snapshot directory]
+    base_model, adapter = sys.argv[1], sys.argv[2]
+    path = sys.argv[3] if len(sys.argv) > 3 else "pricer_snapshot"
+    if not has_snapshot(path):
+        start = time.perf_counter()
+        build_snapshot(path, base_model, adapter, revision=None, quantize=False)
+        print(f"Built the snapshot in {time.perf_counter() - start:.1f}s")
+    pricer = WarmPricer(path)
+    print(f"Cold start {time.time() - STARTED:.1f}s, of which loading the snapshot {pricer.load_seconds:.2f}s")
+    for description in ["A stainless steel kettle", "A USB-C charging cable, 2m"]:
+        print(f"${pricer.price(description):,.2f}, first token after {pricer.last_first_token:.3f}s")
+    print(pricer.stats())
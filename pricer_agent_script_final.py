@@ -1,77 +1,103 @@
-import logging
-import queue
 import threading
-import time
 import gradio as gr
 from deal_agent_framework import DealAgentFramework
+from scheduler import RunScheduler
 from agents.deals import Opportunity, Deal
-from log_utils import reformat
+from log_utils import LogStream
 import plotly.graph_objects as go
 
+VISIBLE_LOG_LINES = 18
+PAGE_SIZE = 10
+RUN_INTERVAL = 300
+# How often each session checks whether a run has started that it should follow
+POLL_INTERVAL = 10
+SORT_OPTIONS = {"Newest first": "created", "Biggest discount": "discount"}
 
-class QueueHandler(logging.Handler):
-    def __init__(self, log_queue):
-        super().__init__()
-        self.log_queue = log_queue
-
-    def emit(self, record):
-        self.log_queue.put(self.format(record))
 
 def html_for(log_data):
-    output = '<br>'.join(log_data[-18:])
+    output = '<br>'.join(log_data[-VISIBLE_LOG_LINES:])
     return f"""
     <div id="scrollContent" style="height: 400px; overflow-y: auto; border: 1px solid #ccc; background-color: #222229; padding: 10px;">
     {output}
     </div>
     """
 
-def setup_logging(log_queue):
-    handler = QueueHandler(log_queue)
-    formatter = logging.Formatter(
-        "[%(asctime)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S %z",
-    )
-    handler.setFormatter(formatter)
-    logger = logging.getLogger()
-    logger.addHandler(handler)
-    logger.setLevel(logging.INFO)
-                
-
 class App:
 
     def __init__(self):    
         self.agent_framework = None
+        self.scheduler = None
+        self.lock = threading.Lock()
+        self.following = set()
+        self.log_stream = LogStream.install()
 
     def get_agent_framework(self):
-        if not self.agent_framework:
-            self.agent_framework = DealAgentFramework()
-            self.agent_framework.init_agents_as_needed()
-        return self.agent_framework
+        with self.lock:
+            if not self.agent_framework:
+                self.agent_framework = DealAgentFramework()
+                self.agent_framework.init_agents_as_needed()
+            return self.agent_framework
+
+    def get_scheduler(self) -> RunScheduler:
+        """
+        The one scheduler shared by every browser session, started by the first one to load
+        """
+        framework = self.get_agent_framework()
+        with self.lock:
+            if not self.scheduler:
+                self.scheduler = RunScheduler(framework, interval=RUN_INTERVAL, on_complete=self.log_stream.notify)
+                self.scheduler.start()
+            return self.scheduler
 
     def run(self):
         with gr.Blocks(title="The Price is Right", fill_width=True) as ui:
             
-            log_data = gr.State([])
+            # Each session only keeps the sequence number it has seen and the visible tail of lines
+            log_data = gr.State({"sequence": 0, "lines": []})
             
             def table_for(opps):
-                return [[opp.deal.product_description, f"${opp.deal.price:.2f}", f"${opp.estimate:.2f}", f"${opp.discount:.2f}", opp.deal.url] for opp in opps]
-
-            def update_output(log_data, log_queue, result_queue):
-                initial_result = table_for(self.get_agent_framework().memory)
-                final_result = None
+                return [[opp.deal.product_description, f"${opp.deal.price:.2f}", f"${opp.estimate:.2f}", f"${opp.discount:.2f}", opp.deal.url, opp.id] for opp in opps]
+
+            def page_for(page, sort_label):
+                """
+                Query one page of opportunities from the framework, sorted server-side
+                """
+                opps, total = self.get_agent_framework().query_opportunities(
+                    page=int(page), page_size=PAGE_SIZE, sort_by=SORT_OPTIONS[sort_label], descending=True
+                )
+                pages = max(1, -(-total // PAGE_SIZE))
+                return table_for(opps), f"Page {int(page) + 1} of {pages} ({total} deals)"
+
+            def step_page(page, sort_label, step):
+                _, total = self.get_agent_framework().query_opportunities(page_size=PAGE_SIZE)
+                last = max(0, -(-total // PAGE_SIZE) - 1)
+                page = min(max(0, int(page) + step), last)
+                rows, label = page_for(page, sort_label)
+                return page, rows, label
+
+            def update_output(log_data, page, sort_label, finished):
+                """
+                Block on the shared log stream and push an update only when new lines
+                or the final result arrive
+                The table is only sent again if the rows on the visible page actually changed
+                """
+                table, label = page_for(page, sort_label)
+                yield log_data, html_for(log_data["lines"]), table, label
+                sequence = log_data["sequence"]
+                lines = log_data["lines"]
                 while True:
-                    try:
-                        message = log_queue.get_nowait()
-                        log_data.append(reformat(message))
-                        yield log_data, html_for(log_data), final_result or initial_result
-                    except queue.Empty:
-                        try:
-                            final_result = result_queue.get_nowait()
-                            yield log_data, html_for(log_data), final_result or initial_result
-                        except queue.Empty:
-                            if final_result is not None:
-                                break
-                            time.sleep(0.1)
+                    done = finished()
+                    sequence, new_lines = self.log_stream.wait(sequence, timeout=1.0)
+                    if new_lines:
+                        lines = (lines + new_lines)[-VISIBLE_LOG_LINES:]
+                    if done:
+                        log_data = {"sequence": sequence, "lines": lines}
+                        final_table, label = page_for(page, sort_label)
+                        yield log_data, html_for(lines), final_table if final_table != table else gr.update(), label
+                        break
+                    if new_lines:
+                        log_data = {"sequence": sequence, "lines": lines}
+                        yield log_data, html_for(lines), gr.update(), gr.update()
 
             def get_initial_plot():
                 fig = go.Figure()
@@ -107,31 +133,40 @@ class App:
 
                 return fig
         
-            def do_run():
-                new_opportunities = self.get_agent_framework().run()
-                table = table_for(new_opportunities)
-                return table
-
-            def run_with_logging(initial_log_data):
-                log_queue = queue.Queue()
-                result_queue = queue.Queue()
-                setup_logging(log_queue)
-                
-                def worker():
-                    result = do_run()
-                    result_queue.put(result)
-                
-                thread = threading.Thread(target=worker)
-                thread.start()
-                
-                for log_data, output, final_result in update_output(initial_log_data, log_queue, result_queue):
-                    yield log_data, output, final_result
+            def follow_run(initial_log_data, page, sort_label, request: gr.Request):
+                """
+                Follow the scheduler's current run: stream its logs, then refresh the table
+                Between runs this returns the current state at once, and a tick that arrives while
+                the session is already following a run is skipped, so ticks never pile up
+                Sessions never start runs themselves, so any number of them share one run
+                """
+                scheduler = self.get_scheduler()
+                run = scheduler.target()
+                session = request.session_hash
+                with self.lock:
+                    if session in self.following:
+                        yield gr.update(), gr.update(), gr.update(), gr.update()
+                        return
+                    if run is not None:
+                        self.following.add(session)
+                if run is None:
+                    table, label = page_for(page, sort_label)
+                    yield initial_log_data, html_for(initial_log_data["lines"]), table, label
+                    return
+                try:
+                    for log_data, output, table, label in update_output(initial_log_data, page, sort_label, lambda: scheduler.completed >= run):
+                        yield log_data, output, table, label
+                finally:
+                    with self.lock:
+                        self.following.discard(session)
 
             def do_select(selected_index: gr.SelectData):
-                opportunities = self.get_agent_framework().memory
-                row = selected_index.index[0]
-                opportunity = opportunities[row]
-                self.get_agent_framework().planner.emailer.alert(opportunity)
+                # The last column holds the opportunity id, so selection doesn't depend on list position
+                opportunity_id = selected_index.row_value[-1]
+                opportunity = self.get_agent_framework().get_opportunity(opportunity_id)
+                if opportunity:
+                    # A user's click always resends, even though the deal was alerted when it was found
+                    self.get_agent_framework().planner.emailer.alert(opportunity, force=True)
         
             with gr.Row():
                 gr.Markdown('<div style="text-align: center;font-size:24px"><strong>The Price is Right</strong> - Autonomous Agent Framework that hunts for deals</div>')
@@ -139,23 +174,34 @@ class App:
                 gr.Markdown('<div style="text-align: center;font-size:14px">A proprietary fine-tuned LLM deployed on Modal and a RAG pipeline with a frontier model collaborate to send push notifications with great online deals.</div>')
             with gr.Row():
                 opportunities_dataframe = gr.Dataframe(
-                    headers=["Deals found so far", "Price", "Estimate", "Discount", "URL"],
+                    headers=["Deals found so far", "Price", "Estimate", "Discount", "URL", "ID"],
                     wrap=True,
-                    column_widths=[6, 1, 1, 1, 3],
-                    row_count=10,
-                    col_count=5,
+                    column_widths=[6, 1, 1, 1, 3, 1],
+                    row_count=PAGE_SIZE,
+                    col_count=6,
                     max_height=400,
                 )
+            with gr.Row():
+                sort_by = gr.Dropdown(choices=list(SORT_OPTIONS), value="Newest first", show_label=False, scale=2)
+                previous_page = gr.Button("Previous", scale=1)
+                page = gr.Number(value=0, visible=False, precision=0)
+                page_label = gr.Markdown()
+                next_page = gr.Button("Next", scale=1)
             with gr.Row():
                 with gr.Column(scale=1):
                     logs = gr.HTML()
                 with gr.Column(scale=1):
                     plot = gr.Plot(value=get_plot(), show_label=False)
         
-            ui.load(run_with_logging, inputs=[log_data], outputs=[log_data, logs, opportunities_dataframe])
+            # Every session follows the shared runs concurrently, rather than queueing behind one another
+            ui.load(follow_run, inputs=[log_data, page, sort_by], outputs=[log_data, logs, opportunities_dataframe, page_label], concurrency_limit=None)
+
+            timer = gr.Timer(value=POLL_INTERVAL, active=True)
+            timer.tick(follow_run, inputs=[log_data, page, sort_by], outputs=[log_data, logs, opportunities_dataframe, page_label], concurrency_limit=None)
 
-            timer = gr.Timer(value=300, active=True)
-            timer.tick(run_with_logging, inputs=[log_data], outputs=[log_data, logs, opportunities_dataframe])
+            sort_by.change(lambda sort_label: (0, *page_for(0, sort_label)), inputs=[sort_by], outputs=[page, opportunities_dataframe, page_label])
+            previous_page.click(lambda p, s: step_page(p, s, -1), inputs=[page, sort_by], outputs=[page, opportunities_dataframe, page_label])
+            next_page.click(lambda p, s: step_page(p, s, 1), inputs=[page, sort_by], outputs=[page, opportunities_dataframe, page_label])
 
             opportunities_dataframe.select(do_select)
         
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Optional
+from deal_agent_framework import DealAgentFramework
+
+
+class RunScheduler:
+    """
+    Owns the planning runs for the whole process: one background thread kicks off
+    DealAgentFramework.run every interval, however many UI sessions are watching
+    Sessions never start runs themselves; they follow the scheduler's runs
+    and the shared log stream, so ten dashboards cost the same as one
+    """
+
+    def __init__(self, framework: DealAgentFramework, interval: float = 300, on_complete: Optional[Callable[[], None]] = None):
+        self.framework = framework
+        self.interval = interval
+        self.on_complete = on_complete
+        self.run_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.started = 0
+        self.completed = 0
+        self.last_error = None
+        self.thread = None
+        self.event_loop = None
+
+    @property
+    def running(self) -> bool:
+        return self.started > self.completed
+
+    def start(self) -> None:
+        """
+        Start the background thread, if it isn't already running; the first run begins immediately
+        """
+        with self.condition:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.loop, name="run-scheduler", daemon=True)
+            self.thread.start()
+
+    def loop(self) -> None:
+        while True:
+            self.run_once()
+            time.sleep(self.interval)
+
+    def target(self) -> Optional[int]:
+        """
+        The number of the run a newly arriving watcher should follow
+        :return: the run in progress, or None between runs
+        """
+        with self.condition:
+            return self.started if self.running else None
+
+    def run_once(self) -> bool:
+        """
+        Run the framework once, unless a run is already in progress
+        :return: True if this call did the run
+        """
+        if not self.run_lock.acquire(blocking=False):
+            return False
+        try:
+            with self.condition:
+                self.started += 1
+            try:
+                if self.framework.ASYNC_AGENTS:
+                    # One loop for every run: the agents' async clients are bound to the loop they were first used on
+                    if not self.event_loop:
+                        self.event_loop = asyncio.new_event_loop()
+                        asyncio.set_event_loop(self.event_loop)
+                    self.event_loop.run_until_complete(self.framework.arun())
+                else:
+                    self.framework.run()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+                logging.exception("Scheduled run failed")
+        finally:
+            with self.condition:
+                self.completed = self.started
+                self.condition.notify_all()
+            self.run_lock.release()
+            if self.on_complete:
+                self.on_complete()
+        return True
+
+    def wait_for(self, run: int, timeout: Optional[float] = None) -> bool:
+        """
+        Block until the given run number has completed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.completed < run:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
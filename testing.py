@@ -57,11 +57,15 @@ class Tester:
         plt.title(title)
         plt.show()
 
-    def report(self):
+    def metrics(self):
         average_error = sum(self.errors) / self.size
         rmsle = math.sqrt(sum(self.sles) / self.size)
         hits = sum(1 for color in self.colors if color=="green")
-        title = f"{self.title} Error=${average_error:,.2f} RMSLE={rmsle:,.2f} Hits={hits/self.size*100:.1f}%"
+        return average_error, rmsle, hits/self.size*100
+
+    def report(self):
+        average_error, rmsle, hit_rate = self.metrics()
+        title = f"{self.title} Error=${average_error:,.2f} RMSLE={rmsle:,.2f} Hits={hit_rate:.1f}%"
         self.chart(title)
 
     def run(self):
@@ -72,4 +76,21 @@ class Tester:
 
     @classmethod
     def test(cls, function, data):
-        cls(function, data).run()
\ No newline at end of file
+        cls(function, data).run()
+
+    @classmethod
+    def compare(cls, predictors, data, size=250):
+        """
+        Run several predictors over the same datapoints and print their scores side by side,
+        e.g. Tester.compare({"Random Forest": rf_pricer, "kNN": knn_pricer}, test)
+        """
+        results = {}
+        for title, predictor in predictors.items():
+            tester = cls(predictor, data, title=title, size=size)
+            for i in range(size):
+                tester.run_datapoint(i)
+            results[title] = tester.metrics()
+        print(f"{'Model':<20} {'Error':>10} {'RMSLE':>8} {'Hits':>8}")
+        for title, (average_error, rmsle, hit_rate) in results.items():
+            print(f"{title:<20} ${average_error:>9,.2f} {rmsle:>8,.2f} {hit_rate:>7.1f}%")
+        return results
\ No newline at end of file
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+import joblib
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
+from sklearn.linear_model import LinearRegression
+from agents.model_store import ModelStore
+from agents.pricing_log import PricingLog
+from agents.compact_forest import CompactForest
+from agents.vector_index import VectorCompressor
+from agents.vector_store import load_store
+from agents.specialist_head import SpecialistHead
+
+DB = "products_vectorstore"
+ENSEMBLE_FEATURES = ['Specialist', 'Frontier', 'RandomForest', 'Knn', 'Min', 'Max']
+# Pricing logs written before the kNN agent joined the ensemble have no Knn column
+LEGACY_ENSEMBLE_FEATURES = ['Specialist', 'Frontier', 'RandomForest', 'Min', 'Max']
+TRAINING_INFO = "training.json"
+
+
+def train_forest(collection, n_estimators: int = 100, sample_size: Optional[int] = None,
+                 compressor: Optional[VectorCompressor] = None) -> RandomForestRegressor:
+    """
+    Fit a random forest from scratch on the collection (or a random sample of it)
+    :param compressor: if given, the forest is trained on its PCA projection of the embeddings
+    """
+    _, X, y, _ = load_store(collection, sample_size)
+    if compressor:
+        X = compressor.project(X)
+    model = RandomForestRegressor(n_estimators=n_estimators, random_state=42, n_jobs=-1)
+    model.fit(X, y)
+    return model
+
+
+def train_hist_gradient_boosting(collection, sample_size: Optional[int] = None, max_iter: int = 300) -> HistGradientBoostingRegressor:
+    """
+    A much faster alternative to the random forest: histogram gradient boosting
+    fits the whole collection in minutes instead of an hour
+    """
+    _, X, y, _ = load_store(collection, sample_size)
+    model = HistGradientBoostingRegressor(max_iter=max_iter, random_state=42)
+    model.fit(X, y)
+    return model
+
+
+def warm_start_forest(model: RandomForestRegressor, X: np.ndarray, y: np.ndarray, extra_trees: int = 10) -> RandomForestRegressor:
+    """
+    Grow extra trees on new data, keeping every existing tree as it is
+    """
+    model.set_params(warm_start=True, n_estimators=len(model.estimators_) + extra_trees)
+    model.fit(X, y)
+    return model
+
+
+def publish_forest(store: ModelStore, model, trained_until: float, compressor: Optional[VectorCompressor] = None) -> int:
+    """
+    Publish a price regressor: the sklearn pickle (kept so further trees can be added),
+    plus the compact forest the agent prefers at load time when the model is a random forest,
+    plus the compressor if the model was trained on reduced embeddings
+    """
+    def write(path):
+        if compressor:
+            compressor.save(path)
+        joblib.dump(model, os.path.join(path, "model.pkl"))
+        if isinstance(model, RandomForestRegressor):
+            CompactForest.from_sklearn(model).save(os.path.join(path, "compact"))
+        with open(os.path.join(path, TRAINING_INFO), "w") as file:
+            json.dump({"trained_until": trained_until}, file)
+    return store.publish("random_forest", write)
+
+
+def trained_until(store: ModelStore, name: str) -> float:
+    current = store.current(name)
+    if not current:
+        return 0.0
+    try:
+        with open(os.path.join(current[1], TRAINING_INFO), "r") as file:
+            return json.load(file)["trained_until"]
+    except (FileNotFoundError, KeyError, ValueError):
+        return 0.0
+
+
+def update_random_forest(collection, store: ModelStore, log: PricingLog, extra_trees: int = 10, replay_size: int = 20000) -> Optional[int]:
+    """
+    Add trees to the live random forest using the labelled deals logged since it was last trained,
+    mixed with a replay sample of the collection so the new trees don't just fit a handful of deals
+    :return: the new version, or None if there was nothing new to learn from
+    """
+    since = trained_until(store, "random_forest")
+    records = [record for record in log.labelled() if record["time"] > since]
+    if not records:
+        return None
+    current = store.current("random_forest")
+    model = joblib.load(os.path.join(current[1], "model.pkl") if current else "random_forest_model.pkl")
+    if not isinstance(model, RandomForestRegressor):
+        raise ValueError("Only a random forest can be warm-started; retrain the gradient boosting model instead")
+    compressor = VectorCompressor.find(current[1]) if current else None
+    from agents.embeddings import get_encoder
+    X_new = get_encoder().encode([record["description"] for record in records]).astype(np.float32)
+    y_new = np.array([record["value"] for record in records], dtype=np.float32)
+    _, X_old, y_old, _ = load_store(collection, replay_size)
+    X = np.concatenate([X_old, X_new])
+    if compressor:
+        X = compressor.project(X)
+    model = warm_start_forest(model, X, np.concatenate([y_old, y_new]), extra_trees)
+    return publish_forest(store, model, max(record["time"] for record in records), compressor)
+
+
+def from_specialist(record: Dict) -> bool:
+    """
+    Whether a logged Specialist estimate came from the fine-tuned model on Modal rather than the local head
+    Records from before SpecialistSource was logged can't be told apart from the local head's, so they don't count
+    """
+    return record.get("SpecialistSource") not in (None, SpecialistHead.MODEL)
+
+
+def refit_ensemble(store: ModelStore, log: PricingLog, features: List[str] = ENSEMBLE_FEATURES, minimum: int = 20) -> Optional[int]:
+    """
+    Refit the LinearRegression stacker on the sub-model estimates of the labelled deals in the pricing log,
+    leaving out deals whose Specialist estimate came from the local head rather than the fine-tuned model
+    If too few records have every feature yet, fall back to the legacy features without Knn
+    :return: the new version, or None if there aren't enough complete records yet
+    """
+    base = [feature for feature in features if feature not in ('Min', 'Max')]
+    records = [record for record in log.labelled() if all(record.get(feature) is not None for feature in base)
+               and from_specialist(record)]
+    if len(records) < minimum:
+        if features == ENSEMBLE_FEATURES:
+            return refit_ensemble(store, log, LEGACY_ENSEMBLE_FEATURES, minimum)
+        return None
+    X = pd.DataFrame({feature: [float(record[feature]) for record in records] for feature in base})
+    X['Min'] = X[base].min(axis=1)
+    X['Max'] = X[base].max(axis=1)
+    X = X[features]
+    y = pd.Series([record["value"] for record in records])
+    model = LinearRegression()
+    model.fit(X, y)
+    latest = max(record["time"] for record in records)
+
+    def write(path):
+        joblib.dump(model, os.path.join(path, "model.pkl"))
+        with open(os.path.join(path, TRAINING_INFO), "w") as file:
+            json.dump({"trained_until": latest, "records": len(records)}, file)
+    return store.publish("ensemble", write)
+
+
+def train_specialist_head(collection, store: ModelStore, log: PricingLog, minimum: int = 200,
+                          replay_size: int = 20000) -> Optional[int]:
+    """
+    Fit the local head that stands in for the specialist, on the estimates the specialist logged from Modal,
+    never on the head's own
+    Until the log holds minimum of them, it learns from a sample of the vector store's prices instead,
+    so that development and CI have a working local specialist from the start
+    :return: the new version
+    """
+    records = [record for record in log if (record.get("Specialist") or 0) > 0 and from_specialist(record)]
+    from agents.embeddings import get_encoder
+    if len(records) >= minimum:
+        X = get_encoder().encode([record["description"] for record in records]).astype(np.float32)
+        y = np.array([record["Specialist"] for record in records], dtype=np.float32)
+    else:
+        _, X, y, _ = load_store(collection, replay_size)
+    head = SpecialistHead.fit(X, y)
+    latest = max((record["time"] for record in records), default=0.0)
+
+    def write(path):
+        head.save(path)
+        with open(os.path.join(path, TRAINING_INFO), "w") as file:
+            json.dump({"trained_until": latest, "records": len(records) if len(records) >= minimum else 0}, file)
+    return store.publish(SpecialistHead.STORE_NAME, write)
+
+
+def read_labels(path: str) -> Dict[str, float]:
+    """
+    Known prices by product description, from a .csv with description and price columns,
+    or from a .jsonl with one {"description": ..., "price": ...} object per line
+    """
+    if path.endswith(".csv"):
+        frame = pd.read_csv(path)
+    else:
+        frame = pd.read_json(path, lines=True)
+    return dict(zip(frame["description"], frame["price"].astype(float)))
+
+
+def check(collection, size: int = 200) -> None:
+    """
+    Exercise the retraining loop end to end in a temporary model store and pricing log:
+    log a sample of the vector store's products with sub-model estimates, label them with their known prices
+    through PricingLog.label, then check that update_random_forest and refit_ensemble each publish a version
+    """
+    import tempfile
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as directory:
+        store = ModelStore(os.path.join(directory, "models"))
+        log = PricingLog(os.path.join(directory, "pricing_log.jsonl"))
+        publish_forest(store, train_forest(collection, n_estimators=5, sample_size=size * 5), 0.0)
+        products = collection.get(limit=size, include=["documents", "metadatas"])
+        for description, metadata in zip(products["documents"], products["metadatas"]):
+            price = metadata["price"]
+            components = {name: float(price * rng.lognormal(0, 0.3)) for name in ("Specialist", "Frontier", "RandomForest", "Knn")}
+            log.append(description, price * 0.7, {**components, "SpecialistSource": "pricer-service"})
+        labelled = log.label(dict(zip(products["documents"], [metadata["price"] for metadata in products["metadatas"]])))
+        forest = update_random_forest(collection, store, log, extra_trees=2, replay_size=size)
+        ensemble = refit_ensemble(store, log)
+        print(f"Labelled {labelled} records; published random_forest v{forest} and ensemble v{ensemble}")
+        if not labelled or forest is None or ensemble is None:
+            raise RuntimeError("The retraining loop did not publish a version from labelled records")
+
+
+if __name__ == "__main__":
+    import chromadb
+    task = sys.argv[1] if len(sys.argv) > 1 else "all"
+    store = ModelStore()
+    log = PricingLog()
+    collection = chromadb.PersistentClient(path=DB).get_or_create_collection('products')
+    if task == "rebuild":
+        print(f"Published random_forest v{publish_forest(store, train_forest(collection), time.time())}")
+    if task == "rebuild-reduced":
+        # python training.py rebuild-reduced 128: a forest on the PCA projection of the embeddings
+        dimensions = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+        compressor = VectorCompressor.fit(load_store(collection, 20000)[1], dimensions)
+        model = train_forest(collection, compressor=compressor)
+        print(f"Published random_forest v{publish_forest(store, model, time.time(), compressor)}")
+    if task == "hgb":
+        print(f"Published random_forest v{publish_forest(store, train_hist_gradient_boosting(collection), time.time())}")
+    if task == "label":
+        # python training.py label known_prices.csv: join known prices onto the logged deals, as training labels
+        print(f"Labelled {log.label(read_labels(sys.argv[2]))} records in {log.filename}")
+    if task == "check":
+        check(collection)
+    if task in ("forest", "all"):
+        print(f"Random forest: {update_random_forest(collection, store, log) or 'no new labelled deals'}")
+    if task in ("specialist", "all"):
+        print(f"Specialist head: v{train_specialist_head(collection, store, log)}")
+    if task in ("ensemble", "all"):
+        print(f"Ensemble: {refit_ensemble(store, log) or 'not enough labelled records'}")